@@ -0,0 +1,264 @@
+"""
+Host agent of the CTF-Creator.
+
+The agent is uploaded to each host and started over SSH. It reads a deployment plan as JSON
+from stdin, applies it against the local Docker daemon and streams one JSON result per line
+to stdout. It only depends on the Python standard library and the Docker CLI of the host.
+
+Plan layout:
+    {
+        "workers": 8,
+        "users": [
+            {
+                "user": "...",
+                "steps": [{"op": "network", ...}, ...],
+                "firewall": ["shell command", ...]
+            }
+        ],
+        "finally": ["shell command", ...]
+    }
+
+The steps of a user run in order and stop at the first failure, users run in parallel.
+After all users, the firewall commands of every user whose steps all succeeded run, and
+then the commands in "finally", e.g. to persist the firewall.
+"""
+
+import io
+import json
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+output_lock = threading.Lock()
+
+
+def emit(result: dict) -> None:
+    with output_lock:
+        sys.stdout.write(json.dumps(result) + "\n")
+        sys.stdout.flush()
+
+
+def run(command: list, input: str | bytes = None) -> None:
+    if isinstance(input, str):
+        input = input.encode()
+    result = subprocess.run(command, input=input, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(
+            result.stderr.decode().strip() or result.stdout.decode().strip()
+        )
+
+
+def file_archive(files: dict) -> bytes:
+    """Builds a tar archive of the files for docker cp, including their folders."""
+    folders = sorted(
+        {
+            "/".join(name.split("/")[:depth])
+            for name in files
+            for depth in range(1, name.count("/") + 1)
+        }
+    )
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode="w") as tar:
+        for folder in folders:
+            directory = tarfile.TarInfo(name=folder)
+            directory.type = tarfile.DIRTYPE
+            directory.mode = 0o755
+            directory.mtime = int(time.time())
+            tar.addfile(directory)
+        for name, content in files.items():
+            data = content.encode()
+            info = tarfile.TarInfo(name=name)
+            info.size = len(data)
+            info.mode = 0o444
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+    return stream.getvalue()
+
+
+def container_command(spec: dict, create: bool = False) -> list:
+    """
+    Translates a container specification of the controller into a docker run call, or a
+    docker create call if the container is started later.
+    """
+    if create:
+        command = ["docker", "create", "--name", spec["name"]]
+    else:
+        command = ["docker", "run", "-d", "--name", spec["name"]]
+    command += ["--network", spec["network"], "--ip", spec["ip"]]
+    for key, value in (spec.get("environment") or {}).items():
+        command += ["-e", f"{key}={value}"]
+    for key, value in (spec.get("labels") or {}).items():
+        command += ["--label", f"{key}={value}"]
+    for capability in spec.get("cap_add") or []:
+        command += ["--cap-add", capability]
+    for option in spec.get("security_opt") or []:
+        command += ["--security-opt", option]
+    for container_port, host_port in (spec.get("ports") or {}).items():
+        command += ["-p", f"{host_port}:{container_port}"]
+    for volume in spec.get("volumes") or []:
+        command += ["-v", volume]
+    for path in spec.get("tmpfs") or {}:
+        command += ["--tmpfs", path]
+    command += ["--memory", spec["mem_limit"], "--cpu-quota", str(spec["cpu_quota"])]
+    command += ["--memory-swap", str(spec["memswap_limit"])]
+    command += ["--restart", spec["restart"], spec["image"]]
+    arguments = spec.get("command") or []
+    if isinstance(arguments, str):
+        arguments = arguments.split()
+    return command + [str(argument) for argument in arguments]
+
+
+def apply_step(step: dict) -> str:
+    """Applies one step and returns the name of the resource it handled."""
+    op = step["op"]
+    if op == "mkdir":
+        run(["mkdir", "-p", step["path"]])
+        return step["path"]
+    if op == "extract":
+        run(["mkdir", "-p", step["target"]])
+        run(
+            [
+                "tar",
+                "--strip-components=1",
+                "-xf",
+                step["archive"],
+                "-C",
+                step["target"],
+            ]
+        )
+        return step["archive"]
+    if op == "network":
+        run(
+            [
+                "docker",
+                "network",
+                "create",
+                "--driver",
+                "bridge",
+                "--subnet",
+                step["subnet"],
+                "--gateway",
+                step["gateway"],
+                step["name"],
+            ]
+        )
+        return step["name"]
+    if op == "remove":
+        run(["docker", "rm", "-f", step["name"]])
+        return step["name"]
+    if op == "container":
+        spec = step["spec"]
+        if step.get("pool"):
+            # A claimed pool container is renamed and connected instead of created.
+            run(["docker", "rename", step["pool"], spec["name"]])
+            run(
+                [
+                    "docker",
+                    "network",
+                    "connect",
+                    "--ip",
+                    spec["ip"],
+                    spec["network"],
+                    spec["name"],
+                ]
+            )
+        elif spec.get("files"):
+            run(container_command(spec, create=True))
+        else:
+            run(container_command(spec))
+            return spec["name"]
+        if spec.get("files"):
+            # The files have to be in place before the first start.
+            run(
+                ["docker", "cp", "-", f"{spec['name']}:/"],
+                input=file_archive(spec["files"]),
+            )
+        run(["docker", "start", spec["name"]])
+        return spec["name"]
+    if op == "attach":
+        spec = step["spec"]
+        try:
+            run(
+                [
+                    "docker",
+                    "network",
+                    "connect",
+                    "--ip",
+                    spec["ip"],
+                    spec["network"],
+                    spec["container"],
+                ]
+            )
+        except RuntimeError as e:
+            if "already exists" not in str(e):
+                raise
+        for path, content in spec["files"].items():
+            folder = path.rsplit("/", 1)[0]
+            run(
+                [
+                    "docker",
+                    "exec",
+                    "-i",
+                    spec["container"],
+                    "sh",
+                    "-c",
+                    f"mkdir -p /{folder} && cat > /{path}",
+                ],
+                input=content,
+            )
+        return spec["name"]
+    if op == "shell":
+        run(["sh", "-c", step["command"]])
+        return step["command"]
+    raise ValueError(f"Unknown operation {op}")
+
+
+def apply_user(user: dict) -> bool:
+    """Applies the steps of a user, returns False after the first failed step."""
+    for step in user["steps"]:
+        start = time.monotonic()
+        result = {"user": user["user"], "op": step["op"]}
+        try:
+            result["name"] = apply_step(step)
+            result["ok"] = True
+        except Exception as e:
+            result["ok"] = False
+            result["error"] = str(e)
+        result["seconds"] = round(time.monotonic() - start, 3)
+        emit(result)
+        if not result["ok"]:
+            return False
+    return True
+
+
+def run_commands(user: str, op: str, commands: list) -> bool:
+    """Runs shell commands until one fails and emits one result for all of them."""
+    result = {"user": user, "op": op, "name": f"{len(commands)} commands"}
+    try:
+        for command in commands:
+            run(["sh", "-c", command])
+        result["ok"] = True
+    except Exception as e:
+        result["ok"] = False
+        result["error"] = str(e)
+    emit(result)
+    return result["ok"]
+
+
+def main() -> None:
+    plan = json.load(sys.stdin)
+    users = plan.get("users", [])
+    with ThreadPoolExecutor(max_workers=plan.get("workers", 8)) as executor:
+        succeeded = list(executor.map(apply_user, users))
+    for user, ok in zip(users, succeeded):
+        if ok and user.get("firewall"):
+            run_commands(user["user"], "firewall", user["firewall"])
+    for command in plan.get("finally", []):
+        run_commands(None, "shell", [command])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,78 @@
 import os
-import random
 import sys
-from typing import List
-from docker import DockerClient
-import yamale
-import click
+
+sys.path.append(os.getcwd())
+if __name__ == "__main__" and sys.argv[1:2] == ["status"]:
+    # status only needs light modules, so it is started before the Docker SDK and the
+    # deployment code are imported.
+    from src.status import status
+
+    status.main(args=sys.argv[2:], prog_name=f"{os.path.basename(sys.argv[0])} status")
+
+import json
+import multiprocessing
 import pathlib
-import sys
-import os
+import random
+import re
+import shutil
 import time
-
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from ipaddress import IPv4Network, IPv6Network, ip_network
 from subprocess import run, CalledProcessError
-from docker import DockerClient
-from docker.errors import NotFound
+from typing import Dict, Iterator, List, Tuple
 
-from ipaddress import IPv4Network, IPv6Network, ip_network
+import click
+import yamale
+from docker import DockerClient
+from docker.errors import NotFound, APIError
 from yamale import YamaleError
 from yamale.validators import DefaultValidators
-from docker.errors import NotFound, APIError
 
-sys.path.append(os.getcwd())
-from src.host import Host
+from src.host import Host, KALI_IMAGE, SAVE_FIREWALL, shared_replica
+from src.distribution import ImageDistributor
+from src.idle import ACTIONS, IdleManager
+from src.lease import (
+    SSH_BATCH,
+    LeaseCollector,
+    expired_participants,
+    lease_expiry,
+    retired_users,
+)
+from src.lazy import log_lazy_metrics, percentile
+from src.journal import (
+    DATA_GENERATED,
+    DATA_UPLOADED,
+    FIREWALL,
+    KALI,
+    NETWORK,
+    OPENVPN,
+    Journal,
+    container_step,
+)
 from src.log_config import get_logger
 from src.utils import Path
 from src.participant import Participant
-from src.gen_flag import gen_flag
+from src.pipeline import Pipeline
+from src.plan import firewall_present, read_inventories, summarize, user_prefix
+from src.rebalance import plan_moves
+from src.rotate import FlagRotator, read_epoch, write_epoch
+from src.status import status
+from src.roster import (
+    Roster,
+    RosterError,
+    UserValidator,
+    deployed_participants,
+    read_users,
+)
+from src.gen_flag import challenge_environment
+from src.openvpn import (
+    OPENVPN_IMAGE,
+    ensure_image,
+    fetch_templates,
+    next_tunnel_ip,
+    write_gateway_files,
+    write_server_files,
+)
 
 
 logger = get_logger("ctf_creator.ctf")
@@ -36,6 +84,12 @@ class DownloadError(Exception):
     pass
 
 
+class OpenVPNError(Exception):
+    """Custom exception raised when the local OpenVPN container cannot issue a client configuration."""
+
+    pass
+
+
 class RemoteLineNotFoundError(Exception):
     """Custom exception raised when no 'remote' line is found in the OpenVPN configuration file."""
 
@@ -44,17 +98,58 @@ class RemoteLineNotFoundError(Exception):
 
 class CTFCreator:
     def __init__(
-        self, config: str, save_path: str, prune: bool, kalibox: bool, recreate: bool
+        self,
+        config: str,
+        save_path: str,
+        prune: bool,
+        kalibox: bool,
+        recreate: bool,
+        gateway: bool = False,
+        memory_report: bool = False,
+        agent: bool = False,
+        agent_workers: int = 8,
+        distribute_images: bool = False,
+        registry_mirror: str = None,
+        incremental: bool = False,
+        resume: bool = False,
+        workers: int = 1,
+        lazy: bool = False,
+        ready_target: float = 10.0,
+        lease_days: int = None,
+        processes: int = 1,
+        pipeline: bool = False,
+        upload_workers: int = 4,
+        queue_size: int = 8,
+        read_only: bool = False,
     ) -> None:
+        self.config_source = config
         self.config = self._get_config(config)
         self.prune = prune
         self.kalibox = kalibox
         self.recreate = recreate
+        self.gateway = gateway
+        self.memory_report = memory_report
+        self.agent = agent
+        self.agent_workers = agent_workers
+        self.distribute_images = distribute_images
+        self.registry_mirror = registry_mirror
+        self.incremental = incremental
+        self.resume = resume
+        self.workers = workers
+        self.lazy = lazy
+        self.ready_target = ready_target
+        self.lease_days = lease_days
+        self.processes = processes
+        self.pipeline = pipeline
+        self.upload_workers = upload_workers
+        self.queue_size = queue_size
         self.openvpn_port = 45000
         self.challenge_counter = 1
 
         logger.info(f"Containers: {self.config.get('containers')}")
-        logger.info(f"Users: {self.config.get('users')}")
+        logger.info(f"Users: {len(self.config.get('users') or [])}")
+        logger.info(f"Users file: {self.config.get('users_file')}")
+        logger.info(f"Teams: {len(self.config.get('teams') or [])}")
         logger.info(f"Key: {self.config.get('key')}")
         logger.info(f"Hosts: {self.config.get('hosts')}")
         logger.info(f"IP-Address Subnet-base: {self.config.get('subnet')}")
@@ -65,15 +160,26 @@ class CTFCreator:
         logger.info(f"Total number of containers per user {self.total_amount}")
 
         self.save_path = save_path
+        self.journal = Journal(save_path=save_path, read_only=read_only)
+        self.epoch = read_epoch(save_path=save_path)
         self.subnet = ip_network(self.config.get("subnet"))
         self.next_network = self.subnet
 
-        self.local_docker = DockerClient(base_url="unix:///var/run/docker.sock")
+        self._local_docker = None
         self.local_docker_ip = "0.0.0.0"
         self.local_docker_port = "85"
         self.local_docker_openvpn = "local_vpn"
+        self.openvpn_templates = None
+
+    @property
+    def local_docker(self) -> DockerClient:
+        """The Docker of this machine, only connected once it is needed."""
+        if self._local_docker is None:
+            self._local_docker = DockerClient(base_url="unix:///var/run/docker.sock")
+        return self._local_docker
 
-    def _get_config(self, config: dict) -> dict:
+    @staticmethod
+    def _get_config(config: dict) -> dict:
         try:
             validators = DefaultValidators.copy()  # This is a dictionary
             validators[Path.tag] = Path
@@ -86,6 +192,21 @@ class CTFCreator:
             # Validate data against the schema. Throws a ValueError if data is invalid.
             yamale.validate(schema, data)
 
+            if not any(data[0][0].get(k) for k in ("users", "users_file", "teams")):
+                logger.error(
+                    "Validation failed! Either users, users_file or teams is required."
+                )
+                exit(1)
+
+            for container in data[0][0].get("containers"):
+                if container.get("shared") and not container.get("shared_unisolated"):
+                    logger.error(
+                        f"Validation failed! The shared challenge {container['name']} "
+                        f"serves many users from one container, set shared_unisolated "
+                        f"to true to accept that it is not isolated."
+                    )
+                    exit(1)
+
             logger.info("YAML file loaded successfully.")
 
             return data[0][0]
@@ -110,18 +231,38 @@ class CTFCreator:
                 host_object.clean_up()
         return hosts
 
-    def _start_local_openvpn(self):
+    def _distribute_images(self) -> None:
+        images = [OPENVPN_IMAGE] + [c["image"] for c in self.config.get("containers")]
+        if self.kalibox:
+            images.append(KALI_IMAGE)
+        distributor = ImageDistributor(
+            local_docker=self.local_docker,
+            hosts=self.hosts,
+            mirror=self.registry_mirror,
+        )
+        distributor.distribute(images=list(dict.fromkeys(images)))
+
+    def _start_local_openvpn(self, data_path: str = None):
+        """
+        Starts the local OpenVPN container used to generate the client configurations.
+
+        Args:
+            data_path (str, optional): An existing Dockovpn_data archive, e.g. of a gateway,
+                that is loaded before the start so new clients are signed by its CA.
+        """
         try:
+            # A left over container, e.g. of an interrupted run, holds the PKI of another
+            # server and would sign the new clients with the wrong CA.
             con = self.local_docker.containers.get(self.local_docker_openvpn)
-            if con:
-                return
+            logger.warning(f"Replace the running {self.local_docker_openvpn}.")
+            con.remove(force=True)
         except NotFound:
-            logger.warning(f"Not started yet.")
+            logger.debug(f"{self.local_docker_openvpn} is not running.")
 
         try:
-            container = self.local_docker.containers.run(
-                image="alekslitvinenk/openvpn",
-                detach=True,
+            ensure_image(client=self.local_docker)
+            container = self.local_docker.containers.create(
+                image=OPENVPN_IMAGE,
                 name=self.local_docker_openvpn,
                 command="-s",
                 restart_policy={"Name": "always"},
@@ -136,6 +277,10 @@ class CTFCreator:
                 memswap_limit=0,
                 cpu_quota=100000,
             )
+            if data_path:
+                with open(data_path, "rb") as f:
+                    container.put_archive("/opt", f.read())
+            container.start()
 
             return container
         except APIError as e:
@@ -196,20 +341,39 @@ class CTFCreator:
             logger.error(f"Error: An unexpected error occurred - {e}")
             raise DownloadError(f"An unexpected error occurred - {e}")
 
-    def _openvpn_config(self, user: Participant):
+    def _list_clients(self, container) -> set:
+        _, output = container.exec_run("ls /opt/Dockovpn_data/clients")
+        return set(output.decode().split())
+
+    def _openvpn_config(self, user: Participant, archive_path: str = None) -> str:
+        """
+        Generates a client configuration for the user in the local OpenVPN container and
+        saves the Dockovpn_data folder.
+
+        Args:
+            user (Participant): The user the configuration is generated for.
+            archive_path (str, optional): Where the Dockovpn_data archive is saved,
+                defaults to the user data.
+
+        Returns:
+            str: The common name of the generated client.
+
+        Raises:
+            OpenVPNError: If the local OpenVPN container fails.
+        """
         logger.info(f"Downloading OpenVPN configuration for {user.name}...")
 
         # Download the folder with data
         try:
             container = self.local_docker.containers.get(self.local_docker_openvpn)
-        except NotFound:
+        except NotFound as e:
             logger.error(f"Error: Container {self.local_docker_openvpn} not found.")
-            exit(1)
+            raise OpenVPNError(f"{self.local_docker_openvpn} not found") from e
         except Exception as e:
             logger.error(
                 f"Error: Something is wrong with {self.local_docker_openvpn}. {e}"
             )
-            exit(1)
+            raise OpenVPNError(str(e)) from e
 
         unhealthy = True
         max_retries = 0
@@ -230,20 +394,24 @@ class CTFCreator:
             time.sleep(5)
 
         try:
+            clients = self._list_clients(container)
             logger.info("Executing command in container...")
             _, _ = container.exec_run("./genclient.sh", detach=True)
             # Delay to give time to run the command in the container
             time.sleep(5)
             self._curl_client_ovpn(user=user.name, save_path=user.save_path)
+            new_clients = self._list_clients(container) - clients
+            client_id = new_clients.pop() if new_clients else None
         except Exception as e:
             logger.error(f"Error: Unable to execute command in container. {e}")
-            exit(1)
+            raise OpenVPNError(str(e)) from e
 
         try:
             container = self.local_docker.containers.get(self.local_docker_openvpn)
-            local_save_path = f"{user.save_path}/data/{user.name}"
-            local_path_to_data = f"{user.save_path}/data/{user.name}/dockovpn_data.tar"
-            os.makedirs(local_save_path, exist_ok=True)
+            local_path_to_data = (
+                archive_path or f"{user.save_path}/data/{user.name}/dockovpn_data.tar"
+            )
+            os.makedirs(os.path.dirname(local_path_to_data), exist_ok=True)
             archive, _ = container.get_archive("/opt/Dockovpn_data")
             # Save the archive to a local file
             with open(local_path_to_data, "wb") as f:
@@ -251,14 +419,16 @@ class CTFCreator:
                     f.write(chunk)
             logger.info(f"Container found: {self.local_docker_openvpn}")
             logger.info("And the Dockovpn_data folder is saved on this system")
-        except NotFound:
+        except NotFound as e:
             logger.info(f"Error: Container {self.local_docker_openvpn} not found.")
-            exit(1)
+            raise OpenVPNError(f"{self.local_docker_openvpn} not found") from e
         except Exception as e:
             logger.info(
                 f"Error: Something is wrong with the saving of the ovpn_data!. {e}"
             )
-            exit(1)
+            raise OpenVPNError(str(e)) from e
+
+        return client_id
 
     def _modify_ovpn_client(self, user: Participant) -> None:
         """
@@ -319,28 +489,37 @@ class CTFCreator:
                 f"No change needed for {user}. The IP address and port are already correct."
             )
 
-    def _check_running(self, user: str, host: Host):
+    def _check_running(
+        self, user: str, host: Host, gateway: bool = False, lazy: bool = False
+    ):
         logger.info("Check if containers and OpenVPN exists...")
 
         running = []
 
-        if host.container_exists(user=user, container="openvpn"):
+        if gateway:
+            if host.network_exists(user=user) and host.attached(
+                container_name="gateway_openvpn", user=user
+            ):
+                running.append("openvpn")
+        elif host.container_exists(user=user, container="openvpn"):
             running.append("openvpn")
 
         if self.kalibox and host.container_exists(user=user, container="kali"):
             running.append("kali")
 
         for container in self.config.get("containers"):
-            if host.container_exists(user=user, container=container["name"]):
+            if self._challenge_exists(
+                host=host, user=user, container=container["name"]
+            ):
                 running.append(container["name"])
 
-        if len(running) == self.total_amount:
+        if len(running) == self.total_amount or (lazy and "openvpn" in running):
             logger.info(f"All are up and running for {user}")
             return running
         else:
             logger.info(f"Remove containers, not all are up and running for {user}")
 
-            if self.recreate:
+            if self.recreate and not gateway:
                 logger.debug("Remove OpenVPN container to recreate.")
                 host.container_remove(user=user, container="openvpn")
                 if "openvpn" in running:
@@ -354,7 +533,8 @@ class CTFCreator:
 
             host.challenge_remove(user=user)
 
-            if self.recreate:
+            if self.recreate and not gateway:
+                # The network of a gateway user is shared with the running gateway.
                 host.network_remove(user=user)
 
             return running
@@ -362,161 +542,2515 @@ class CTFCreator:
     def create_challenge(self):
         logger.info("Set up hosts.")
         self.hosts = self._get_hosts()
+        if self.distribute_images:
+            self._distribute_images()
+        self._start_shared()
         logger.info("Begin set up of challenge.")
 
-        used_ports = []
-        used_subnets = []
+        teams = self._teams()
+        retired = retired_users(save_path=self.save_path)
+        previous = Roster(save_path=self.save_path).load() if self.incremental else None
+        used_ports, used_subnets = self._used_allocations()
+        # Only the names of the roster are kept, the users file is streamed once.
+        roster = set()
+        expired = 0
         users = []
+        positions = {}
+        logger.info("\u2500" * 120)
+        try:
+            for mail in self._iter_users(teams=teams):
+                if mail in retired:
+                    expired += 1
+                    continue
+                idx = len(roster)
+                roster.add(mail)
+                if previous is not None and mail in previous:
+                    continue
+                user_obj = Participant(user=mail, save_path=self.save_path)
+
+                if os.path.exists(f"{user_obj.save_path}/data/{user_obj.name}"):
+                    logger.info(f"OpenVPN data exists for the user: {user_obj.name}")
+                    logger.debug(
+                        f"Data for the user: {user_obj.name} will NOT be changed. Starting OVPN Docker container with existing data."
+                    )
+
+                users.append(user_obj)
+                positions[user_obj.name] = idx
+        except RosterError as e:
+            logger.error(e)
+            exit(1)
+        if expired:
+            logger.info(f"Skip {expired} users with expired lease")
+
+        kept = []
+        if self.incremental:
+            removed = sorted(previous - roster)
+            logger.info(f"Roster: {len(users)} added and {len(removed)} removed users")
+            kept = self._remove_users(users=removed)
+
+        logger.info(f"Ports in use {len(used_ports)}")
+        logger.info(f"Subnets in use {len(used_subnets)}")
+        logger.info(f"Users to deploy {len(users)} of {len(roster)}")
         logger.info("\u2500" * 120)
-        for idx, mail in enumerate(self.config.get("users")):
-            user_obj = Participant(user=mail, save_path=self.save_path)
 
-            if os.path.exists(f"{user_obj.save_path}/data/{user_obj.name}"):
-                logger.info(f"OpenVPN data exists for the user: {user_obj.name}")
-                logger.debug(
-                    f"Data for the user: {user_obj.name} will NOT be changed. Starting OVPN Docker container with existing data."
+        agent_users = {}
+        sharded_users = {}
+        parallel_users = []
+        pipeline_users = []
+        for user in users:
+            user_path = f"{self.save_path}/data/{user.name}"
+            if (
+                self.resume
+                and os.path.exists(user_path)
+                and not os.path.exists(f"{user_path}/README.md")
+                and not self.journal.done(user=user.name, step=DATA_GENERATED)
+            ):
+                logger.warning(f"Remove incomplete data of {user.name}.")
+                shutil.rmtree(user_path)
+            if not os.path.exists(user_path):
+                if self.pipeline and not self.gateway and not self.agent:
+                    pipeline_users.append(user)
+                    continue
+                self._create_openvpn_data(
+                    positions[user.name], user, used_ports, used_subnets
                 )
-                used_ports.append(int(user_obj.existing_openvpn_port))
-                used_subnets.append(str(user_obj.subnet))
+                self.journal.record(user=user.name, step=DATA_GENERATED)
 
-            users.append(user_obj)
+            host = self._prepare_user(user=user, teams=teams)
+            if host is None:
+                continue
 
-        logger.info(f"Ports in use {used_ports}")
-        logger.info(f"Subnets in use {used_subnets}")
-        logger.info("\u2500" * 120)
+            if self.agent and not user.gateway:
+                agent_users.setdefault(host, []).append(user)
+                continue
 
-        futures = []
-        for idx, user in enumerate(users):
-            if not os.path.exists(f"{self.save_path}/data/{user.name}"):
-                self._create_openvpn_data(idx, user, used_ports, used_subnets)
+            if self.processes > 1 and not user.gateway:
+                sharded_users.setdefault(host, []).append(user)
+                continue
 
-            host: Host = [d for d in self.hosts if str(d.ip) == str(user.ip)][0]
-            logger.debug(f"Deploy on host: {host.ip}")
+            if self.workers > 1 and not user.gateway:
+                parallel_users.append((user, host))
+                continue
 
             self.deploy_challenge(user, host)
 
-    def deploy_challenge(self, user: Participant, host: Host) -> str:
+        if parallel_users:
+            self._deploy_parallel(users=parallel_users)
 
-        logger.info("\u2500" * 120)
-        logger.info(f"Create Challenge for {user.name}")
+        if sharded_users:
+            self._deploy_sharded(users_by_host=sharded_users)
+
+        if pipeline_users:
+            self._deploy_pipeline(
+                users=pipeline_users,
+                positions=positions,
+                used_ports=used_ports,
+                used_subnets=used_subnets,
+                teams=teams,
+            )
+
+        if agent_users:
+            self._deploy_with_agent(users_by_host=agent_users)
+
+        self._report_admission()
+        self._report_shared()
+
+        self._fill_pools()
+        # Users that could not be removed stay in the snapshot and are removed next time.
+        Roster(save_path=self.save_path).save(users=roster | set(kept))
+        self.journal.close()
+
+        if self.memory_report:
+            self._report_openvpn_memory(users=users)
 
-        running = self._check_running(user=user.name, host=host)
+    def _prepare_user(
+        self, user: Participant, teams: Dict[str, List[str]]
+    ) -> Host | None:
+        """
+        Updates the lease and the lazy state of a user with data, migrates it to the
+        gateway and completes the member profiles of a team.
+
+        Returns:
+            Host | None: The host of the user, None if its lease expired.
+        """
+        expires = self._lease_expiry(user=user)
+        if expires != user.metadata.get("expires"):
+            user.metadata["expires"] = expires
+            user.write_metadata()
+        if expires and expires < time.time():
+            logger.warning(f"Lease of {user.name} expired, skip deployment.")
+            return None
+
+        host: Host = [d for d in self.hosts if str(d.ip) == str(user.ip)][0]
+        logger.debug(f"Deploy on host: {host.ip}")
+
+        if self.lazy and "lazy" not in user.metadata:
+            # Users that already have their challenges do not wait for a connect.
+            lazy = not self._deployed(user=user, host=host)
+            user.metadata.update(lazy=lazy, kali=self.kalibox)
+            user.write_metadata()
+        elif not self.lazy and user.metadata.get("lazy"):
+            # Deployed completely now, so the user no longer waits for a connect.
+            user.metadata["lazy"] = False
+            user.write_metadata()
 
-        if not host.network_exists(user=user.name):
-            host.create_network(user=user.name, subnet=user.subnet)
+        if self.gateway and not user.gateway:
+            self._migrate_to_gateway(user=user, host=host)
+
+        if user.name in teams:
+            self._ensure_member_profiles(team=user, members=teams[user.name])
+        return host
+
+    def _deploy_pipeline(
+        self,
+        users: List[Participant],
+        positions: Dict[str, int],
+        used_ports: List[int],
+        used_subnets: List[str],
+        teams: Dict[str, List[str]],
+    ) -> None:
+        """
+        Deploys new users in three stages connected by bounded queues: the OpenVPN data is
+        generated on this machine, uploaded to the host and then the containers are
+        created. So the data of the next users is generated while the first users are
+        uploaded and deployed. The generation runs in one thread, as it allocates the port
+        and subnet and uses the local OpenVPN container.
+        """
+
+        def generate(user: Participant) -> tuple:
+            self._create_openvpn_data(
+                positions[user.name], user, used_ports, used_subnets
+            )
+            self.journal.record(user=user.name, step=DATA_GENERATED)
+            host = self._prepare_user(user=user, teams=teams)
+            return (user, host) if host else None
 
-        if not "openvpn" in running:
+        def upload(item: tuple) -> tuple:
+            user, host = item
             host.send_and_extract_tar(user=user.name)
-            host.start_openvpn(
-                user=user.name,
-                openvpn_port=user.existing_openvpn_port,
-                subnet=user.subnet,
+            self.journal.record(user=user.name, step=DATA_UPLOADED)
+            return item
+
+        def deploy(item: tuple) -> tuple:
+            user, host = item
+            logger.info(self.deploy_challenge(user, host, uploaded=True))
+            return item
+
+        pipeline = Pipeline(
+            stages=[
+                ("generate", generate, 1),
+                ("upload", upload, self.upload_workers),
+                ("deploy", deploy, self.workers),
+            ],
+            queue_size=self.queue_size,
+            label=lambda item: (item[0] if isinstance(item, tuple) else item).name,
+        )
+        start = time.monotonic()
+        failed = pipeline.run(items=users)
+        elapsed = time.monotonic() - start
+
+        for name, stats in pipeline.stats().items():
+            logger.info(
+                f"Stage {name}: {stats['processed']} users, {stats['failed']} failed, "
+                f"{stats['workers']} workers busy {stats['busy']}s, queue depth avg "
+                f"{stats['avg_depth']} max {stats['max_depth']}, the stage before "
+                f"waited {stats['blocked']}s on the full queue"
+            )
+        deployed = pipeline.stats()["deploy"]["processed"]
+        logger.info(
+            f"Pipeline deployed {deployed} of {len(users)} new users in {elapsed:.1f}s "
+            f"({deployed / elapsed if elapsed else 0:.2f} users/s)"
+        )
+        if failed:
+            logger.error(
+                f"Deployment failed for {len(failed)} users, continue with --resume: "
+                f"{[name for name, _ in failed]}"
             )
 
-        used_ip = []
-        for container in self.config.get("containers"):
-            if not container["name"] in running:
-                used = True
-                while used:
-                    random_ip = random.randint(4, 254)
-                    if not random_ip in used_ip:
-                        used_ip.append(random_ip)
-                        used = False
-                logger.debug(f"Randomized port {random_ip}")
-                host.start_container(
-                    user=user.name,
-                    container=container,
-                    subnet=user.subnet,
-                    index=random_ip,
-                    environment={
-                        "USER": user.name,
-                        "SECRET": self.config.get("secret"),
-                        "FLAG": gen_flag(
-                            secret=self.config.get("secret"),
-                            user=f"{user.name}_{container['name']}",
-                        ),
-                    },
+    def _deploy_parallel(self, users: List[tuple]) -> None:
+        """
+        Deploys users in parallel. The admission controller of each host keeps the Docker
+        calls within what its daemon can handle, a failed user does not stop the others.
+        """
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {
+                executor.submit(self.deploy_challenge, user, host): user
+                for user, host in users
+            }
+            for future, user in futures.items():
+                try:
+                    logger.info(future.result())
+                except Exception as e:
+                    failed.append(user.name)
+                    logger.error(f"Deployment of {user.name} failed: {e}")
+        if failed:
+            logger.error(
+                f"Deployment failed for {len(failed)} users, continue with --resume: {failed}"
+            )
+
+    def _deploy_sharded(self, users_by_host: Dict[Host, List[Participant]]) -> None:
+        """
+        Deploys the users of each host in a worker process of its own, so the SSH, SFTP
+        and JSON work of many hosts is spread over the cores of this machine. Ports and
+        subnets are already allocated, every worker only opens its own connections to its
+        host and deploys its users with --workers threads.
+        """
+        options = self._shard_options()
+        start = time.monotonic()
+        ready = {}
+        failed = []
+        # Spawned instead of forked, the workers must not share the open connections.
+        with ProcessPoolExecutor(
+            max_workers=min(self.processes, len(users_by_host)),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            futures = {
+                executor.submit(
+                    deploy_shard, options, host.host, [u.name for u in users]
+                ): (host, users)
+                for host, users in users_by_host.items()
+            }
+            for future, (host, users) in futures.items():
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f"Worker of host {host.ip} failed: {e}")
+                    failed += [u.name for u in users]
+                    continue
+                ready.update(result["ready"])
+                failed += result["failed"]
+                stats = result["admission"]
+                logger.info(
+                    f"Worker of host {host.ip}: {len(result['ready'])} of "
+                    f"{len(users)} users in {result['seconds']}s, "
+                    f"{stats['calls']} Docker calls, limit {stats['limit']}, "
+                    f"max queue depth {stats['max_waiting']}"
                 )
+        # The workers changed the hosts, the pools and reports need the current lists.
+        for host in users_by_host:
+            host.refresh()
+        # Compacting the journal keeps only the steps this process knows of.
+        self.journal.reload()
 
-        if self.kalibox and not "kali" in running:
-            self._start_kalibox(user=user.name, host=host, subnet=user.subnet)
+        elapsed = time.monotonic() - start
+        logger.info(
+            f"Deployed {len(ready)} users with {len(futures)} host workers in "
+            f"{elapsed:.1f}s ({len(ready) / elapsed if elapsed else 0:.2f} users/s)"
+        )
+        if ready:
+            values = list(ready.values())
+            logger.info(
+                f"Deployment per user p50 {percentile(values, 50)}s, "
+                f"p95 {percentile(values, 95)}s, max {max(values)}s"
+            )
+        if failed:
+            logger.error(
+                f"Deployment failed for {len(failed)} users, continue with --resume: {failed}"
+            )
 
-        logger.info("\u2500" * 120)
+    def _shard_options(self) -> dict:
+        """Returns the options of a worker, which only deploys the users of its host."""
+        return {
+            "config": self.config_source,
+            "save_path": self.save_path,
+            "prune": False,
+            "kalibox": self.kalibox,
+            "recreate": self.recreate,
+            "gateway": self.gateway,
+            "resume": self.resume,
+            "workers": self.workers,
+            "lazy": self.lazy,
+            "lease_days": self.lease_days,
+        }
+
+    def deploy_host(self, host: Host, users: List[Participant]) -> dict:
+        """
+        Deploys users of one host with --workers threads. Runs in the worker process of
+        the host.
 
-        return f"Done for User: {user.name}"
+        Returns:
+            dict: The seconds until each user was deployed, the failed users, the duration
+                and the statistics of the admission controller of the host.
+        """
 
-    def _create_openvpn_data(
-        self, idx: int, user: Participant, used_ports: list, used_subnets: list
-    ):
+        def deploy(user: Participant) -> float:
+            started = time.monotonic()
+            self.deploy_challenge(user, host)
+            return time.monotonic() - started
+
+        start = time.monotonic()
+        ready = {}
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(deploy, user): user for user in users}
+            for future, user in futures.items():
+                try:
+                    ready[user.name] = round(future.result(), 1)
+                except Exception as e:
+                    failed.append(user.name)
+                    logger.error(f"Deployment of {user.name} failed: {e}")
+        self.journal.close()
+        return {
+            "ready": ready,
+            "failed": failed,
+            "seconds": round(time.monotonic() - start, 1),
+            "admission": host.docker.admission.stats(),
+        }
+
+    def _report_admission(self) -> None:
+        """Logs the call limit, queue depth and errors of the Docker calls per host."""
+        for host in self.hosts:
+            stats = host.docker.admission.stats()
+            if not stats["calls"]:
+                continue
+            logger.info(
+                f"Docker calls on host {host.ip}: {stats['calls']} calls, "
+                f"limit {stats['limit']}, max queue depth {stats['max_waiting']}, "
+                f"{stats['errors']} transient errors, {stats['retried']} retries, "
+                f"latency {stats['latency']}s"
+            )
+
+    def _lease_expiry(self, user: Participant) -> float:
+        """
+        Returns the end of the lease of a user. The expires value of the configuration
+        applies to all users, otherwise new users get a lease of --lease-days.
+        """
+        if self.config.get("expires"):
+            return lease_expiry(self.config.get("expires"))
+        if self.lease_days and not user.metadata.get("expires"):
+            return time.time() + self.lease_days * 24 * 60 * 60
+        return user.metadata.get("expires")
+
+    def _iter_users(self, teams: Dict[str, List[str]]) -> Iterator[str]:
+        """
+        Yields the users of the configuration, the teams, followed by the users of the users
+        file. The users file is streamed and validated row by row. Team members share the
+        namespace of the users, as their profiles are saved under the name of the member.
+
+        Args:
+            teams (Dict[str, List[str]]): The members of each team, see _teams.
+
+        Raises:
+            RosterError: If a user or member is invalid or appears twice.
+        """
+        validator = UserValidator()
+        for user in self.config.get("users") or []:
+            yield validator.validate(user=user, source="users")
+        for team, members in teams.items():
+            yield validator.validate(user=team, source="teams")
+            for member in members:
+                validator.validate(user=member, source=f"teams.{team}")
+        if self.config.get("users_file"):
+            yield from read_users(
+                path=self.config.get("users_file"), validator=validator
+            )
+
+    def _teams(self) -> Dict[str, List[str]]:
+        """
+        Returns the members of each team. A team is deployed like a single user, every
+        member gets its own client configuration for the OpenVPN server of the team. The
+        members are validated together with the users by _iter_users.
+        """
+        return {
+            team["name"]: list(team["members"])
+            for team in self.config.get("teams") or []
+        }
+
+    def _used_allocations(self) -> Tuple[List[int], List[str]]:
+        """
+        Collects the ports and subnets of all users with existing data, including users
+        that were removed from the roster, so they are never handed out twice.
+
+        The allocations are cached in allocations.json with the modification time of the
+        client configuration, only new or regenerated users are parsed again.
+        """
+        used_ports = []
+        used_subnets = []
+        data_path = f"{self.save_path}/data"
+        if not os.path.isdir(data_path):
+            return used_ports, used_subnets
+        cache_path = f"{self.save_path}/allocations.json"
+        cache = {}
+        if os.path.exists(cache_path):
+            with open(cache_path, "r") as file:
+                cache = json.load(file)
+
+        allocations = {}
+        for entry in os.scandir(data_path):
+            try:
+                modified = os.stat(f"{entry.path}/client.ovpn").st_mtime
+            except OSError:
+                continue
+            cached = cache.get(entry.name)
+            if cached and cached["modified"] == modified:
+                allocations[entry.name] = cached
+                continue
+            user = Participant(user=entry.name, save_path=self.save_path)
+            allocations[entry.name] = {
+                "modified": modified,
+                "port": int(user.existing_openvpn_port),
+                "subnet": str(user.subnet),
+            }
+        if allocations != cache:
+            with open(f"{cache_path}.part", "w") as file:
+                json.dump(allocations, file)
+            os.replace(f"{cache_path}.part", cache_path)
+
+        for allocation in allocations.values():
+            used_ports.append(allocation["port"])
+            used_subnets.append(allocation["subnet"])
+        return used_ports, used_subnets
+
+    def _remove_users(self, users: List[str]) -> List[str]:
+        """
+        Removes the containers and networks of users that are no longer in the roster. Their
+        data is kept, so their port and subnet stay reserved if they are added again.
+
+        Returns:
+            List[str]: The users that could not be removed.
+        """
+        failed = []
+        for name in users:
+            user = Participant(user=name, save_path=self.save_path)
+            if not os.path.isfile(f"{self.save_path}/data/{user.name}/client.ovpn"):
+                continue
+            hosts = [h for h in self.hosts if str(h.ip) == str(user.ip)]
+            if not hosts:
+                logger.warning(
+                    f"Host {user.ip} of removed user {user.name} is unknown."
+                )
+                continue
+            try:
+                hosts[0].user_remove(user=user.name, gateway=user.gateway)
+            except APIError as e:
+                logger.error(f"Could not remove {user.name} from host {user.ip}: {e}")
+                failed.append(user.name)
+        return failed
+
+    def apply(self, dry_run: bool = False, output: str = None) -> dict:
+        """
+        Compares the desired state, the configuration and the user data, with the actual
+        state of the hosts and runs the operations that close the gap.
+
+        The actual state is read with one SSH command per host. The plan lists the
+        containers and networks to create or remove, the uploads and the firewall changes
+        of every user. It is executed without checking the hosts again: all hosts in
+        parallel, the users of a host with --workers threads and the firewall rules of a
+        host in one batch.
+
+        Args:
+            dry_run (bool, optional): Only logs the plan.
+            output (str, optional): Path of a JSON file the plan is written to.
+
+        Returns:
+            dict: The plan with the operations per host and user.
+        """
+        start = time.monotonic()
+        teams = self._teams()
+        try:
+            roster = list(self._iter_users(teams=teams))
+        except RosterError as e:
+            logger.error(e)
+            exit(1)
+        retired = retired_users(save_path=self.save_path)
+        roster = [u for u in roster if u not in retired]
+
+        hosts = self.config.get("hosts")
+        inventories = read_inventories(hosts=hosts)
+        lost = [ip for ip, inventory in inventories.items() if "error" in inventory]
+        if lost:
+            logger.error(f"Cannot plan without the inventory of the hosts {lost}")
+            exit(1)
+
+        plan = {"hosts": {str(h.get("ip")): {} for h in hosts}, "generate": []}
+        positions = {}
+        for idx, name in enumerate(roster):
+            positions[name] = idx
+            if not os.path.isfile(f"{self.save_path}/data/{name}/README.md"):
+                # The host _create_openvpn_data assigns to the user.
+                ip = str(hosts[idx % len(hosts)].get("ip"))
+                user = Participant(user=name, save_path=self.save_path)
+                plan["generate"].append(name)
+                plan["hosts"][ip][name] = [{"op": "generate"}] + self._plan_user(
+                    user=user, inventory=None
+                )
+                continue
+            user = Participant(user=name, save_path=self.save_path)
+            if str(user.ip) not in plan["hosts"]:
+                logger.warning(f"Host {user.ip} of {name} is not configured, skip.")
+                continue
+            ops = self._plan_user(user=user, inventory=inventories[str(user.ip)])
+            if ops:
+                plan["hosts"][str(user.ip)][name] = ops
+
+        desired = set(roster)
+        for user in deployed_participants(save_path=self.save_path):
+            inventory = inventories.get(str(user.ip))
+            if user.name in desired or inventory is None:
+                continue
+            prefix = user_prefix(user=user.name)
+            if f"{prefix}network" in inventory["networks"] or any(
+                c["user"] == user.name or name.startswith(prefix)
+                for name, c in inventory["containers"].items()
+            ):
+                plan["hosts"][str(user.ip)][user.name] = [{"op": "remove_user"}]
+
+        summary = summarize(plan=plan, workers=self.workers)
+        self._log_plan(plan=plan, summary=summary)
+        logger.info(f"Planned in {time.monotonic() - start:.1f}s")
+        if output:
+            with open(output, "w") as file:
+                json.dump({"plan": plan, "summary": summary}, file, indent=2)
+        if dry_run:
+            return plan
+
+        self._execute_plan(
+            plan=plan,
+            positions=positions,
+            teams=teams,
+            summary=summary,
+            inventories=inventories,
+        )
+        Roster(save_path=self.save_path).save(users=roster)
+        self.journal.close()
+        return plan
+
+    def _plan_user(self, user: Participant, inventory: dict = None) -> List[dict]:
+        """
+        Returns the operations that bring a user to the desired state, following the
+        rules of _check_running: an incomplete user loses its challenge containers, and
+        with --recreate its OpenVPN server, Kali container and network as well. A user
+        without inventory, because its data is generated first, gets everything created.
+        """
+        prefix = user_prefix(user=user.name)
+        lazy = self._is_lazy(user=user)
+        names = self._user_containers(lazy=lazy)
+        shared = {
+            c["name"]: c for c in self.config.get("containers") if c.get("shared")
+        }
+        existing = []
+        network = data = firewall = False
+        if inventory is not None:
+            containers = inventory["containers"]
+            network = f"{prefix}network" in inventory["networks"]
+            data = user.name in inventory["data"]
+            firewall = firewall_present(
+                inventory=inventory,
+                openvpn_port=user.existing_openvpn_port,
+                subnet=user.subnet,
+            )
+            for name in names:
+                if name in shared:
+                    replica = containers.get(shared_replica(user.name, shared[name]))
+                    if replica and f"{prefix}network" in replica["networks"]:
+                        existing.append(name)
+                elif name == "openvpn" and user.gateway:
+                    if "gateway_openvpn" in containers and network:
+                        existing.append(name)
+                elif f"{prefix}{name}" in containers:
+                    existing.append(name)
+
+        if user.gateway or self.gateway:
+            # Served by the gateway of the host, deployed the usual way.
+            return [] if len(existing) == len(names) else [{"op": "deploy"}]
+
+        ops = []
+        if len(existing) != len(names):
+            removable = [
+                c["name"] for c in self.config.get("containers") if not c.get("shared")
+            ]
+            if self.recreate:
+                removable += ["openvpn", "kali"]
+            for name in [n for n in existing if n in removable]:
+                ops.append({"op": "remove", "name": name})
+                existing.remove(name)
+            if self.recreate and network:
+                ops.append({"op": "remove_network"})
+                network = False
+
+        if not network:
+            ops.append({"op": "network"})
+        if not "openvpn" in existing:
+            if not data or self.recreate:
+                ops.append({"op": "upload"})
+            ops.append({"op": "openvpn"})
+        if not firewall:
+            ops.append({"op": "firewall"})
+        if lazy:
+            return ops
+        for container in self.config.get("containers"):
+            if not container["name"] in existing:
+                op = "attach" if container.get("shared") else "challenge"
+                ops.append({"op": op, "name": container["name"]})
+        if self.kalibox and not "kali" in existing:
+            ops.append({"op": "kali"})
+        return ops
+
+    def _log_plan(self, plan: dict, summary: dict) -> None:
+        for ip, counts in summary["hosts"].items():
+            logger.info(
+                f"Host {ip}: {counts['users']} users, {counts['create']} creates, "
+                f"{counts['remove']} removes, {counts['upload']} uploads, "
+                f"{counts['firewall']} firewall changes, ~{counts['seconds']}s"
+            )
+            for name, ops in sorted(plan["hosts"][ip].items()):
+                steps = [
+                    f"{o['op']} {o['name']}" if "name" in o else o["op"] for o in ops
+                ]
+                logger.info(f"  {name}: {', '.join(steps)}")
         logger.info(
-            f"For the user: {user.name}, an OpenVPN configuration file will be generated!"
+            f"{summary['generate']} users need new OpenVPN data, "
+            f"{sum(c['users'] for c in summary['hosts'].values())} users change, "
+            f"estimated ~{summary['seconds']}s"
         )
-        host: Host = self.hosts[idx % len(self.hosts)]
-        user.ip = host.ip
-        # Get free port
-        in_use = True
-        while in_use:
-            if not (self.openvpn_port + self.challenge_counter) in used_ports:
-                in_use = False
-            else:
-                self.challenge_counter += 1
-        user.existing_openvpn_port = self.openvpn_port + self.challenge_counter
-        used_ports.append(self.openvpn_port + self.challenge_counter)
-        # Get free subnet
-        in_use = True
-        while in_use:
-            if not str(self.next_network) in used_subnets:
-                in_use = False
-            else:
-                self.next_network = ip_network(
-                    (
-                        int(self.next_network.network_address)
-                        + self.next_network.num_addresses
+
+    def _execute_plan(
+        self,
+        plan: dict,
+        positions: Dict[str, int],
+        teams: Dict[str, List[str]],
+        summary: dict,
+        inventories: Dict[str, dict],
+    ) -> None:
+        """
+        Runs a plan of apply. Only the hosts with operations are connected, all hosts if
+        new users are spread over them. The hosts were checked and listed by the inventory
+        of the plan, so only their Docker clients are opened.
+        """
+        start = time.monotonic()
+        hosts = [
+            h
+            for h in self.config.get("hosts")
+            if plan["generate"] or plan["hosts"][str(h.get("ip"))]
+        ]
+        if not hosts:
+            logger.info("All users are up to date, nothing to do.")
+            return
+        with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+            self.hosts = list(
+                executor.map(
+                    lambda host: Host(
+                        host=host,
+                        save_path=self.save_path,
+                        inventory=inventories[str(host.get("ip"))],
                     ),
-                    strict=False,
+                    hosts,
                 )
-                self.next_network = self.next_network.supernet(new_prefix=24)
-        user.subnet = self.next_network
-        used_subnets.append(str(self.next_network))
+            )
 
-        logger.debug(f"Deploy on host: {host.ip}")
+        if plan["generate"]:
+            used_ports, used_subnets = self._used_allocations()
+            generated = 0
+            for name in plan["generate"]:
+                user_path = f"{self.save_path}/data/{name}"
+                if os.path.exists(user_path):
+                    logger.warning(f"Remove incomplete data of {name}.")
+                    shutil.rmtree(user_path)
+                user = Participant(user=name, save_path=self.save_path)
+                self._create_openvpn_data(
+                    positions[name], user, used_ports, used_subnets
+                )
+                self.journal.record(user=user.name, step=DATA_GENERATED)
+                generated += 1
+            logger.info(f"Generated the OpenVPN data of {generated} users")
+
+        if any(c.get("shared") for c in self.config.get("containers")):
+            self._start_shared()
+
+        def run_host(host: Host) -> List[str]:
+            users = plan["hosts"].get(str(host.ip), {})
+            removed = [
+                Participant(user=n, save_path=self.save_path)
+                for n, ops in users.items()
+                if ops == [{"op": "remove_user"}]
+            ]
+            if removed:
+                LeaseCollector(hosts=[host], save_path=self.save_path).remove_from_host(
+                    host=host, users=removed
+                )
+            deploy = {
+                n: ops for n, ops in users.items() if ops != [{"op": "remove_user"}]
+            }
+            failed = []
+            firewall = []
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = {
+                    name: executor.submit(
+                        self._run_plan_user,
+                        Participant(user=name, save_path=self.save_path),
+                        host,
+                        ops,
+                        teams,
+                    )
+                    for name, ops in deploy.items()
+                }
+                for name, future in futures.items():
+                    try:
+                        if future.result():
+                            firewall.append(name)
+                    except Exception as e:
+                        failed.append(name)
+                        logger.error(f"Plan of {name} on host {host.ip} failed: {e}")
+
+            commands = []
+            for name in firewall:
+                user = Participant(user=name, save_path=self.save_path)
+                commands += host.firewall_commands(
+                    openvpn_port=user.existing_openvpn_port, subnet=user.subnet
+                )
+            for index in range(0, len(commands), SSH_BATCH):
+                host._execute_ssh_command(
+                    "; ".join(commands[index : index + SSH_BATCH])
+                )
+            if commands:
+                host._execute_ssh_command(SAVE_FIREWALL)
+                for name in firewall:
+                    self.journal.record(user=name, step=FIREWALL)
+            return failed
 
-        self._start_local_openvpn()
-        self._openvpn_config(user=user)
-        self._modify_ovpn_client(user=user)
-        self._stop_local_openvpn()
-        user.write_readme()
+        with ThreadPoolExecutor(max_workers=len(self.hosts)) as executor:
+            failed = sum(executor.map(run_host, self.hosts), [])
 
-    def _start_kalibox(self, user: str, host: Host, subnet: IPv4Network | IPv6Network):
-        logger.info(f"Start kalibox on {str(subnet.network_address + 3)}")
-        host.start_kali(
-            user=user,
-            subnet=subnet,
-            index=3,
-            command=[self.config.get("secret"), "kali"],
+        self._report_admission()
+        self._fill_pools()
+        logger.info(
+            f"Plan executed in {time.monotonic() - start:.1f}s, "
+            f"estimated ~{summary['seconds']}s"
         )
+        if failed:
+            logger.error(f"Plan failed for {len(failed)} users: {failed}")
 
+    def _run_plan_user(
+        self,
+        user: Participant,
+        host: Host,
+        ops: List[dict],
+        teams: Dict[str, List[str]],
+    ) -> bool:
+        """
+        Runs the operations of a user, in the order of the plan.
 
-@click.command()
-@click.option(
-    "--config",
-    required=True,
-    help="The path to the .yaml configuration file for the CTF-Creator.",
-    type=click.File("r", encoding="utf8"),
-)
-@click.option(
-    "--save",
-    required=True,
-    help="The path where you want to save the user data for the CTF-Creator. E.g. /home/debian/ctf-creator",
-    type=click.Path(writable=True),
-)
-@click.option(
+        Returns:
+            bool: True if the firewall rules of the user are still missing.
+        """
+        if self._prepare_user(user=user, teams=teams) is None:
+            return False
+        kinds = [o["op"] for o in ops]
+        if "deploy" in kinds:
+            logger.info(self.deploy_challenge(user, host))
+            return False
+
+        prefix = user_prefix(user=user.name)
+        lazy = self._is_lazy(user=user)
+        self.journal.reset(user=user.name)
+        for op in ops:
+            if op["op"] == "remove":
+                host.docker.call(
+                    host.docker.client.api.remove_container,
+                    f"{prefix}{op['name']}",
+                    force=True,
+                )
+            elif op["op"] == "remove_network":
+                host.network_remove(user=user.name)
+            elif op["op"] == "network":
+                host.create_network(user=user.name, subnet=user.subnet)
+            elif op["op"] == "upload":
+                if not os.path.exists(f"{user.save_path}/data/{user.name}/server"):
+                    self._write_openvpn_server_files(user=user)
+                host.send_and_extract_tar(user=user.name)
+            elif op["op"] == "openvpn":
+                host.start_openvpn(
+                    user=user.name,
+                    openvpn_port=user.existing_openvpn_port,
+                    subnet=user.subnet,
+                    firewall=False,
+                )
+
+        created = [
+            o.get("name", "kali")
+            for o in ops
+            if o["op"] in ("challenge", "attach", "kali")
+        ]
+        if not lazy and created:
+            running = [n for n in self._user_containers() if n not in created]
+            self._start_challenges(
+                user=user, host=host, running=running, kali=self.kalibox
+            )
+        for step in self._user_steps(lazy=lazy) - {FIREWALL}:
+            self.journal.record(user=user.name, step=step)
+        if "firewall" not in kinds:
+            self.journal.record(user=user.name, step=FIREWALL)
+        logger.info(f"Applied {len(ops)} operations for {user.name} on {host.ip}")
+        return "firewall" in kinds
+
+    def rebalance(
+        self, drain: List[str] = None, max_moves: int = None, dry_run: bool = False
+    ) -> Dict[str, float]:
+        """
+        Moves users between hosts, so they are spread evenly or leave drained hosts.
+
+        All profiles of the moved users are rewritten in one pass first, the previous data
+        is kept in <save>/rebalance. Then the users are deployed on their new hosts in
+        parallel, and only afterwards removed from their old hosts. A user whose deployment
+        fails gets its previous data back and stays on its old host. Users of a running host
+        keep their environment until they reconnect with the new profile, users of a lost
+        host are without it until the move is done.
+
+        Args:
+            drain (List[str], optional): Hosts that are emptied completely.
+            max_moves (int, optional): Upper limit of moved users.
+            dry_run (bool, optional): Only logs the moves.
+
+        Returns:
+            Dict[str, float]: The seconds until each moved user was ready on its new host.
+        """
+        users = deployed_participants(save_path=self.save_path)
+        moves = plan_moves(
+            users=users,
+            hosts=[str(h.get("ip")) for h in self.config.get("hosts")],
+            drain=drain,
+            max_moves=max_moves,
+        )
+        for user, target in moves:
+            logger.info(f"Move {user.name} from {user.ip} to {target}")
+        logger.info(f"{len(moves)} of {len(users)} users move")
+        if dry_run or not moves:
+            return {}
+
+        targets = {target for _, target in moves}
+        sources = {str(user.ip) for user, _ in moves}
+        self.hosts = []
+        for host in self.config.get("hosts"):
+            ip = str(host.get("ip"))
+            if ip not in targets | sources:
+                continue
+            try:
+                self.hosts.append(Host(host=host, save_path=self.save_path))
+            except Exception as e:
+                if ip in targets:
+                    raise
+                logger.warning(f"Host {ip} is lost, its users stay on it: {e}")
+        hosts = {str(h.ip): h for h in self.hosts}
+
+        # Keeps the old client of gateway users for the removal from the old host.
+        previous = {
+            user.name: Participant(user=user.name, save_path=self.save_path)
+            for user, _ in moves
+        }
+        teams = self._teams()
+        backup = f"{self.save_path}/rebalance"
+        for user, target in moves:
+            shutil.rmtree(f"{backup}/{user.name}", ignore_errors=True)
+            shutil.copytree(
+                f"{self.save_path}/data/{user.name}", f"{backup}/{user.name}"
+            )
+            user.ip = hosts[target].ip
+            if user.gateway:
+                self._create_gateway_profile(user=user)
+            else:
+                self._modify_ovpn_client(user=user)
+            if user.name in teams:
+                self._move_member_profiles(team=user, members=teams[user.name])
+
+        def move(user: Participant, target: str) -> float:
+            start = time.monotonic()
+            self.deploy_challenge(user, hosts[target])
+            return time.monotonic() - start
+
+        ready = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {
+                executor.submit(move, user, target): user for user, target in moves
+            }
+            for future, user in futures.items():
+                try:
+                    ready[user.name] = round(future.result(), 1)
+                except Exception as e:
+                    logger.error(f"Move of {user.name} failed: {e}")
+
+        for user, target in moves:
+            if user.name in ready:
+                shutil.rmtree(f"{backup}/{user.name}")
+                continue
+            logger.warning(f"{user.name} stays on {previous[user.name].ip}")
+            path = f"{self.save_path}/data/{user.name}"
+            shutil.rmtree(path)
+            os.replace(f"{backup}/{user.name}", path)
+            # The steps recorded on the new host do not hold for the old one.
+            self.journal.reset(user=user.name)
+            try:
+                hosts[target].user_remove(user=user.name, gateway=user.gateway)
+            except APIError as e:
+                logger.warning(f"Could not clean up {user.name} on {target}: {e}")
+
+        collector = LeaseCollector(hosts=self.hosts, save_path=self.save_path)
+        for ip in sources:
+            moved = [previous[u.name] for u, _ in moves if u.name in ready]
+            moved = [u for u in moved if str(u.ip) == ip]
+            if ip in hosts and moved:
+                collector.remove_from_host(host=hosts[ip], users=moved)
+        self.journal.close()
+
+        for name, seconds in sorted(ready.items()):
+            logger.info(f"{name}: ready on the new host after {seconds}s")
+        if ready:
+            values = list(ready.values())
+            logger.info(
+                f"Moved {len(ready)} of {len(moves)} users, ready after p50 "
+                f"{percentile(values, 50)}s, p95 {percentile(values, 95)}s, "
+                f"max {max(values)}s"
+            )
+        return ready
+
+    def _move_member_profiles(self, team: Participant, members: List[str]) -> None:
+        """Points the member profiles of a moved team to its new host."""
+        members_path = f"{team.save_path}/data/{team.name}/members"
+        if team.gateway:
+            # Issued again by the gateway CA of the new host.
+            if os.path.exists(members_path):
+                shutil.rmtree(members_path)
+            team.metadata["member_clients"] = []
+            self._ensure_member_profiles(team=team, members=members)
+            return
+        if not os.path.isdir(members_path):
+            return
+        for name in os.listdir(members_path):
+            member = Participant(
+                user=f"{team.name}/members/{name}", save_path=team.save_path
+            )
+            member.ip = team.ip
+            self._modify_ovpn_client(user=member)
+
+    def _report_openvpn_memory(self, users: List[Participant]) -> None:
+        """
+        Logs the memory the OpenVPN servers use per user on each host and stores it in
+        <save>/memory_report.json. Once a host was measured with and without --gateway,
+        the memory per user of both modes is compared.
+        """
+        path = f"{self.save_path}/memory_report.json"
+        reports = {}
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                reports = json.load(file)
+        for host in self.hosts:
+            amount = len([u for u in users if str(u.ip) == str(host.ip)])
+            if amount == 0:
+                continue
+            memory = host.openvpn_memory() / (1024 * 1024)
+            mode = "gateway" if host.gateway_exists() else "per-user"
+            logger.info(
+                f"OpenVPN memory on host {host.ip} ({mode}): {memory:.1f} MiB total, "
+                f"{memory / amount:.2f} MiB per user for {amount} users"
+            )
+            report = reports.setdefault(str(host.ip), {})
+            report[mode] = {
+                "time": time.time(),
+                "users": amount,
+                "total_mib": round(memory, 1),
+                "per_user_mib": round(memory / amount, 3),
+            }
+            other = report.get("per-user" if mode == "gateway" else "gateway")
+            if other and report[mode]["per_user_mib"]:
+                logger.info(
+                    f"OpenVPN memory per user on host {host.ip}: "
+                    f"{report['per-user']['per_user_mib']:.2f} MiB per-user "
+                    f"({report['per-user']['users']} users), "
+                    f"{report['gateway']['per_user_mib']:.2f} MiB gateway "
+                    f"({report['gateway']['users']} users), the gateway needs "
+                    f"{report['gateway']['per_user_mib'] / report['per-user']['per_user_mib']:.1%} of the per-user memory"
+                )
+        with open(f"{path}.part", "w") as file:
+            json.dump(reports, file, indent=2)
+        os.replace(f"{path}.part", path)
+
+    def _start_shared(self) -> None:
+        """Starts the instances of the shared challenges on every host."""
+        for container in self.config.get("containers"):
+            if not container.get("shared"):
+                continue
+            for host in self.hosts:
+                host.start_shared(
+                    container=container,
+                    environment={
+                        "SECRET": self.config.get("secret"),
+                        "CHALLENGE": container["name"],
+                    },
+                )
+
+    def _challenge_exists(self, host: Host, user: str, container: str) -> bool:
+        """True if the challenge container of the user exists or, for a shared
+        challenge, the shared instance is connected to the network of the user."""
+        shared = [
+            c
+            for c in self.config.get("containers")
+            if c["name"] == container and c.get("shared")
+        ]
+        if shared:
+            return host.shared_attached(user=user, container=shared[0])
+        return host.container_exists(user=user, container=container)
+
+    def _report_shared(self) -> None:
+        """
+        Logs the containers and memory the shared challenges save on each host compared
+        with one container per user.
+        """
+        for container in self.config.get("containers"):
+            if not container.get("shared"):
+                continue
+            for host in self.hosts:
+                replicas = [
+                    f"shared_{container['name']}_{i}"
+                    for i in range(container["shared"])
+                ]
+                amount = 0
+                memory = 0
+                for name in replicas:
+                    try:
+                        attrs = host.docker.call(
+                            host.docker.client.api.inspect_container, name
+                        )
+                    except NotFound:
+                        logger.warning(
+                            f"Shared instance {name} on host {host.ip} is missing"
+                        )
+                        continue
+                    amount += len(attrs["NetworkSettings"]["Networks"])
+                    memory += host.docker.container_memory(container_name=name)
+                if amount == 0:
+                    continue
+                saved = max(amount - len(replicas), 0)
+                logger.info(
+                    f"Shared {container['name']} on host {host.ip}: {len(replicas)} "
+                    f"instances serve {amount} users, {saved} containers and "
+                    f"~{saved * memory / len(replicas) / (1024 * 1024):.0f} MiB saved"
+                )
+
+    def _fill_pools(self) -> None:
+        """
+        Refills the warm pools after the deployment, so users registering later only have
+        to claim a pre-created container instead of waiting for a full container run.
+        """
+        for container in self.config.get("containers"):
+            if not container.get("pool") or container.get("shared"):
+                continue
+            for host in self.hosts:
+                host.fill_pool(container=container, size=container["pool"])
+
+    def deploy_challenge(
+        self, user: Participant, host: Host, uploaded: bool = False
+    ) -> str:
+
+        logger.info("\u2500" * 120)
+        logger.info(f"Create Challenge for {user.name}")
+        lazy = self._is_lazy(user=user)
+
+        if self.resume:
+            done = self.journal.completed(user=user.name)
+            if self._user_steps(lazy=lazy) <= done:
+                logger.info(f"All steps of {user.name} are in the journal, skip.")
+                return f"Done for User: {user.name}"
+            names = self._user_containers(lazy=lazy)
+            running = [n for n in names if self._step(n) in done]
+            for name in names:
+                if name not in running and host.container_exists(
+                    user=user.name, container=name
+                ):
+                    # Created before the crash, but not recorded as completed.
+                    host.container_remove(user=user.name, container=name)
+        else:
+            done = set()
+            self.journal.reset(user=user.name)
+            running = self._check_running(
+                user=user.name, host=host, gateway=user.gateway, lazy=lazy
+            )
+            for name in running:
+                self.journal.record(user=user.name, step=self._step(name))
+            if "openvpn" in running:
+                self.journal.record(user=user.name, step=FIREWALL)
+
+        if not NETWORK in done:
+            if not host.network_exists(user=user.name):
+                host.create_network(user=user.name, subnet=user.subnet)
+            self.journal.record(user=user.name, step=NETWORK)
+
+        if not "openvpn" in running and user.gateway:
+            host.send_gateway_data()
+            self.journal.record(user=user.name, step=DATA_UPLOADED)
+            host.start_gateway(
+                user=user.name,
+                openvpn_port=user.existing_openvpn_port,
+                subnet=user.subnet,
+            )
+            self.journal.record(user=user.name, step=OPENVPN)
+            self.journal.record(user=user.name, step=FIREWALL)
+        elif not "openvpn" in running:
+            if not DATA_UPLOADED in done:
+                if not uploaded:
+                    if not os.path.exists(f"{user.save_path}/data/{user.name}/server"):
+                        self._write_openvpn_server_files(user=user)
+                    host.send_and_extract_tar(user=user.name)
+                self.journal.record(user=user.name, step=DATA_UPLOADED)
+            host.start_openvpn(
+                user=user.name,
+                openvpn_port=user.existing_openvpn_port,
+                subnet=user.subnet,
+                firewall=False,
+            )
+            self.journal.record(user=user.name, step=OPENVPN)
+
+        if not self.journal.done(user=user.name, step=FIREWALL):
+            host.apply_firewall(
+                openvpn_port=user.existing_openvpn_port, subnet=user.subnet
+            )
+            self.journal.record(user=user.name, step=FIREWALL)
+
+        if lazy:
+            logger.info(f"Challenges of {user.name} are created on the first connect.")
+        else:
+            self._start_challenges(
+                user=user, host=host, running=running, kali=self.kalibox
+            )
+
+        logger.info("\u2500" * 120)
+
+        return f"Done for User: {user.name}"
+
+    def _start_challenges(
+        self,
+        user: Participant,
+        host: Host,
+        running: List[str],
+        kali: bool,
+        used_ip: List[int] = None,
+    ) -> None:
+        """Starts the challenge containers and the Kali container that are not running."""
+        used_ip = used_ip or []
+        for container in self.config.get("containers"):
+            if not container["name"] in running:
+                random_ip = self._random_index(used_ip=used_ip)
+                environment = self._challenge_environment(
+                    user=user, container=container
+                )
+                if container.get("shared"):
+                    host.attach_shared(
+                        user=user.name,
+                        container=container,
+                        subnet=user.subnet,
+                        index=random_ip,
+                        flag=environment["FLAG"],
+                    )
+                    self.journal.record(
+                        user=user.name, step=container_step(container["name"])
+                    )
+                    continue
+                if container.get("pool") and host.claim_pool_container(
+                    user=user.name,
+                    container=container,
+                    subnet=user.subnet,
+                    index=random_ip,
+                    environment=environment,
+                ):
+                    self.journal.record(
+                        user=user.name, step=container_step(container["name"])
+                    )
+                    continue
+                host.start_container(
+                    user=user.name,
+                    container=container,
+                    subnet=user.subnet,
+                    index=random_ip,
+                    environment=environment,
+                )
+                self.journal.record(
+                    user=user.name, step=container_step(container["name"])
+                )
+
+        if kali and not "kali" in running:
+            self._start_kalibox(user=user.name, host=host, subnet=user.subnet)
+            self.journal.record(user=user.name, step=KALI)
+
+    def _is_lazy(self, user: Participant) -> bool:
+        """
+        True if the challenges of the user wait for the first VPN connect. Whether a user
+        is lazy is decided once by _prepare_user and kept in its metadata.
+        """
+        if user.metadata.get("materialized_at"):
+            return False
+        return user.metadata.get("lazy", self.lazy)
+
+    def _deployed(self, user: Participant, host: Host) -> bool:
+        """True if all challenges of the user are in the journal or on the host."""
+        containers = self.config.get("containers")
+        done = self.journal.completed(user=user.name)
+        if {container_step(c["name"]) for c in containers} <= done:
+            return True
+        user_filtered = re.sub("[^A-Za-z0-9]+", "", user.name)
+        return all(
+            (
+                host.shared_attached(user=user.name, container=c)
+                if c.get("shared")
+                else f"{user_filtered}_{c['name']}" in host.containers
+            )
+            for c in containers
+        )
+
+    def materialize(
+        self, user: Participant, host: Host, containers: dict, since: float = None
+    ) -> None:
+        """
+        Creates the challenges of a lazy user on the first connect.
+
+        Args:
+            user (Participant): The connected user.
+            host (Host): The host of the user.
+            containers (dict): The containers of the host from the Docker API, by name.
+            since (float, optional): The time the VPN client connected.
+        """
+        if not user.metadata.get("lazy") or user.metadata.get("materialized_at"):
+            return
+        user_filtered = re.sub("[^A-Za-z0-9]+", "", user.name)
+        network = f"{user_filtered}_network"
+        running = []
+        used_ip = []
+        for name in [c["name"] for c in self.config.get("containers")] + ["kali"]:
+            container = containers.get(f"{user_filtered}_{name}")
+            if container is None:
+                continue
+            running.append(name)
+            address = container["NetworkSettings"]["Networks"].get(network, {})
+            if address.get("IPAddress"):
+                used_ip.append(int(address["IPAddress"].split(".")[-1]))
+
+        self._start_challenges(
+            user=user,
+            host=host,
+            running=running,
+            kali=user.metadata.get("kali", False),
+            used_ip=used_ip,
+        )
+        ready = time.time()
+        user.metadata["materialized_at"] = ready
+        user.metadata["ready_seconds"] = round(ready - since, 2) if since else None
+        user.write_metadata()
+        if since and ready - since > self.ready_target:
+            logger.warning(
+                f"Challenges of {user.name} ready after {ready - since:.1f}s, "
+                f"above the target of {self.ready_target}s"
+            )
+        else:
+            logger.info(f"Challenges of {user.name} are ready")
+
+    def _user_containers(self, lazy: bool = False) -> List[str]:
+        if lazy:
+            return ["openvpn"]
+        names = ["openvpn"] + [c["name"] for c in self.config.get("containers")]
+        if self.kalibox:
+            names.append("kali")
+        return names
+
+    def _step(self, name: str) -> str:
+        """Returns the journal step of a container of a user."""
+        if name == "openvpn":
+            return OPENVPN
+        if name == "kali":
+            return KALI
+        return container_step(name)
+
+    def _user_steps(self, lazy: bool = False) -> set:
+        """Returns the journal steps of a completely deployed user."""
+        return {NETWORK, FIREWALL} | {
+            self._step(n) for n in self._user_containers(lazy=lazy)
+        }
+
+    def _random_index(self, used_ip: list) -> int:
+        used = True
+        while used:
+            random_ip = random.randint(4, 254)
+            if not random_ip in used_ip:
+                used_ip.append(random_ip)
+                used = False
+        logger.debug(f"Randomized port {random_ip}")
+        return random_ip
+
+    def _challenge_environment(self, user: Participant, container: dict) -> dict:
+        return challenge_environment(
+            user=user.name,
+            secret=self.config.get("secret"),
+            container=container["name"],
+            epoch=self.epoch,
+        )
+
+    def _agent_steps(self, user: Participant, host: Host) -> tuple:
+        """
+        Builds the agent steps of a user from the container and network lists the host
+        fetched once at start up, so no further remote call is needed.
+
+        Returns:
+            tuple: The steps, the files to upload and the firewall commands of the user.
+        """
+        user_filtered = re.sub("[^A-Za-z0-9]+", "", user.name)
+        remote_base = f"/home/{host.username}/ctf-data/{user.name}"
+        local_dir = f"{user.save_path}/data/{user.name}"
+
+        lazy = self._is_lazy(user=user)
+        names = self._user_containers(lazy=lazy)
+        existing = [
+            n
+            for n in names
+            if self._challenge_exists(host=host, user=user.name, container=n)
+        ]
+        network = host.network_exists(user=user.name)
+
+        steps = []
+        uploads = []
+        firewall = []
+        if self.resume:
+            done = self.journal.completed(user=user.name)
+            recorded = [n for n in names if self._step(n) in done]
+            for name in [n for n in existing if n not in recorded]:
+                # Created before the crash, but not recorded as completed.
+                steps.append({"op": "remove", "name": f"{user_filtered}_{name}"})
+            existing = recorded
+        elif len(existing) != len(names):
+            removable = [
+                c["name"] for c in self.config.get("containers") if not c.get("shared")
+            ]
+            if self.recreate:
+                removable += ["openvpn", "kali"]
+            for name in [n for n in existing if n in removable]:
+                steps.append({"op": "remove", "name": f"{user_filtered}_{name}"})
+                existing.remove(name)
+            if self.recreate and network:
+                steps.append(
+                    {
+                        "op": "shell",
+                        "command": f"docker network rm {user_filtered}_network",
+                    }
+                )
+                network = False
+
+        if not self.resume:
+            done = set()
+            self.journal.reset(user=user.name)
+            for name in existing:
+                self.journal.record(user=user.name, step=self._step(name))
+            if "openvpn" in existing:
+                self.journal.record(user=user.name, step=FIREWALL)
+        if network and not NETWORK in done:
+            self.journal.record(user=user.name, step=NETWORK)
+
+        if not network and not NETWORK in done:
+            steps.append(
+                {
+                    "op": "network",
+                    "name": f"{user_filtered}_network",
+                    "subnet": str(user.subnet),
+                    "gateway": str(user.subnet.network_address + 1),
+                }
+            )
+
+        if not "openvpn" in existing:
+            if not DATA_UPLOADED in done:
+                if not os.path.exists(f"{local_dir}/server"):
+                    self._write_openvpn_server_files(user=user)
+                uploads.append(
+                    (
+                        f"{local_dir}/dockovpn_data.tar",
+                        f"{remote_base}/dock_vpn_data.tar",
+                    )
+                )
+                for file_name in os.listdir(f"{local_dir}/server"):
+                    uploads.append(
+                        (
+                            f"{local_dir}/server/{file_name}",
+                            f"{remote_base}/server/{file_name}",
+                        )
+                    )
+                steps.append(
+                    {
+                        "op": "extract",
+                        "archive": f"{remote_base}/dock_vpn_data.tar",
+                        "target": f"{remote_base}/Dockovpn_data",
+                    }
+                )
+            steps.append(
+                {
+                    "op": "container",
+                    "spec": host.openvpn_spec(
+                        user=user.name,
+                        openvpn_port=user.existing_openvpn_port,
+                        subnet=user.subnet,
+                    ),
+                }
+            )
+
+        if not self.journal.done(user=user.name, step=FIREWALL):
+            firewall += host.firewall_commands(
+                openvpn_port=user.existing_openvpn_port, subnet=user.subnet
+            )
+
+        if lazy:
+            return steps, uploads, firewall
+
+        used_ip = []
+        for container in self.config.get("containers"):
+            if container["name"] in existing:
+                continue
+            if container.get("shared"):
+                spec = host.shared_spec(
+                    user=user.name,
+                    container=container,
+                    subnet=user.subnet,
+                    index=self._random_index(used_ip=used_ip),
+                    flag=self._challenge_environment(user=user, container=container)[
+                        "FLAG"
+                    ],
+                )
+                steps.append({"op": "attach", "spec": spec})
+                continue
+            spec = host.container_spec(
+                user=user.name,
+                container=container,
+                subnet=user.subnet,
+                index=self._random_index(used_ip=used_ip),
+                environment=self._challenge_environment(user=user, container=container),
+            )
+            step = {"op": "container", "spec": spec}
+            if container.get("pool"):
+                pool = host.take_pool_container(container=container)
+                if pool:
+                    step["pool"] = pool
+            steps.append(step)
+
+        if self.kalibox and not "kali" in existing:
+            spec = host.kali_spec(
+                user=user.name,
+                subnet=user.subnet,
+                index=3,
+                command=[self.config.get("secret"), "kali"],
+            )
+            steps.append({"op": "container", "spec": spec})
+
+        return steps, uploads, firewall
+
+    def _deploy_with_agent(self, users_by_host: dict) -> None:
+        """
+        Deploys the users of every host with one agent run per host. The hosts run in
+        parallel, the agent applies the users of its host in parallel as well.
+        """
+
+        def deploy(host: Host, users: List[Participant]) -> None:
+            start = time.monotonic()
+            plan = {"workers": self.agent_workers, "users": [], "finally": []}
+            uploads = []
+            for user in users:
+                steps, user_uploads, firewall = self._agent_steps(user=user, host=host)
+                if steps or firewall:
+                    plan["users"].append(
+                        {"user": user.name, "steps": steps, "firewall": firewall}
+                    )
+                uploads += user_uploads
+            if not plan["users"]:
+                logger.info(f"All steps on {host.ip} are in the journal, skip.")
+                return
+            if any(u["firewall"] for u in plan["users"]):
+                plan["finally"].append(SAVE_FIREWALL)
+
+            failed = 0
+            firewall_users = []
+            saved = False
+            for result in host.run_agent(plan=plan, uploads=uploads):
+                if result["ok"]:
+                    logger.info(
+                        f"{host.ip} {result['user']}: {result['op']} {result['name']} done"
+                    )
+                    if result["op"] == "firewall":
+                        firewall_users.append(result["user"])
+                    elif result["user"] is None:
+                        saved = True
+                    step = self._agent_result_step(result=result)
+                    if step:
+                        self.journal.record(user=result["user"], step=step)
+                else:
+                    failed += 1
+                    logger.error(
+                        f"{host.ip} {result['user']}: {result['op']} failed: {result['error']}"
+                    )
+            if saved:
+                # Only applied for users whose steps all succeeded.
+                for name in firewall_users:
+                    self.journal.record(user=name, step=FIREWALL)
+            logger.info(
+                f"Agent on {host.ip} finished {len(users)} users in "
+                f"{time.monotonic() - start:.1f}s with {failed} failed steps"
+            )
+
+        with ThreadPoolExecutor(max_workers=len(users_by_host)) as executor:
+            futures = [
+                executor.submit(deploy, host, users)
+                for host, users in users_by_host.items()
+            ]
+            for future in futures:
+                future.result()
+
+    def _agent_result_step(self, result: dict) -> str:
+        """Returns the journal step of a successful agent result, if it completes one."""
+        if result["op"] == "network":
+            return NETWORK
+        if result["op"] == "extract":
+            return DATA_UPLOADED
+        if result["op"] in ("container", "attach"):
+            user_filtered = re.sub("[^A-Za-z0-9]+", "", result["user"])
+            return self._step(result["name"][len(user_filtered) + 1 :])
+        return None
+
+    def _create_openvpn_data(
+        self, idx: int, user: Participant, used_ports: list, used_subnets: list
+    ):
+        logger.info(
+            f"For the user: {user.name}, an OpenVPN configuration file will be generated!"
+        )
+        host: Host = self.hosts[idx % len(self.hosts)]
+        user.ip = host.ip
+        if self.gateway:
+            # All users of a host share the gateway port
+            user.existing_openvpn_port = self.openvpn_port
+        else:
+            # Get free port
+            in_use = True
+            while in_use:
+                if not (self.openvpn_port + self.challenge_counter) in used_ports:
+                    in_use = False
+                else:
+                    self.challenge_counter += 1
+            user.existing_openvpn_port = self.openvpn_port + self.challenge_counter
+            used_ports.append(self.openvpn_port + self.challenge_counter)
+        # Get free subnet
+        in_use = True
+        while in_use:
+            if not str(self.next_network) in used_subnets:
+                in_use = False
+            else:
+                self.next_network = ip_network(
+                    (
+                        int(self.next_network.network_address)
+                        + self.next_network.num_addresses
+                    ),
+                    strict=False,
+                )
+                self.next_network = self.next_network.supernet(new_prefix=24)
+        user.subnet = self.next_network
+        used_subnets.append(str(self.next_network))
+
+        logger.debug(f"Deploy on host: {host.ip}")
+
+        if self.gateway:
+            self._create_gateway_profile(user=user)
+        else:
+            self._start_local_openvpn()
+            self._openvpn_config(user=user)
+            self._modify_ovpn_client(user=user)
+            self._stop_local_openvpn()
+            self._write_openvpn_server_files(user=user)
+        user.write_readme()
+
+    def _create_gateway_profile(self, user: Participant) -> None:
+        """
+        Issues a client configuration for the user, signed by the gateway CA of the user's
+        host, and adds the user to the client-config-dir and firewall of the gateway.
+        """
+        gateway_path = f"{self.save_path}/gateway/{user.ip}"
+        archive_path = f"{gateway_path}/dockovpn_data.tar"
+        clients_path = f"{gateway_path}/clients.json"
+
+        self._start_local_openvpn(
+            data_path=archive_path if os.path.exists(archive_path) else None
+        )
+        client_id = self._openvpn_config(user=user, archive_path=archive_path)
+        self._modify_ovpn_client(user=user)
+        self._stop_local_openvpn()
+
+        if client_id is None:
+            logger.error(f"Error: No new OpenVPN client found for {user.name}.")
+            raise OpenVPNError(f"No new OpenVPN client found for {user.name}")
+
+        clients = {}
+        if os.path.exists(clients_path):
+            with open(clients_path, "r") as file:
+                clients = json.load(file)
+        clients[client_id] = {
+            "user": user.name,
+            "tunnel_ip": next_tunnel_ip(clients),
+            "subnet": str(user.subnet),
+        }
+        with open(clients_path, "w") as file:
+            json.dump(clients, file, indent=2)
+
+        if self.openvpn_templates is None:
+            self.openvpn_templates = fetch_templates(client=self.local_docker)
+        write_gateway_files(
+            templates=self.openvpn_templates, clients=clients, path=gateway_path
+        )
+
+        user.metadata.update(
+            {
+                "mode": "gateway",
+                "client_id": client_id,
+                "tunnel_ip": clients[client_id]["tunnel_ip"],
+            }
+        )
+        user.write_metadata()
+        logger.info(f"Gateway profile {client_id} issued for {user.name}")
+
+    def _ensure_member_profiles(self, team: Participant, members: List[str]) -> None:
+        """
+        Issues a client configuration to every member of a team that has none yet. The
+        profiles are signed by the CA of the team's OpenVPN server, or of the gateway, so
+        a running server accepts new members without a restart.
+
+        Args:
+            team (Participant): The team, deployed like a single user.
+            members (List[str]): The members of the team.
+        """
+        members_path = f"{team.save_path}/data/{team.name}/members"
+        missing = [
+            m for m in members if not os.path.isfile(f"{members_path}/{m}/client.ovpn")
+        ]
+        existing = (
+            set(os.listdir(members_path)) if os.path.isdir(members_path) else set()
+        )
+        for member in sorted(existing - set(members)):
+            # The OpenVPN server of a team has no revocation list.
+            logger.warning(
+                f"{member} is no longer a member of {team.name}, the profile stays valid "
+                f"until the team is deployed with new data."
+            )
+        if not missing:
+            return
+
+        participants = []
+        for name in missing:
+            if os.path.exists(f"{members_path}/{name}"):
+                shutil.rmtree(f"{members_path}/{name}")
+            member = Participant(
+                user=f"{team.name}/members/{name}", save_path=team.save_path
+            )
+            member.ip = team.ip
+            member.existing_openvpn_port = team.existing_openvpn_port
+            member.subnet = team.subnet
+            participants.append(member)
+
+        if team.gateway:
+            for member in participants:
+                self._create_gateway_profile(user=member)
+                member.write_readme()
+            team.metadata["member_clients"] = team.metadata.get(
+                "member_clients", []
+            ) + [m.metadata["client_id"] for m in participants]
+        else:
+            archive_path = f"{team.save_path}/data/{team.name}/dockovpn_data.tar"
+            self._start_local_openvpn(data_path=archive_path)
+            for member in participants:
+                self._openvpn_config(user=member, archive_path=archive_path)
+                self._modify_ovpn_client(user=member)
+                member.write_readme()
+            self._stop_local_openvpn()
+
+        team.metadata.update(team=True, members=members)
+        team.write_metadata()
+        logger.info(f"Issued {len(participants)} member profiles for team {team.name}")
+
+    def _migrate_to_gateway(self, user: Participant, host: Host) -> None:
+        """
+        Moves an existing user from its own OpenVPN server to the gateway of its host.
+        The previous profile is kept as client.ovpn.per-user, the subnet stays the same.
+        """
+        logger.info(f"Migrate {user.name} to the OpenVPN gateway of {host.ip}")
+        profile = f"{user.save_path}/data/{user.name}/client.ovpn"
+        os.replace(profile, f"{profile}.per-user")
+        members = f"{user.save_path}/data/{user.name}/members"
+        if os.path.exists(members):
+            # The member profiles are issued again by the gateway CA.
+            shutil.rmtree(members)
+        previous_port = user.existing_openvpn_port
+        user.existing_openvpn_port = self.openvpn_port
+        self._create_gateway_profile(user=user)
+        host.container_remove(user=user.name, container="openvpn")
+        user_filtered = re.sub("[^A-Za-z0-9]+", "", user.name)
+        if f"{user_filtered}_openvpn" in host.containers:
+            host.containers.remove(f"{user_filtered}_openvpn")
+        # The rules of the subnet stay, only the port of the removed server is closed.
+        gateway_rules = host.firewall_rules(
+            openvpn_port=self.openvpn_port, subnet=user.subnet
+        )
+        host.remove_firewall(
+            rules=[
+                rule
+                for rule in host.firewall_rules(
+                    openvpn_port=previous_port, subnet=user.subnet
+                )
+                if rule not in gateway_rules
+            ]
+        )
+
+    def _write_openvpn_server_files(self, user: Participant) -> None:
+        """
+        Renders the server.conf and start.sh of the user OpenVPN server into the user data.
+        They are mounted into the container, so it starts correctly the first time.
+        """
+        if self.openvpn_templates is None:
+            self.openvpn_templates = fetch_templates(client=self.local_docker)
+        write_server_files(
+            templates=self.openvpn_templates,
+            subnet=user.subnet,
+            path=f"{user.save_path}/data/{user.name}/server",
+        )
+        logger.info(f"OpenVPN server configuration rendered for {user.name}")
+
+    def _start_kalibox(self, user: str, host: Host, subnet: IPv4Network | IPv6Network):
+        logger.info(f"Start kalibox on {str(subnet.network_address + 3)}")
+        host.start_kali(
+            user=user,
+            subnet=subnet,
+            index=3,
+            command=[self.config.get("secret"), "kali"],
+        )
+
+
+def deploy_shard(options: dict, host: dict, users: List[str]) -> dict:
+    """
+    Entry point of a worker process of --processes. Connects to its host and deploys the
+    given users, see CTFCreator.deploy_host.
+    """
+    creator = CTFCreator(**options)
+    # The workers append to the same journal, the parent compacts it afterwards.
+    creator.journal.compact = False
+    host_object = Host(host=host, save_path=creator.save_path)
+    creator.hosts = [host_object]
+    return creator.deploy_host(
+        host=host_object,
+        users=[Participant(user=u, save_path=creator.save_path) for u in users],
+    )
+
+
+class LegacyGroup(click.Group):
+    """
+    Runs create if the arguments start with an option, so calls from before the
+    subcommands, e.g. ctf.py --config challenge.yaml --save <save>, keep working.
+    """
+
+    def parse_args(self, ctx: click.Context, args: List[str]) -> List[str]:
+        if (
+            args
+            and args[0].startswith("-")
+            and args[0] not in self.get_help_option_names(ctx)
+        ):
+            logger.warning(
+                "Calling ctf.py without a subcommand is deprecated, use ctf.py create."
+            )
+            args = ["create"] + args
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=LegacyGroup)
+def main():
+    """CTF-Creator: deploys and manages per-user CTF environments."""
+    pass
+
+
+@main.command()
+@click.option(
+    "--config",
+    required=True,
+    help="The path to the .yaml configuration file for the CTF-Creator.",
+    type=click.File("r", encoding="utf8"),
+)
+@click.option(
+    "--save",
+    required=True,
+    help="The path where you want to save the user data for the CTF-Creator. E.g. /home/debian/ctf-creator",
+    type=click.Path(writable=True),
+)
+@click.option(
     "--prune",
     default=False,
     is_flag=True,
-    help="Prunes all running containers on the host machine.",
+    help="Prunes all running containers on the host machine.",
+    show_default=True,
+)
+@click.option(
+    "--kali",
+    default=False,
+    is_flag=True,
+    help="Provides a Kali Docker container for network tracing.",
+    show_default=True,
+)
+@click.option(
+    "--recreate",
+    default=False,
+    is_flag=True,
+    help="Restart OpenVPN Docker container. Restarts Kalibox also if --kali is set to true",
+    show_default=True,
+)
+@click.option(
+    "--gateway",
+    default=False,
+    is_flag=True,
+    help="Serves all users of a host with one shared OpenVPN gateway. Existing users are migrated.",
+    show_default=True,
+)
+@click.option(
+    "--memory-report",
+    default=False,
+    is_flag=True,
+    help="Reports the memory the OpenVPN servers use per user on each host.",
+    show_default=True,
+)
+@click.option(
+    "--agent",
+    default=False,
+    is_flag=True,
+    help="Deploys with an agent on each host that applies all users in one SSH round trip.",
+    show_default=True,
+)
+@click.option(
+    "--agent-workers",
+    default=8,
+    help="Number of users the agent deploys in parallel on each host.",
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--distribute-images",
+    default=False,
+    is_flag=True,
+    help="Exports the required images once on this machine and loads them on all hosts.",
+    show_default=True,
+)
+@click.option(
+    "--registry-mirror",
+    default=None,
+    help="Registry reachable by the hosts, e.g. 10.0.0.1:5000. Used with --distribute-images instead of streaming the images.",
+)
+@click.option(
+    "--incremental",
+    default=False,
+    is_flag=True,
+    help="Only deploys users added and removes users removed since the last run.",
+    show_default=True,
+)
+@click.option(
+    "--resume",
+    default=False,
+    is_flag=True,
+    help="Continues an interrupted run. Steps recorded in the journal are skipped without checking the hosts.",
+    show_default=True,
+)
+@click.option(
+    "--workers",
+    default=1,
+    help="Number of users deployed in parallel. The Docker calls per host are throttled adaptively.",
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--lazy",
+    default=False,
+    is_flag=True,
+    help="Only creates the network and OpenVPN server per user. The challenges are created by monitor on the first connect.",
+    show_default=True,
+)
+@click.option(
+    "--lease-days",
+    default=None,
+    help="Lease of new users in days, after which gc retires them. The expires value of the configuration takes precedence.",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--processes",
+    default=1,
+    help="Number of worker processes. Each host is deployed by a process of its own, with --workers users in parallel.",
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--pipeline",
+    default=False,
+    is_flag=True,
+    help="Generates, uploads and deploys new users in overlapping stages. The deploy stage runs --workers users in parallel.",
+    show_default=True,
+)
+@click.option(
+    "--upload-workers",
+    default=4,
+    help="Number of users uploaded in parallel with --pipeline.",
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--queue-size",
+    default=8,
+    help="Number of users waiting between two stages of --pipeline.",
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+def create(
+    config,
+    save,
+    prune,
+    kali,
+    recreate,
+    gateway,
+    memory_report,
+    agent,
+    agent_workers,
+    distribute_images,
+    registry_mirror,
+    incremental,
+    resume,
+    workers,
+    lazy,
+    lease_days,
+    processes,
+    pipeline,
+    upload_workers,
+    queue_size,
+):
+    """Deploys the challenges for all users of the configuration."""
+    ctfcreator = CTFCreator(
+        config=config.read(),
+        save_path=save,
+        prune=prune,
+        kalibox=kali,
+        recreate=recreate,
+        gateway=gateway,
+        memory_report=memory_report,
+        agent=agent,
+        agent_workers=agent_workers,
+        distribute_images=distribute_images,
+        registry_mirror=registry_mirror,
+        incremental=incremental,
+        resume=resume,
+        workers=workers,
+        lazy=lazy,
+        lease_days=lease_days,
+        processes=processes,
+        pipeline=pipeline,
+        upload_workers=upload_workers,
+        queue_size=queue_size,
+    )
+    try:
+        ctfcreator.create_challenge()
+    except OpenVPNError:
+        exit(1)
+
+
+@main.command()
+@click.option(
+    "--save",
+    required=True,
+    help="The path where the user data of the CTF-Creator is saved.",
+    type=click.Path(exists=True, file_okay=False),
+)
+@click.option(
+    "--output",
+    default=None,
+    help="The folder for the bundles and index.json. Defaults to <save>/bundles.",
+    type=click.Path(file_okay=False, writable=True),
+)
+@click.option(
+    "--format",
+    "compression",
+    default="zst",
+    help="The bundle format, zst uses multi-threaded zstd.",
+    show_default=True,
+    type=click.Choice(["zst", "zip"]),
+)
+@click.option(
+    "--workers",
+    default=None,
+    help="Number of processes packaging bundles. Defaults to the number of CPUs.",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--in-memory",
+    default=False,
+    is_flag=True,
+    help="Builds each bundle in memory and writes it once, zst bundles are streamed to zstd without temporary files.",
+    show_default=True,
+)
+@click.option(
+    "--force",
+    default=False,
+    is_flag=True,
+    help="Packages all users, not only the ones that changed since the last export.",
+    show_default=True,
+)
+def export(save, output, compression, workers, in_memory, force):
+    """Packages the participant bundles and writes an index."""
+    from src.export import BundleExporter
+
+    exporter = BundleExporter(
+        save_path=save,
+        output=output or os.path.join(save, "bundles"),
+        compression=compression,
+        workers=workers,
+        in_memory=in_memory,
+        force=force,
+    )
+    exporter.export()
+
+
+@main.command()
+@click.option(
+    "--config",
+    required=True,
+    help="The path to the .yaml configuration file for the CTF-Creator.",
+    type=click.File("r"),
+)
+@click.option(
+    "--save",
+    required=True,
+    help="The path where the user data of the CTF-Creator is saved.",
+    type=click.Path(exists=True, file_okay=False),
+)
+@click.option(
+    "--kali",
+    default=False,
+    is_flag=True,
+    help="Also checks the Kali container of every user.",
+    show_default=True,
+)
+@click.option(
+    "--workers",
+    default=32,
+    help="Number of users checked in parallel on each host.",
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--output",
+    default=None,
+    help="The JSON file for the results. Defaults to <save>/verify.json.",
+    type=click.Path(dir_okay=False, writable=True),
+)
+def verify(config, save, kali, workers, output):
+    """Checks the containers, OpenVPN port and reachability of every user."""
+    from src.verify import Verifier, print_matrix, write_results
+
+    verifier = Verifier(
+        config=CTFCreator._get_config(config.read()),
+        save_path=save,
+        kalibox=kali,
+        workers=workers,
+    )
+    results = verifier.verify()
+    print_matrix(results=results, checks=verifier.checks())
+    write_results(results=results, path=output or os.path.join(save, "verify.json"))
+    if not all(r.get("ok") for r in results.values()):
+        exit(1)
+
+
+@main.command()
+@click.option(
+    "--config",
+    required=True,
+    help="The path to the .yaml configuration file for the CTF-Creator.",
+    type=click.File("r"),
+)
+@click.option(
+    "--save",
+    required=True,
+    help="The path where the user data of the CTF-Creator is saved.",
+    type=click.Path(exists=True, file_okay=False),
+)
+@click.option(
+    "--idle-minutes",
+    default=60,
+    help="Minutes without VPN connection after which the containers of a user are suspended.",
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--action",
+    default="stop",
+    help="stop frees the memory of idle containers, pause only their CPU but resumes faster.",
+    show_default=True,
+    type=click.Choice(ACTIONS),
+)
+@click.option(
+    "--interval",
+    default=1.0,
+    help="Seconds between two checks of the VPN connections.",
+    show_default=True,
+    type=click.FloatRange(min=0.1),
+)
+@click.option(
+    "--once",
+    default=False,
+    is_flag=True,
+    help="Runs a single check instead of watching continuously.",
+    show_default=True,
+)
+@click.option(
+    "--ready-target",
+    default=10.0,
+    help="Seconds from the first connect of a lazy user until the challenges should be ready.",
+    show_default=True,
+    type=click.FloatRange(min=0),
+)
+def monitor(config, save, idle_minutes, action, interval, once, ready_target):
+    """Suspends the containers of idle users and resumes them when they connect.
+
+    Users deployed with create --lazy get their challenges on their first connect.
+    """
+    content = config.read()
+    config = CTFCreator._get_config(content)
+    users = deployed_participants(save_path=save)
+    on_connect = None
+    if any(u.metadata.get("lazy") for u in users):
+        ctfcreator = CTFCreator(
+            config=content,
+            save_path=save,
+            prune=False,
+            kalibox=False,
+            recreate=False,
+            lazy=True,
+            ready_target=ready_target,
+            # Runs next to create, which owns the journal.
+            read_only=True,
+        )
+        on_connect = ctfcreator.materialize
+        log_lazy_metrics(users=users, target=ready_target)
+    manager = IdleManager(
+        hosts=[Host(host=host, save_path=save) for host in config.get("hosts")],
+        users=users,
+        challenges=[c["name"] for c in config.get("containers")],
+        save_path=save,
+        idle_timeout=idle_minutes * 60,
+        action=action,
+        interval=interval,
+        on_connect=on_connect,
+    )
+    manager.run(once=once)
+    if on_connect:
+        log_lazy_metrics(users=users, target=ready_target)
+
+
+@main.command()
+@click.option(
+    "--config",
+    required=True,
+    help="The path to the .yaml configuration file for the CTF-Creator.",
+    type=click.File("r"),
+)
+@click.option(
+    "--save",
+    required=True,
+    help="The path where the user data of the CTF-Creator is saved.",
+    type=click.Path(exists=True, file_okay=False),
+)
+@click.option(
+    "--batch-size",
+    default=16,
+    help="Number of users removed in parallel on each host.",
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+def gc(config, save, batch_size):
+    """Retires the environments of all users whose lease expired."""
+    config = CTFCreator._get_config(config.read())
+    users = expired_participants(save_path=save)
+    if not users:
+        logger.info("No expired leases.")
+        return
+    hosts = {str(u.ip) for u in users}
+    collector = LeaseCollector(
+        hosts=[
+            Host(host=host, save_path=save)
+            for host in config.get("hosts")
+            if str(host.get("ip")) in hosts
+        ],
+        save_path=save,
+        batch_size=batch_size,
+    )
+    collector.collect(users=users)
+
+
+@main.command()
+@click.option(
+    "--config",
+    required=True,
+    help="The path to the .yaml configuration file for the CTF-Creator.",
+    type=click.File("r"),
+)
+@click.option(
+    "--save",
+    required=True,
+    help="The path where the user data of the CTF-Creator is saved.",
+    type=click.Path(exists=True, file_okay=False),
+)
+@click.option(
+    "--wave-size",
+    default=4,
+    help="Number of users per host whose challenges are recreated at the same time.",
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--pull/--no-pull",
+    default=True,
+    help="Pulls the challenge images on the hosts before comparing them.",
+    show_default=True,
+)
+def update(config, save, wave_size, pull):
+    """Recreates the challenge containers that run an outdated image."""
+    from src.update import RollingUpdater
+
+    config = CTFCreator._get_config(config.read())
+    updater = RollingUpdater(
+        hosts=[Host(host=host, save_path=save) for host in config.get("hosts")],
+        config=config,
+        save_path=save,
+        wave_size=wave_size,
+        pull=pull,
+    )
+    if updater.update()["failed"]:
+        exit(1)
+
+
+@main.command()
+@click.option(
+    "--config",
+    required=True,
+    help="The path to the .yaml configuration file for the CTF-Creator.",
+    type=click.File("r"),
+)
+@click.option(
+    "--save",
+    required=True,
+    help="The path where the user data of the CTF-Creator is saved.",
+    type=click.Path(exists=True, file_okay=False),
+)
+@click.option(
+    "--epoch",
+    default=None,
+    help="The epoch of the new flags, defaults to the next one. Repeat a failed rotation with the same epoch.",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--batch-size",
+    default=32,
+    help="Number of flags written in parallel on each host.",
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+def rotate(config, save, epoch, batch_size):
+    """Writes new flags into all challenge containers without restarting them."""
+    config = CTFCreator._get_config(config.read())
+    epoch = epoch or read_epoch(save_path=save) + 1
+    rotator = FlagRotator(
+        config=config, save_path=save, epoch=epoch, batch_size=batch_size
+    )
+    if rotator.rotate():
+        logger.error(f"Epoch {epoch} is not saved, repeat it with --epoch {epoch}.")
+        exit(1)
+    # Only saved once every flag of the epoch is confirmed.
+    write_epoch(save_path=save, epoch=epoch)
+
+
+@main.command()
+@click.option(
+    "--config",
+    required=True,
+    help="The path to the .yaml configuration file for the CTF-Creator.",
+    type=click.File("r"),
+)
+@click.option(
+    "--save",
+    required=True,
+    help="The path where the user data of the CTF-Creator is saved.",
+    type=click.Path(exists=True, file_okay=False),
+)
+@click.option(
+    "--user",
+    "users",
+    required=True,
+    multiple=True,
+    help="The user to reset, can be repeated.",
+)
+@click.option(
+    "--challenge",
+    "challenges",
+    multiple=True,
+    help="The challenge to reset, can be repeated. Defaults to all challenges and Kali.",
+)
+@click.option(
+    "--workers",
+    default=16,
+    help="Number of users reset in parallel.",
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+def reset(config, save, users, challenges, workers):
+    """Restores the challenge containers of users to a pristine state."""
+    from src.reset import EnvironmentReset
+
+    config = CTFCreator._get_config(config.read())
+    hosts = {
+        str(Participant(user=u, save_path=save).ip)
+        for u in users
+        if os.path.isfile(f"{save}/data/{u}/client.ovpn")
+    }
+    resetter = EnvironmentReset(
+        hosts=[
+            Host(host=host, save_path=save)
+            for host in config.get("hosts")
+            if str(host.get("ip")) in hosts
+        ],
+        config=config,
+        save_path=save,
+        workers=workers,
+    )
+    results = resetter.reset(users=list(users), challenges=list(challenges) or None)
+    if any("error" in r for r in results.values()):
+        exit(1)
+
+
+@main.command()
+@click.option(
+    "--config",
+    required=True,
+    help="The path to the .yaml configuration file for the CTF-Creator.",
+    type=click.File("r"),
+)
+@click.option(
+    "--port",
+    default=9400,
+    help="Port of the Prometheus endpoint, 0 disables it.",
+    show_default=True,
+    type=click.IntRange(min=0, max=65535),
+)
+@click.option(
+    "--csv",
+    "csv_path",
+    default=None,
+    help="CSV file the percentiles are appended to periodically.",
+    type=click.Path(dir_okay=False),
+)
+@click.option(
+    "--csv-interval",
+    default=60.0,
+    help="Seconds between two CSV snapshots.",
+    show_default=True,
+    type=click.FloatRange(min=1),
+)
+@click.option(
+    "--interval",
+    default=5.0,
+    help="Seconds between two samples of all containers.",
+    show_default=True,
+    type=click.FloatRange(min=1),
+)
+@click.option(
+    "--window",
+    default=300.0,
+    help="Seconds of samples the percentiles are computed over.",
+    show_default=True,
+    type=click.FloatRange(min=1),
+)
+@click.option(
+    "--duration",
+    default=None,
+    help="Stops after the given seconds instead of running until interrupted.",
+    type=click.FloatRange(min=1),
+)
+def telemetry(config, port, csv_path, csv_interval, interval, window, duration):
+    """Collects the resource usage per user, challenge and host from all hosts."""
+    from src.telemetry import TelemetryCollector
+
+    config = CTFCreator._get_config(config.read())
+    collector = TelemetryCollector(
+        hosts=config.get("hosts"), interval=interval, window=window, csv_path=csv_path
+    )
+    collector.run(port=port or None, csv_interval=csv_interval, duration=duration)
+
+
+@main.command()
+@click.option(
+    "--config",
+    required=True,
+    help="The path to the .yaml configuration file for the CTF-Creator.",
+    type=click.File("r"),
+)
+@click.option(
+    "--save",
+    required=True,
+    help="The path where the user data of the CTF-Creator is saved.",
+    type=click.Path(exists=True, file_okay=False),
+)
+@click.option(
+    "--drain",
+    multiple=True,
+    help="IP address of a host whose users all move, can be repeated.",
+)
+@click.option(
+    "--max-moves",
+    default=None,
+    help="Upper limit of users moved in this run.",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--workers",
+    default=8,
+    help="Number of users moved in parallel.",
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--kali",
+    default=False,
+    is_flag=True,
+    help="Provides a Kali Docker container on the new host.",
+    show_default=True,
+)
+@click.option(
+    "--dry-run",
+    default=False,
+    is_flag=True,
+    help="Only shows which users would move.",
     show_default=True,
 )
+def rebalance(config, save, drain, max_moves, workers, kali, dry_run):
+    """Moves users between hosts to spread them evenly or to empty hosts."""
+    ctfcreator = CTFCreator(
+        config=config.read(),
+        save_path=save,
+        prune=False,
+        kalibox=kali,
+        recreate=False,
+        workers=workers,
+    )
+    try:
+        ctfcreator.rebalance(drain=list(drain), max_moves=max_moves, dry_run=dry_run)
+    except OpenVPNError:
+        exit(1)
+
+
+@main.command()
+@click.option(
+    "--config",
+    required=True,
+    help="The path to the .yaml configuration file for the CTF-Creator.",
+    type=click.File("r", encoding="utf8"),
+)
+@click.option(
+    "--save",
+    required=True,
+    help="The path where the user data of the CTF-Creator is saved.",
+    type=click.Path(writable=True),
+)
 @click.option(
     "--kali",
     default=False,
@@ -528,19 +3062,126 @@ class CTFCreator:
     "--recreate",
     default=False,
     is_flag=True,
-    help="Restart OpenVPN Docker container. Restarts Kalibox also if --kali is set to true",
+    help="Recreates the OpenVPN server, Kali container and network of incomplete users.",
+    show_default=True,
+)
+@click.option(
+    "--lazy",
+    default=False,
+    is_flag=True,
+    help="Only plans the network and OpenVPN server of new users.",
+    show_default=True,
+)
+@click.option(
+    "--workers",
+    default=8,
+    help="Number of users of a host applied in parallel.",
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--dry-run",
+    default=False,
+    is_flag=True,
+    help="Only shows the plan.",
     show_default=True,
 )
-def main(config, save, prune, kali, recreate):
+@click.option(
+    "--output",
+    default=None,
+    help="Writes the plan as JSON to this file.",
+    type=click.Path(dir_okay=False, writable=True),
+)
+def apply(config, save, kali, recreate, lazy, workers, dry_run, output):
+    """Plans the operations that bring all hosts to the configuration and runs them."""
     ctfcreator = CTFCreator(
         config=config.read(),
         save_path=save,
-        prune=prune,
+        prune=False,
         kalibox=kali,
         recreate=recreate,
+        workers=workers,
+        lazy=lazy,
+    )
+    try:
+        ctfcreator.apply(dry_run=dry_run, output=output)
+    except OpenVPNError:
+        exit(1)
+
+
+@main.command()
+@click.option(
+    "--config",
+    required=True,
+    help="The path to the .yaml configuration file for the CTF-Creator.",
+    type=click.File("r", encoding="utf8"),
+)
+@click.option(
+    "--save",
+    required=True,
+    help="The path where the user data of the CTF-Creator is saved.",
+    type=click.Path(exists=True, file_okay=False),
+)
+@click.option(
+    "--kali",
+    default=False,
+    is_flag=True,
+    help="The users have a Kali container that is repaired as well.",
+    show_default=True,
+)
+@click.option(
+    "--port",
+    default=9401,
+    help="Port of the status endpoint at /status, 0 disables it.",
+    show_default=True,
+    type=click.IntRange(min=0, max=65535),
+)
+@click.option(
+    "--grace",
+    default=5.0,
+    help="Seconds to wait after a failure event before a user is repaired.",
+    show_default=True,
+    type=click.FloatRange(min=0),
+)
+@click.option(
+    "--max-repairs",
+    default=3,
+    help="Number of repairs of a user within --repair-window, further failures are only logged.",
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--repair-window",
+    default=600.0,
+    help="Window of --max-repairs in seconds.",
+    show_default=True,
+    type=click.FloatRange(min=1),
+)
+def watch(config, save, kali, port, grace, max_repairs, repair_window):
+    """Repairs users as soon as the Docker events of a host show a failure."""
+    from src.watch import Reconciler
+
+    ctfcreator = CTFCreator(
+        config=config.read(),
+        save_path=save,
+        prune=False,
+        kalibox=kali,
+        recreate=False,
+    )
+    reconciler = Reconciler(
+        creator=ctfcreator,
+        hosts=[
+            Host(host=host, save_path=save) for host in ctfcreator.config.get("hosts")
+        ],
+        save_path=save,
+        grace=grace,
+        max_repairs=max_repairs,
+        repair_window=repair_window,
     )
-    ctfcreator.create_challenge()
+    reconciler.run(port=port or None)
+
 
+main.add_command(status)
 
 if __name__ == "__main__":
     main()
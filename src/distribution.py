@@ -0,0 +1,131 @@
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List
+
+from docker import DockerClient
+from docker.errors import ImageNotFound, APIError
+from docker.utils import parse_repository_tag
+
+sys.path.append(os.getcwd())
+from src.host import Host
+from src.log_config import get_logger
+
+logger = get_logger("ctf_creator.distribution")
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class DistributionError(Exception):
+    """Custom exception raised when an image cannot be pushed to the registry mirror."""
+
+    pass
+
+
+class ImageDistributor:
+    """
+    Distributes the images of a deployment from the controller to all hosts, so the hosts
+    do not have to pull them from the registry themselves.
+
+    Every image is exported once on the controller and streamed to the hosts in parallel.
+    Hosts that already have an image with the same ID are skipped. With a registry mirror
+    the image is pushed to the mirror once and the hosts pull it from there instead.
+    """
+
+    def __init__(
+        self, local_docker: DockerClient, hosts: List[Host], mirror: str = None
+    ) -> None:
+        self.local_docker = local_docker
+        self.hosts = hosts
+        self.mirror = mirror
+
+    def distribute(self, images: List[str]) -> None:
+        for image in images:
+            start = time.monotonic()
+            local_image = self._local_image(image=image)
+            targets = [
+                host
+                for host in self.hosts
+                if not self._has_image(host=host, image=image, image_id=local_image.id)
+            ]
+            if not targets:
+                logger.info(f"Image {image} is up to date on all hosts")
+                continue
+
+            logger.info(f"Distribute image {image} to {len(targets)} hosts")
+            if self.mirror:
+                self._distribute_mirror(
+                    image=image, local_image=local_image, hosts=targets
+                )
+            else:
+                self._distribute_archive(
+                    image=image, local_image=local_image, hosts=targets
+                )
+            logger.info(f"Image {image} distributed in {time.monotonic() - start:.1f}s")
+
+    def _local_image(self, image: str):
+        try:
+            return self.local_docker.images.get(image)
+        except ImageNotFound:
+            logger.warning(f"Try to pull Image {image} on the controller.")
+            return self.local_docker.images.pull(image)
+
+    def _has_image(self, host: Host, image: str, image_id: str) -> bool:
+        try:
+            return host.docker.client.images.get(image).id == image_id
+        except ImageNotFound:
+            return False
+
+    def _parallel(self, function, hosts: List[Host]) -> None:
+        with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+            futures = {executor.submit(function, host): host for host in hosts}
+            for future, host in futures.items():
+                try:
+                    future.result()
+                except APIError as e:
+                    logger.error(f"Image distribution to host {host.ip} failed: {e}")
+
+    def _distribute_archive(self, image: str, local_image, hosts: List[Host]) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            archive = os.path.join(directory, "image.tar")
+            with open(archive, "wb") as file:
+                for chunk in local_image.save(chunk_size=CHUNK_SIZE, named=image):
+                    file.write(chunk)
+            logger.info(
+                f"Exported {image} ({os.path.getsize(archive) / (1024 * 1024):.0f} MiB)"
+            )
+
+            def load(host: Host) -> None:
+                host.docker.client.images.load(self._read_chunks(path=archive))
+                logger.info(f"Image {image} loaded on host {host.ip}")
+
+            self._parallel(function=load, hosts=hosts)
+
+    def _read_chunks(self, path: str) -> Iterator[bytes]:
+        with open(path, "rb") as file:
+            while chunk := file.read(CHUNK_SIZE):
+                yield chunk
+
+    def _distribute_mirror(self, image: str, local_image, hosts: List[Host]) -> None:
+        repository, tag = parse_repository_tag(image)
+        tag = tag or "latest"
+        mirror_repository = f"{self.mirror}/{repository}"
+        local_image.tag(mirror_repository, tag)
+        # A failed push is only reported in the stream, the call itself succeeds.
+        for line in self.local_docker.images.push(
+            mirror_repository, tag=tag, stream=True, decode=True
+        ):
+            if "error" in line:
+                raise DistributionError(
+                    f"Push of {image} to the mirror {self.mirror} failed: "
+                    f"{line.get('errorDetail', {}).get('message', line['error'])}"
+                )
+
+        def pull(host: Host) -> None:
+            mirrored = host.docker.client.images.pull(mirror_repository, tag=tag)
+            mirrored.tag(repository, tag)
+            logger.info(f"Image {image} pulled from mirror on host {host.ip}")
+
+        self._parallel(function=pull, hosts=hosts)
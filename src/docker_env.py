@@ -1,6 +1,9 @@
 from ipaddress import IPv4Network, IPv6Network, ip_address
+import io
 import sys
 import os
+import shlex
+import tarfile
 import time
 
 from subprocess import run, CalledProcessError
@@ -10,10 +13,25 @@ from docker.types import EndpointConfig, IPAMPool, IPAMConfig
 
 sys.path.append(os.getcwd())
 from src.log_config import get_logger
+from src.naming import LABEL_ROLE, LABEL_USER
+from src.throttle import AdmissionController
 
 logger = get_logger("ctf_creator.docker")
 
 
+def env_files(environment: dict) -> dict:
+    """
+    Returns the files /ctf/env and /ctf/flag of a challenge, for images that read their
+    environment from files, e.g. pooled challenges.
+    """
+    return {
+        "ctf/env": "".join(
+            f"{key}={shlex.quote(str(value))}\n" for key, value in environment.items()
+        ),
+        "ctf/flag": str(environment.get("FLAG", "")),
+    }
+
+
 class Docker:
     def __init__(self, host: dict) -> None:
         self.username = host.get("username")
@@ -21,6 +39,21 @@ class Docker:
         self.client = DockerClient(
             base_url=f"ssh://{self.username}@{self.ip}", use_ssh_client=True
         )
+        self.admission = AdmissionController(name=str(self.ip))
+
+    def call(self, function, *args, **kwargs):
+        """
+        Runs a Docker call through the admission controller of the host, which limits the
+        calls in flight and retries transient errors.
+        """
+        return self.admission.call(function, *args, **kwargs)
+
+    def call_once(self, function, *args, **kwargs):
+        """
+        Runs a Docker call that creates something through the admission controller of the
+        host, without retries.
+        """
+        return self.admission.call_once(function, *args, **kwargs)
 
     def prune(self):
         try:
@@ -64,21 +97,148 @@ class Docker:
                 f"Original error: {e}"
             )
 
-    def create_container(
+    def container_spec(
         self,
         environment: dict,
         network_name: str,
         host_address: str,
         container_name: str,
         image: str,
-    ) -> None:
+        labels: dict = None,
+        files: dict = None,
+    ) -> dict:
         """
-        Create a Docker container with a specific name, image, and static IP address.
+        Builds the specification of a challenge container.
+
+        Specifications are plain dictionaries, so they can be run with the Docker SDK by
+        run_spec or serialized for the host agent.
 
         Args:
+            environment (dict): The environment of the container.
             network_name (str): The name of the network to connect the container to.
-            name (str): The name of the container to create (must be unique).
+            host_address (str): The static IP address within the network.
+            container_name (str): The name of the container to create (must be unique).
             image (str): The Docker image to use for the container.
+            labels (dict, optional): The labels of the container.
+            files (dict, optional): Files written into the container before its first
+                start, by their path relative to /.
+
+        Returns:
+            dict: The container specification.
+        """
+        return {
+            "name": container_name,
+            "image": image,
+            "network": network_name,
+            "ip": host_address,
+            "environment": environment,
+            "security_opt": ["no-new-privileges"],
+            "tmpfs": {
+                "/var/run": "",
+                "/var/cache": "",
+                "/var/cache/nginx": "",
+                "/tmp": "",
+            },
+            "mem_limit": "256m",
+            "memswap_limit": 0,
+            "cpu_quota": 500000,
+            "restart": "always",
+            "labels": labels or {},
+            "files": files or {},
+        }
+
+    def kali_spec(
+        self,
+        command: list,
+        network_name: str,
+        host_address: str,
+        container_name: str,
+        image: str,
+        labels: dict = None,
+    ) -> dict:
+        """
+        Builds the specification of a Kali container, see container_spec.
+        """
+        return {
+            "name": container_name,
+            "image": image,
+            "network": network_name,
+            "ip": host_address,
+            "command": command,
+            "cap_add": ["NET_ADMIN", "NET_RAW"],
+            "mem_limit": "512m",
+            "memswap_limit": 0,
+            "cpu_quota": 50000,
+            "restart": "always",
+            "labels": labels or {},
+        }
+
+    def openvpn_spec(
+        self,
+        host_address: str,
+        network_name: str,
+        container_name: str,
+        openvpn_port: int,
+        mount_path: str,
+        server_path: str,
+        extra_volumes: list = None,
+        mem_limit: str = "256m",
+        cpu_quota: int = 1000,
+        labels: dict = None,
+    ) -> dict:
+        """
+        Builds the specification of an OpenVPN server container, see container_spec.
+
+        Args:
+            host_address (str): The static IP address within the network.
+            network_name (str): The name of the network to connect the container to.
+            container_name (str): The name of the OpenVPN server container.
+            openvpn_port (int): The published UDP port of the server.
+            mount_path (str): The host path of the Dockovpn_data folder.
+            server_path (str): The host path of the rendered server.conf and start.sh.
+            extra_volumes (list, optional): Additional volumes, e.g. for the gateway.
+            mem_limit (str, optional): The memory limit of the container.
+            cpu_quota (int, optional): The CPU quota of the container.
+            labels (dict, optional): The labels of the container.
+
+        Returns:
+            dict: The container specification.
+        """
+        return {
+            "name": container_name,
+            "image": "alekslitvinenk/openvpn",
+            "network": network_name,
+            "ip": host_address,
+            "command": "-s",
+            "cap_add": ["NET_ADMIN"],
+            "ports": {"1194/udp": str(openvpn_port)},
+            "environment": {
+                "HOST_ADDR": f"{str(self.ip)}",
+            },
+            "tmpfs": {
+                "/var/run": "",
+                "/var/cache": "",
+                "/tmp": "",
+            },
+            "volumes": [
+                f"{mount_path}:/opt/Dockovpn_data",
+                f"{server_path}/server.conf:/etc/openvpn/server.conf",
+                f"{server_path}/start.sh:/opt/Dockovpn/start.sh:ro",
+            ]
+            + (extra_volumes or []),
+            "mem_limit": mem_limit,
+            "memswap_limit": 0,
+            "cpu_quota": cpu_quota,
+            "restart": "always",
+            "labels": labels or {},
+        }
+
+    def run_spec(self, spec: dict):
+        """
+        Create and start a container from its specification.
+
+        Args:
+            spec (dict): The container specification, see container_spec.
 
         Returns:
             docker.models.containers.Container: The created Docker container.
@@ -86,94 +246,409 @@ class Docker:
         Raises:
             docker.errors.APIError: If an error occurs during the container creation process.
         """
-        self._check_image_existence(image_name=image)
-
-        endpoint_config = EndpointConfig(version="1.44", ipv4_address=host_address)
+        self._check_image_existence(image_name=spec["image"])
+
+        endpoint_config = EndpointConfig(version="1.44", ipv4_address=spec["ip"])
+        options = dict(
+            name=spec["name"],
+            network=spec["network"],
+            networking_config={spec["network"]: endpoint_config},
+            mem_limit=spec["mem_limit"],
+            memswap_limit=spec["memswap_limit"],
+            restart_policy={"Name": spec["restart"]},
+            cpu_quota=spec["cpu_quota"],
+            **self._spec_options(spec=spec),
+        )
         try:
-            container = self.client.containers.run(
-                image,
-                detach=True,
-                name=container_name,
-                network=network_name,
-                networking_config={network_name: endpoint_config},
-                environment=environment,
-                security_opt=["no-new-privileges"],
-                # read_only=True,
-                tmpfs={
-                    "/var/run": "",
-                    "/var/cache": "",
-                    "/var/cache/nginx": "",
-                    "/tmp": "",
-                },
-                mem_limit="256m",
-                memswap_limit=0,
-                restart_policy={"name": "always"},
-                cpu_quota=500000,
+            if not spec.get("files"):
+                return self.call_once(
+                    self.client.containers.run, spec["image"], detach=True, **options
+                )
+            # The files have to be in place before the first start.
+            container = self.call_once(
+                self.client.containers.create, spec["image"], **options
             )
+            self.write_files(container_name=container.id, files=spec["files"])
+            self.call(container.start)
             return container
         except APIError as e:
             logger.error(f"Error creating container: {e}")
             raise
 
-    def create_kali(
+    def _spec_options(self, spec: dict) -> dict:
+        """Returns the optional arguments of a container specification for the SDK."""
+        return {
+            key: spec[key]
+            for key in (
+                "environment",
+                "command",
+                "security_opt",
+                "cap_add",
+                "ports",
+                "volumes",
+                "tmpfs",
+                "labels",
+            )
+            if spec.get(key)
+        }
+
+    def replace_container(self, spec: dict) -> float:
+        """
+        Replaces a container by a fresh one from its specification.
+
+        The new container is created detached from all networks before the old one is
+        removed, so only the removal, the network connection and the start fall into the
+        downtime.
+
+        Args:
+            spec (dict): The container specification, see container_spec.
+
+        Returns:
+            float: The seconds between the removal of the old and the start of the new
+                container.
+
+        Raises:
+            docker.errors.APIError: If an error occurs while replacing the container.
+        """
+        self._check_image_existence(image_name=spec["image"])
+        staging = f"{spec['name']}_staging"
+        try:
+            try:
+                self.call(self.client.api.remove_container, staging, force=True)
+            except NotFound:
+                pass
+            container = self.call_once(
+                self.client.containers.create,
+                spec["image"],
+                name=staging,
+                mem_limit=spec["mem_limit"],
+                memswap_limit=spec["memswap_limit"],
+                restart_policy={"Name": spec["restart"]},
+                cpu_quota=spec["cpu_quota"],
+                **self._spec_options(spec=spec),
+            )
+            self.call(self.client.networks.get("bridge").disconnect, container)
+            if spec.get("files"):
+                self.write_files(container_name=container.id, files=spec["files"])
+
+            start = time.monotonic()
+            try:
+                self.call(self.client.api.remove_container, spec["name"], force=True)
+            except NotFound:
+                logger.debug(f"{spec['name']} does not exist, create it")
+            self.call(container.rename, spec["name"])
+            self.call(
+                self.client.networks.get(spec["network"]).connect,
+                container,
+                ipv4_address=spec["ip"],
+            )
+            self.call(container.start)
+            return time.monotonic() - start
+        except APIError as e:
+            logger.error(f"Error replacing container {spec['name']}: {e}")
+            raise
+
+    def create_container(
         self,
-        command: list,
+        environment: dict,
         network_name: str,
         host_address: str,
         container_name: str,
         image: str,
-    ) -> None:
+        labels: dict = None,
+    ):
         """
         Create a Docker container with a specific name, image, and static IP address.
 
         Args:
+            environment (dict): The environment of the container.
             network_name (str): The name of the network to connect the container to.
-            name (str): The name of the container to create (must be unique).
+            host_address (str): The static IP address within the network.
+            container_name (str): The name of the container to create (must be unique).
             image (str): The Docker image to use for the container.
+            labels (dict, optional): The labels of the container.
 
         Returns:
             docker.models.containers.Container: The created Docker container.
 
+        Raises:
+            docker.errors.APIError: If an error occurs during the container creation process.
+        """
+        return self.run_spec(
+            self.container_spec(
+                environment=environment,
+                network_name=network_name,
+                host_address=host_address,
+                container_name=container_name,
+                image=image,
+                labels=labels,
+            )
+        )
+
+    def create_pool_container(
+        self, container_name: str, image: str, labels: dict = None
+    ):
+        """
+        Pre-create a challenge container for the warm pool without starting it.
+
+        The container gets the same limits as a regular challenge container but is
+        detached from every network, so it can later be claimed by any user.
+
+        Args:
+            container_name (str): The name of the pool container (must be unique).
+            image (str): The Docker image to use for the container.
+            labels (dict, optional): The labels of the container.
+
+        Returns:
+            docker.models.containers.Container: The created (not started) container.
+
         Raises:
             docker.errors.APIError: If an error occurs during the container creation process.
         """
         self._check_image_existence(image_name=image)
 
-        endpoint_config = EndpointConfig(version="1.44", ipv4_address=host_address)
+        spec = self.container_spec(
+            environment={},
+            network_name=None,
+            host_address=None,
+            container_name=container_name,
+            image=image,
+            labels=labels,
+        )
         try:
-            container = self.client.containers.run(
+            container = self.call_once(
+                self.client.containers.create,
                 image,
-                detach=True,
                 name=container_name,
-                network=network_name,
-                networking_config={network_name: endpoint_config},
-                command=command,
-                cap_add=["NET_ADMIN", "NET_RAW"],
-                mem_limit="512m",
-                memswap_limit=0,
-                restart_policy={"name": "always"},
-                cpu_quota=50000,
+                security_opt=spec["security_opt"],
+                tmpfs=spec["tmpfs"],
+                mem_limit=spec["mem_limit"],
+                memswap_limit=spec["memswap_limit"],
+                restart_policy={"Name": spec["restart"]},
+                cpu_quota=spec["cpu_quota"],
+                labels=spec["labels"],
             )
+            # Created containers are attached to the default bridge, detach them so the
+            # claim only has to connect the user network.
+            self.call(self.client.networks.get("bridge").disconnect, container)
             return container
         except APIError as e:
-            logger.error(f"Error creating container: {e}")
+            logger.error(f"Error creating pool container: {e}")
             raise
 
-    def create_openvpn_server(
+    def claim_pool_container(self, pool_name: str, spec: dict):
+        """
+        Turn a pre-created pool container into a user challenge container.
+
+        The pool container is renamed, connected to the user network with its static IP
+        and started, so neither the image check nor a container creation is left in the
+        critical path. Docker cannot change the environment of an existing container,
+        therefore the files of the specification, e.g. /ctf/env and /ctf/flag, are
+        written before the start.
+
+        Args:
+            pool_name (str): The name of the pool container to claim.
+            spec (dict): The specification of the user container, see container_spec.
+
+        Returns:
+            docker.models.containers.Container: The started container.
+
+        Raises:
+            docker.errors.APIError: If an error occurs while claiming the container. The
+                container is removed then, so it is neither claimed twice nor left
+                half-configured.
+        """
+        try:
+            container = self.call(self.client.containers.get, pool_name)
+            self.call(container.rename, spec["name"])
+            self.call(
+                self.client.networks.get(spec["network"]).connect,
+                container,
+                ipv4_address=spec["ip"],
+            )
+            if spec.get("files"):
+                self.write_files(container_name=container.id, files=spec["files"])
+            self.call(container.start)
+            return container
+        except APIError as e:
+            logger.error(f"Error claiming pool container {pool_name}: {e}")
+            for name in (pool_name, spec["name"]):
+                try:
+                    self.call(self.client.api.remove_container, name, force=True)
+                except NotFound:
+                    pass
+            raise
+
+    def create_shared_container(
+        self, container_name: str, image: str, environment: dict, labels: dict = None
+    ):
+        """
+        Create and start a challenge container shared by the users of this host.
+
+        The container gets the same limits as a regular challenge container. It is
+        detached from the default bridge and only connected to the user networks.
+
+        Args:
+            container_name (str): The name of the shared container (must be unique).
+            image (str): The Docker image to use for the container.
+            environment (dict): The environment of the container.
+            labels (dict, optional): The labels of the container.
+
+        Returns:
+            docker.models.containers.Container: The started container.
+
+        Raises:
+            docker.errors.APIError: If an error occurs during the container creation process.
+        """
+        self._check_image_existence(image_name=image)
+
+        spec = self.container_spec(
+            environment=environment,
+            network_name=None,
+            host_address=None,
+            container_name=container_name,
+            image=image,
+            labels=labels,
+        )
+        try:
+            container = self.call_once(
+                self.client.containers.create,
+                image,
+                name=container_name,
+                environment=spec["environment"],
+                security_opt=spec["security_opt"],
+                tmpfs=spec["tmpfs"],
+                mem_limit=spec["mem_limit"],
+                memswap_limit=spec["memswap_limit"],
+                restart_policy={"Name": spec["restart"]},
+                cpu_quota=spec["cpu_quota"],
+                labels=spec["labels"],
+            )
+            self.call(self.client.networks.get("bridge").disconnect, container)
+            self.call(container.start)
+            return container
+        except APIError as e:
+            logger.error(f"Error creating shared container: {e}")
+            raise
+
+    def attach_shared(self, spec: dict) -> None:
+        """
+        Connects a shared container to the network of a user and writes the files of the
+        user, e.g. the flag, into it.
+
+        Args:
+            spec (dict): The attachment specification, see Host.shared_spec.
+
+        Raises:
+            docker.errors.APIError: If an error occurs while attaching the container.
+        """
+        self.connect_network(
+            container_name=spec["container"],
+            network_name=spec["network"],
+            host_address=spec["ip"],
+        )
+        try:
+            self.write_files(container_name=spec["container"], files=spec["files"])
+        except APIError as e:
+            logger.error(f"Error writing the files of {spec['name']}: {e}")
+            raise
+
+    def write_files(self, container_name: str, files: dict) -> None:
+        """
+        Writes files into a running or stopped container with one call.
+
+        Args:
+            container_name (str): The name or ID of the container.
+            files (dict): The content of each file by its path relative to /.
+
+        Raises:
+            docker.errors.APIError: If the files could not be written.
+        """
+        self.call(
+            self.client.api.put_archive,
+            container_name,
+            "/",
+            self._file_archive(files=files),
+        )
+
+    def read_file(self, container_name: str, path: str) -> str:
+        """
+        Reads a single file from a running or stopped container.
+
+        Raises:
+            docker.errors.APIError: If the file could not be read.
+        """
+        stream, _ = self.call(self.client.api.get_archive, container_name, path)
+        with tarfile.open(fileobj=io.BytesIO(b"".join(stream))) as tar:
+            member = [m for m in tar.getmembers() if m.isfile()][0]
+            return tar.extractfile(member).read().decode()
+
+    def _file_archive(self, files: dict) -> bytes:
+        """Builds an in-memory tar archive of the files, including their folders."""
+        folders = sorted(
+            {
+                "/".join(name.split("/")[:depth])
+                for name in files
+                for depth in range(1, name.count("/") + 1)
+            }
+        )
+        stream = io.BytesIO()
+        with tarfile.open(fileobj=stream, mode="w") as tar:
+            for folder in folders:
+                directory = tarfile.TarInfo(name=folder)
+                directory.type = tarfile.DIRTYPE
+                directory.mode = 0o755
+                directory.mtime = int(time.time())
+                tar.addfile(directory)
+            for name, content in files.items():
+                data = content.encode()
+                info = tarfile.TarInfo(name=name)
+                info.size = len(data)
+                info.mode = 0o444
+                info.mtime = int(time.time())
+                tar.addfile(info, io.BytesIO(data))
+        return stream.getvalue()
+
+    def create_kali(
         self,
-        host_address: str,
+        command: list,
         network_name: str,
+        host_address: str,
         container_name: str,
-        openvpn_port: int,
-        mount_path: str,
+        image: str,
+        labels: dict = None,
     ):
         """
-        Create an OpenVPN server container with specific configurations.
+        Create a Kali container with a specific name, image, and static IP address.
 
         Args:
-            client (docker.DockerClient): An instance of the Docker client.
+            command (list): The command of the container.
             network_name (str): The name of the network to connect the container to.
-            name (str): The base name of the OpenVPN server container.
+            host_address (str): The static IP address within the network.
+            container_name (str): The name of the container to create (must be unique).
+            image (str): The Docker image to use for the container.
+            labels (dict, optional): The labels of the container.
+
+        Returns:
+            docker.models.containers.Container: The created Docker container.
+
+        Raises:
+            docker.errors.APIError: If an error occurs during the container creation process.
+        """
+        return self.run_spec(
+            self.kali_spec(
+                command=command,
+                network_name=network_name,
+                host_address=host_address,
+                container_name=container_name,
+                image=image,
+                labels=labels,
+            )
+        )
+
+    def create_openvpn_server(self, **kwargs):
+        """
+        Create an OpenVPN server container, the arguments are the ones of openvpn_spec.
 
         Returns:
             docker.models.containers.Container: The created OpenVPN server container.
@@ -181,38 +656,45 @@ class Docker:
         Raises:
             docker.errors.APIError: If an error occurs during the container creation process.
         """
-        self._check_image_existence(image_name="alekslitvinenk/openvpn")
-        endpoint_config = EndpointConfig(version="1.44", ipv4_address=host_address)
+        return self.run_spec(self.openvpn_spec(**kwargs))
+
+    def connect_network(
+        self, container_name: str, network_name: str, host_address: str
+    ) -> None:
+        """
+        Connects an existing container to a network with a static IP address.
+
+        Args:
+            container_name (str): The name of the container.
+            network_name (str): The name of the network to connect the container to.
+            host_address (str): The static IP address within the network.
+
+        Raises:
+            docker.errors.APIError: If an error occurs while connecting the container.
+        """
+        container = self.client.containers.get(container_name)
+        if network_name in container.attrs["NetworkSettings"]["Networks"]:
+            logger.debug(f"{container_name} is already connected to {network_name}")
+            return
         try:
-            container = self.client.containers.run(
-                image="alekslitvinenk/openvpn",
-                detach=True,
-                name=container_name,
-                command="-s",
-                network=network_name,
-                restart_policy={"Name": "always"},
-                cap_add=["NET_ADMIN"],
-                ports={"1194/udp": str(openvpn_port)},
-                environment={
-                    "HOST_ADDR": f"{str(self.ip)}",
-                },
-                tmpfs={
-                    "/var/run": "",
-                    "/var/cache": "",
-                    "/tmp": "",
-                },
-                networking_config={network_name: endpoint_config},
-                volumes=[f"{mount_path}:/opt/Dockovpn_data"],
-                mem_limit="256m",
-                memswap_limit=0,
-                cpu_quota=1000,
+            self.call(
+                self.client.networks.get(network_name).connect,
+                container,
+                ipv4_address=host_address,
             )
-
-            return container
         except APIError as e:
-            logger.error(f"Error creating container: {e}")
+            logger.error(f"Error connecting {container_name} to {network_name}: {e}")
             raise
 
+    def container_memory(self, container_name: str) -> int:
+        """
+        Returns the current memory usage of a container in bytes, without the page cache.
+        """
+        stats = self.client.api.stats(container_name, stream=False, one_shot=True)
+        memory = stats.get("memory_stats", {})
+        cache = memory.get("stats", {}).get("inactive_file", 0)
+        return memory.get("usage", 0) - cache
+
     def create_network(self, name, subnet_, gateway_):
         """
         Create a Docker network with specific IPAM configuration.
@@ -232,8 +714,12 @@ class Docker:
         ipam_config = IPAMConfig(pool_configs=[ipam_pool])
 
         # Create the network with IPAM configuration
-        return self.client.networks.create(
-            name, driver="bridge", ipam=ipam_config, check_duplicate=True
+        return self.call_once(
+            self.client.networks.create,
+            name,
+            driver="bridge",
+            ipam=ipam_config,
+            check_duplicate=True,
         )
 
     def _check_image_existence(self, image_name):
@@ -266,29 +752,3 @@ class Docker:
                 raise ImageNotFound(
                     f"Error: Image {image_name} could not be pulled. Does this Docker Image exist?"
                 )
-
-    def modify_ovpn_server(self, user: str, subnet: IPv4Network | IPv6Network):
-
-        container = self.client.containers.get(f"{user}_openvpn")
-        delete_old = [
-            "sed -i '/push \"redirect-gateway/d' /etc/openvpn/server.conf",
-            "sed -i '/push \"dhcp-option DNS/d' /etc/openvpn/server.conf",
-            f"sed -i '$ a\\push \"route {subnet.network_address} 255.255.255.0\"' >> /etc/openvpn/server.conf",
-            "sed -i '$ a\\route-nopull' >> /etc/openvpn/server.conf",
-            "sed -i '$ a\\pull-filter ignore redirect-gateway' >> /etc/openvpn/server.conf",
-            f"iptables -A INPUT -s {subnet.network_address}/24 -j ACCEPT",
-            f"iptables -A OUTPUT -d {subnet.network_address}/24 -j ACCEPT",
-            f"""
-            sed -i '/iptables -t nat -A POSTROUTING -s 10.8.0.0\\/24 -o $ADAPTER -j MASQUERADE/a \\
-            iptables -A INPUT -s {subnet.network_address}/24 -j ACCEPT\\n\\
-            iptables -A OUTPUT -d {subnet.network_address}/24 -j ACCEPT\\n\\
-            iptables -A INPUT -m state --state ESTABLISHED,RELATED -j ACCEPT\\n\\
-            iptables -A OUTPUT -m state --state ESTABLISHED,RELATED -j ACCEPT\\n\\
-            iptables -A INPUT -j DROP\\n\\
-            iptables -A OUTPUT -j DROP' /opt/Dockovpn/start.sh
-            """,
-        ]
-        for sed_cmd in delete_old:
-            container.exec_run(cmd=sed_cmd)
-
-        container.restart()
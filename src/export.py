@@ -0,0 +1,218 @@
+import hashlib
+import io
+import json
+import os
+import sys
+import tarfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from subprocess import run, CalledProcessError
+from typing import List
+
+sys.path.append(os.getcwd())
+from src.log_config import get_logger
+from src.participant import Participant
+
+logger = get_logger("ctf_creator.export")
+
+# The only files handed out to a participant. Everything else of a user, e.g. the server
+# PKI in dockovpn_data.tar with the CA key or the profiles of team members, stays here.
+BUNDLED = ("client.ovpn", "README.md")
+
+
+class ExportError(Exception):
+    """Custom exception raised when a participant bundle could not be written."""
+
+    pass
+
+
+def _bundle_files(user_path: str) -> List[str]:
+    return sorted(n for n in BUNDLED if os.path.isfile(os.path.join(user_path, n)))
+
+
+def _fingerprint(user_path: str, files: List[str]) -> str:
+    """Fingerprint of the bundle content based on the names, sizes and mtimes of its files."""
+    digest = hashlib.sha256()
+    for name in files:
+        stat = os.stat(os.path.join(user_path, name))
+        digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def _tar_bytes(user: str, user_path: str, files: List[str]) -> bytes:
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode="w") as tar:
+        for name in files:
+            tar.add(os.path.join(user_path, name), arcname=f"{user}/{name}")
+    return stream.getvalue()
+
+
+def _build_bundle(
+    user: str,
+    user_path: str,
+    files: List[str],
+    target: str,
+    compression: str,
+    in_memory: bool,
+) -> str:
+    """
+    Writes the bundle of one user and returns its sha256 checksum. Runs in a worker process.
+    """
+    partial = f"{target}.part"
+    if compression == "zip" and in_memory:
+        stream = io.BytesIO()
+        with zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_DEFLATED) as bundle:
+            for name in files:
+                bundle.write(os.path.join(user_path, name), arcname=f"{user}/{name}")
+        with open(partial, "wb") as file:
+            file.write(stream.getvalue())
+    elif compression == "zip":
+        with zipfile.ZipFile(partial, "w", compression=zipfile.ZIP_DEFLATED) as bundle:
+            for name in files:
+                bundle.write(os.path.join(user_path, name), arcname=f"{user}/{name}")
+    elif in_memory:
+        result = run(
+            ["zstd", "-T0", "-q", "-c"],
+            input=_tar_bytes(user=user, user_path=user_path, files=files),
+            capture_output=True,
+            check=True,
+        )
+        with open(partial, "wb") as file:
+            file.write(result.stdout)
+    else:
+        tar_path = f"{target}.tar"
+        with tarfile.open(tar_path, mode="w") as tar:
+            for name in files:
+                tar.add(os.path.join(user_path, name), arcname=f"{user}/{name}")
+        try:
+            run(["zstd", "-T0", "-q", "-f", tar_path, "-o", partial], check=True)
+        finally:
+            os.remove(tar_path)
+    os.replace(partial, target)
+
+    digest = hashlib.sha256()
+    with open(target, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BundleExporter:
+    """
+    Packages the data of every participant into one bundle per user and writes an index.
+
+    The bundles are built in a process pool. Users whose files did not change since the
+    last export are skipped, based on the fingerprint stored in the index.
+    """
+
+    def __init__(
+        self,
+        save_path: str,
+        output: str,
+        compression: str = "zst",
+        workers: int = None,
+        in_memory: bool = False,
+        force: bool = False,
+    ) -> None:
+        self.save_path = save_path
+        self.output = output
+        self.compression = compression
+        self.workers = workers
+        self.in_memory = in_memory
+        self.force = force
+        self.index_path = os.path.join(output, "index.json")
+
+    def _read_index(self) -> dict:
+        if self.force or not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path, "r") as file:
+            return json.load(file)
+
+    def _users(self) -> List[str]:
+        """
+        Returns the users with a client configuration relative to the data folder. Teams
+        are replaced by their members, who get a bundle each in a folder of the team.
+        """
+        data_path = f"{self.save_path}/data"
+        if not os.path.isdir(data_path):
+            return []
+        users = []
+        for user in os.listdir(data_path):
+            if not os.path.isfile(f"{data_path}/{user}/client.ovpn"):
+                continue
+            members_path = f"{data_path}/{user}/members"
+            if not os.path.isdir(members_path):
+                users.append(user)
+                continue
+            users += [
+                f"{user}/members/{member}"
+                for member in os.listdir(members_path)
+                if os.path.isfile(f"{members_path}/{member}/client.ovpn")
+            ]
+        return sorted(users)
+
+    def export(self) -> dict:
+        start = time.monotonic()
+        os.makedirs(self.output, exist_ok=True)
+        previous = self._read_index()
+        extension = "zip" if self.compression == "zip" else "tar.zst"
+
+        index = {}
+        pending = {}
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for name in self._users():
+                user_path = f"{self.save_path}/data/{name}"
+                user = name.replace("/members/", "/")
+                files = _bundle_files(user_path)
+                participant = Participant(user=name, save_path=self.save_path)
+                if "/" in user:
+                    os.makedirs(
+                        os.path.join(self.output, os.path.dirname(user)), exist_ok=True
+                    )
+                entry = {
+                    "bundle": f"{user}.{extension}",
+                    "source": _fingerprint(user_path, files),
+                    "host": str(participant.ip),
+                    "port": participant.existing_openvpn_port,
+                    "subnet": str(participant.subnet),
+                }
+                old = previous.get(user, {})
+                if (
+                    old.get("source") == entry["source"]
+                    and old.get("bundle") == entry["bundle"]
+                    and os.path.exists(os.path.join(self.output, entry["bundle"]))
+                ):
+                    entry["sha256"] = old["sha256"]
+                    index[user] = entry
+                    continue
+
+                index[user] = entry
+                pending[user] = executor.submit(
+                    _build_bundle,
+                    user,
+                    user_path,
+                    files,
+                    os.path.join(self.output, entry["bundle"]),
+                    self.compression,
+                    self.in_memory,
+                )
+
+            for user, future in pending.items():
+                try:
+                    index[user]["sha256"] = future.result()
+                except (CalledProcessError, OSError) as e:
+                    del index[user]
+                    logger.error(f"Error exporting the bundle of {user}: {e}")
+
+        with open(f"{self.index_path}.part", "w") as file:
+            json.dump(index, file, indent=2)
+        os.replace(f"{self.index_path}.part", self.index_path)
+
+        logger.info(
+            f"Exported {len(pending)} changed of {len(index)} bundles to {self.output} "
+            f"in {time.monotonic() - start:.1f}s"
+        )
+        if len(index) < len(self._users()):
+            raise ExportError("Not all bundles could be exported.")
+        return index
@@ -17,3 +17,22 @@ def gen_flag_base64(user: str, secret: str):
         secret.encode(), msg=user.encode(), digestmod=hashlib.sha256
     ).digest()
     return flag.format(base64.b64encode(digest).decode())
+
+
+def challenge_flag(user: str, secret: str, container: str, epoch: int = 0) -> str:
+    """Returns the flag of a challenge of a user. Every rotation starts a new epoch."""
+    message = f"{user}_{container}" if not epoch else f"{user}_{container}_{epoch}"
+    return gen_flag(secret=secret, user=message)
+
+
+def challenge_environment(
+    user: str, secret: str, container: str, epoch: int = 0
+) -> dict:
+    """Returns the environment of the challenge container of a user, including its flag."""
+    return {
+        "USER": user,
+        "SECRET": secret,
+        "FLAG": challenge_flag(
+            user=user, secret=secret, container=container, epoch=epoch
+        ),
+    }
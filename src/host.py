@@ -1,9 +1,11 @@
+import json
 import re
 import sys
 import os
-from typing import List
+import threading
+from typing import Iterator, List
 
-from docker.errors import APIError
+from docker.errors import APIError, NotFound
 from ipaddress import IPv4Network, IPv6Network
 from paramiko import SSHClient, AutoAddPolicy
 from ipaddress import ip_address
@@ -11,13 +13,42 @@ from subprocess import run, PIPE, TimeoutExpired
 
 sys.path.append(os.getcwd())
 from src.log_config import get_logger
-from src.docker_env import Docker
+from src.docker_env import Docker, LABEL_ROLE, LABEL_USER, env_files
+from src.naming import shared_replica
+from src.openvpn import GATEWAY_CCD, GATEWAY_FIREWALL
 
 logger = get_logger("ctf_creator.host")
 
+KALI_IMAGE = "ghcr.io/emcl-research-itseclab/itsec-1-exercises:main-kali"
+SAVE_FIREWALL = "sudo sh -c 'iptables-save > /etc/iptables/rules.v4'"
+# Host firewall rules that protect all user networks and are never removed.
+SHARED_FIREWALL_RULES = ["INPUT -d 10.14.0.0/16 -j REJECT"]
+
+
+def firewall_rules(openvpn_port: int, subnet: IPv4Network | IPv6Network) -> List[str]:
+    """
+    Returns the host firewall rules of a user network as iptables rule specifications.
+    """
+    return [
+        f"DOCKER-USER -s {str(subnet.network_address + 2)} -p udp --dport {openvpn_port} -j ACCEPT",
+        # f"DOCKER-USER -s {str(subnet.network_address)}/24 -j REJECT --reject-with icmp-port-unreachable",
+        f"DOCKER-USER -s {str(subnet.network_address)}/24 -m state --state RELATED,ESTABLISHED -j RETURN",
+        f"INPUT -d {str(subnet.network_address + 1)} -j REJECT",
+        f"FORWARD -d {str(subnet.network_address + 1)} -j REJECT",
+    ]
+
 
 class Host:
-    def __init__(self, host: dict, save_path: str) -> None:
+    def __init__(self, host: dict, save_path: str, inventory: dict = None) -> None:
+        """
+        Checks the connection to the host and lists its containers and networks.
+
+        Args:
+            host (dict): The host entry of the YAML configuration.
+            save_path (str): The path of the user data.
+            inventory (dict, optional): A fresh inventory of the host, see
+                plan.read_inventory. The checks and the listing are then skipped.
+        """
         self.host = host
         self.username = host.get("username")
         self.ip = ip_address(host.get("ip"))
@@ -27,21 +58,36 @@ class Host:
         if not os.path.isfile(self.identify_path):
             raise FileNotFoundError(f"Identity file not found: {self.identify_path}.")
 
-        self._check_reachability()
-        self._check_ssh()
-        self._add_ssh_identity()
+        if inventory is None:
+            self._check_reachability()
+            self._check_ssh()
+            self._add_ssh_identity()
 
         self.docker = Docker(host=host)
         self.save_path = save_path
+        # Guards the container list and pool claims, a host is shared by the workers.
+        self.lock = threading.Lock()
+        if inventory is None:
+            self.refresh()
+        else:
+            self.containers = list(inventory["containers"])
+            self.networks = list(inventory["networks"])
+            self.shared_networks = {}
+
+    def refresh(self) -> None:
+        """Lists the containers and networks again, e.g. after other processes deployed."""
         output, _ = self._execute_ssh_command(
             command="docker ps -a --format '{{.Names}}'"
         )
-        self.containers = output.replace("\r", "").split("\n")
-        logger.info(f"Running containers: {self.containers}")
+        containers = output.replace("\r", "").split("\n")
+        logger.info(f"Running containers: {containers}")
         output, _ = self._execute_ssh_command(
             command="docker network ls --format '{{.Name}}'"
         )
-        self.networks = output.replace("\r", "").split("\n")
+        with self.lock:
+            self.containers = containers
+            self.networks = output.replace("\r", "").split("\n")
+            self.shared_networks = {}
 
     def _check_reachability(self):
         """
@@ -156,15 +202,24 @@ class Host:
         )
         logger.info("Clean up process on hosts finished!")
 
-    def send_and_extract_tar(self, user: str) -> None:
+    def send_and_extract_tar(
+        self, user: str, local_dir: str = None, remote_base: str = None
+    ) -> None:
         """
         Sends a tar file to a remote host via SSH and extracts it.
 
+        Args:
+            user (str): Name of the user.
+            local_dir (str, optional): Local folder holding the data, defaults to the user data.
+            remote_base (str, optional): Remote folder for the data, defaults to the user folder.
+
         Raises:
             PermissionError: If there is a permission issue on the remote host.
         """
-        tar_file_path = f"{self.save_path}/data/{user}/dockovpn_data.tar"
-        remote_path = f"/home/{self.username}/ctf-data/{user}/dock_vpn_data.tar"
+        local_dir = local_dir or f"{self.save_path}/data/{user}"
+        remote_base = remote_base or f"/home/{self.username}/ctf-data/{user}"
+        tar_file_path = f"{local_dir}/dockovpn_data.tar"
+        remote_path = f"{remote_base}/dock_vpn_data.tar"
 
         # Create an SSH client
         ssh = SSHClient()
@@ -181,9 +236,7 @@ class Host:
             ssh.connect(str(self.ip), port=22, username=self.username)
 
             # Extract the remote directory path
-            remote_dir = os.path.dirname(
-                f"/home/{self.username}/ctf-data/{user}/Dockovpn_data/"
-            )
+            remote_dir = f"{remote_base}/Dockovpn_data"
 
             # Ensure the remote directory exists
             logger.info(f"Ensuring the remote directory {remote_dir} exists...")
@@ -200,6 +253,9 @@ class Host:
             logger.info(f"Copying {tar_file_path} to {self.ip}:{remote_path}...")
             sftp = ssh.open_sftp()
             sftp.put(tar_file_path, remote_path)
+            self._send_server_files(
+                sftp=sftp, local_dir=local_dir, remote_base=remote_base
+            )
             sftp.close()
 
             logger.info(
@@ -232,6 +288,80 @@ class Host:
             logger.info("Closing the SSH connection...")
             ssh.close()
 
+    def _send_server_files(self, sftp, local_dir: str, remote_base: str) -> None:
+        """
+        Copies the rendered OpenVPN server files and, for a gateway, its client-config-dir
+        to the host.
+        """
+        for folder in ("server", "ccd"):
+            if not os.path.isdir(f"{local_dir}/{folder}"):
+                continue
+            try:
+                sftp.mkdir(f"{remote_base}/{folder}")
+            except IOError:
+                logger.debug(f"Remote directory {remote_base}/{folder} already exists.")
+            for file_name in os.listdir(f"{local_dir}/{folder}"):
+                sftp.put(
+                    f"{local_dir}/{folder}/{file_name}",
+                    f"{remote_base}/{folder}/{file_name}",
+                )
+        sftp.chmod(f"{remote_base}/server/start.sh", 0o755)
+
+    def _sftp_makedirs(self, sftp, path: str) -> None:
+        current = ""
+        for folder in path.strip("/").split("/"):
+            current = f"{current}/{folder}"
+            try:
+                sftp.stat(current)
+            except IOError:
+                sftp.mkdir(current)
+
+    def run_agent(self, plan: dict, uploads: List[tuple]) -> Iterator[dict]:
+        """
+        Uploads the host agent and the user data in one SSH session and lets the agent apply
+        the plan on the host. The results of the agent are yielded as they arrive.
+
+        Args:
+            plan (dict): The plan as described in agent.py.
+            uploads (list): Tuples of local and remote paths copied before the plan runs.
+
+        Yields:
+            dict: One result per applied step.
+        """
+        remote_agent = f"/home/{self.username}/ctf-data/agent.py"
+
+        ssh = SSHClient()
+        ssh.load_system_host_keys()
+        ssh.set_missing_host_key_policy(AutoAddPolicy())
+
+        try:
+            ssh.connect(str(self.ip), port=22, username=self.username)
+
+            logger.info(f"Copying agent and {len(uploads)} files to {self.ip}...")
+            sftp = ssh.open_sftp()
+            self._sftp_makedirs(sftp=sftp, path=os.path.dirname(remote_agent))
+            sftp.put(
+                f"{os.path.dirname(os.path.realpath(__file__))}/agent.py", remote_agent
+            )
+            for local_path, remote_path in uploads:
+                self._sftp_makedirs(sftp=sftp, path=os.path.dirname(remote_path))
+                sftp.put(local_path, remote_path)
+                if os.access(local_path, os.X_OK):
+                    sftp.chmod(remote_path, 0o755)
+            sftp.close()
+
+            stdin, stdout, stderr = ssh.exec_command(f"python3 {remote_agent}")
+            stdin.write(json.dumps(plan))
+            stdin.channel.shutdown_write()
+            for line in stdout:
+                yield json.loads(line)
+
+            error = stderr.read().decode().strip()
+            if error:
+                logger.error(f"Agent on {self.ip} failed: {error}")
+        finally:
+            ssh.close()
+
     def get_container(self, user, container):
         user_filtered = re.sub("[^A-Za-z0-9]+", "", user)
         try:
@@ -271,7 +401,7 @@ class Host:
             pcontainer = self.docker.client.containers.get(
                 f"{user_filtered}_{container}"
             )
-            pcontainer.remove(force=True)
+            self.docker.call(pcontainer.remove, force=True)
         except APIError as e:
             logger.warning(
                 f"Container {user_filtered}_{container} not found on host {self.ip}."
@@ -284,20 +414,77 @@ class Host:
             for test_container in self.containers:
                 if f"{user_filtered}_main-" in test_container:
                     pcontainer = self.docker.client.containers.get(test_container)
-                    pcontainer.stop()
-                    pcontainer.remove(force=True)
+                    self.docker.call(pcontainer.stop)
+                    self.docker.call(pcontainer.remove, force=True)
         except APIError as e:
             logger.warning(f"Container {user_filtered} not found on host {self.ip}.")
             logger.warning(f"Error {e}.")
 
-    def network_remove(self, user):
+    def network_remove(self, user, strict: bool = False):
+        """
+        Removes the network of a user. Failures are only logged, unless strict is set.
+
+        Raises:
+            APIError: If strict is set and an existing network could not be removed.
+        """
         user_filtered = re.sub("[^A-Za-z0-9]+", "", user)
         try:
             network = self.docker.client.networks.get(f"{user_filtered}_network")
-            network.remove()
-        except APIError as e:
+            for container in network.attrs.get("Containers", {}).values():
+                # Shared challenges outlive the network of a user.
+                if container["Name"].startswith("shared_"):
+                    self.docker.call(network.disconnect, container["Name"], force=True)
+            self.docker.call(network.remove)
+        except NotFound:
             logger.warning(f"Network {user_filtered}_network not found.")
-            logger.warning(f"Error {e}.")
+        except APIError as e:
+            logger.warning(f"Could not remove {user_filtered}_network: {e}.")
+            if strict:
+                raise
+
+    def user_containers(self, user: str) -> list:
+        """
+        Returns the containers labelled with the user and those named with its prefix, like
+        the containers of older versions and claimed pool containers without labels.
+        """
+        prefix = f"{re.sub('[^A-Za-z0-9]+', '', user)}_"
+        containers = {
+            c.id: c
+            for c in self.docker.client.containers.list(
+                all=True, filters={"label": f"{LABEL_USER}={user}"}
+            )
+        }
+        for container in self.docker.client.containers.list(
+            all=True, filters={"name": prefix}
+        ):
+            # The name filter matches anywhere in the name.
+            if container.name.startswith(prefix):
+                containers[container.id] = container
+        return list(containers.values())
+
+    def user_remove(self, user: str, gateway: bool = False) -> None:
+        """
+        Removes all containers of the user and the network of the user. A gateway is
+        disconnected from the network first.
+
+        Raises:
+            APIError: If a container or the network could not be removed.
+        """
+        for container in self.user_containers(user=user):
+            self.docker.call(container.remove, force=True)
+            with self.lock:
+                if container.name in self.containers:
+                    self.containers.remove(container.name)
+        if gateway and self.gateway_exists():
+            user_filtered = re.sub("[^A-Za-z0-9]+", "", user)
+            try:
+                self.docker.client.networks.get(f"{user_filtered}_network").disconnect(
+                    "gateway_openvpn", force=True
+                )
+            except APIError as e:
+                logger.warning(f"Error {e}.")
+        self.network_remove(user=user, strict=True)
+        logger.info(f"Removed user {user} from host {self.ip}")
 
     def create_network(
         self,
@@ -311,60 +498,391 @@ class Host:
             gateway_=str(subnet.network_address + 1),
         )
 
-    def start_openvpn(
+    def _labels(self, user: str, role: str) -> dict:
+        return {LABEL_USER: user, LABEL_ROLE: role}
+
+    def openvpn_spec(
         self,
         user: str,
         openvpn_port: int,
         subnet: IPv4Network | IPv6Network,
-    ):
+    ) -> dict:
         user_filtered = re.sub("[^A-Za-z0-9]+", "", user)
-        self.docker.create_openvpn_server(
+        return self.docker.openvpn_spec(
             host_address=str(subnet.network_address + 2),
             network_name=f"{user_filtered}_network",
             container_name=f"{user_filtered}_openvpn",
             openvpn_port=openvpn_port,
             mount_path=f"/home/{self.username}/ctf-data/{user}/Dockovpn_data/",
+            server_path=f"/home/{self.username}/ctf-data/{user}/server",
+            labels=self._labels(user=user, role="openvpn"),
         )
 
-        self.docker.modify_ovpn_server(user=user_filtered, subnet=subnet)
-        commands = [
-            f"sudo iptables -C DOCKER-USER -s {str(subnet.network_address + 2)} -p udp --dport {openvpn_port} -j ACCEPT || sudo iptables --insert DOCKER-USER -s {str(subnet.network_address + 2)} -p udp --dport {openvpn_port} -j ACCEPT",
-            # f"sudo iptables -C DOCKER-USER -s {str(subnet.network_address)}/24 -j REJECT --reject-with icmp-port-unreachable || sudo iptables --insert DOCKER-USER -s {str(subnet.network_address)}/24 -j REJECT --reject-with icmp-port-unreachable",
-            f"sudo iptables -C DOCKER-USER -s {str(subnet.network_address)}/24 -m state --state RELATED,ESTABLISHED -j RETURN || sudo iptables --insert DOCKER-USER -s {str(subnet.network_address)}/24 -m state --state RELATED,ESTABLISHED -j RETURN",
-            f"sudo iptables -C INPUT -d {str(subnet.network_address + 1)} -j REJECT || sudo iptables -I INPUT -d {str(subnet.network_address + 1)} -j REJECT",
-            f"sudo iptables -C FORWARD -d {str(subnet.network_address + 1)} -j REJECT || sudo iptables -I FORWARD -d {str(subnet.network_address + 1)} -j REJECT",
-            f"sudo iptables -C INPUT -d 10.14.0.0/16 -j REJECT || sudo iptables -I INPUT -d 10.14.0.0/16 -j REJECT",
-            "sudo sh -c 'iptables-save > /etc/iptables/rules.v4'",
+    def start_openvpn(
+        self,
+        user: str,
+        openvpn_port: int,
+        subnet: IPv4Network | IPv6Network,
+        firewall: bool = True,
+    ):
+        self.docker.run_spec(
+            self.openvpn_spec(user=user, openvpn_port=openvpn_port, subnet=subnet)
+        )
+
+        if firewall:
+            self.apply_firewall(openvpn_port=openvpn_port, subnet=subnet)
+
+    def firewall_rules(
+        self, openvpn_port: int, subnet: IPv4Network | IPv6Network
+    ) -> List[str]:
+        return firewall_rules(openvpn_port=openvpn_port, subnet=subnet)
+
+    def firewall_commands(
+        self, openvpn_port: int, subnet: IPv4Network | IPv6Network
+    ) -> List[str]:
+        """
+        Returns the idempotent host firewall commands of a user network. Persisting the
+        rules is left to the caller, so it can be done once for many users.
+        """
+        rules = self.firewall_rules(openvpn_port=openvpn_port, subnet=subnet)
+        return [
+            f"sudo iptables -C {rule} || sudo iptables -I {rule}"
+            for rule in rules + SHARED_FIREWALL_RULES
         ]
+
+    def firewall_remove_commands(
+        self, openvpn_port: int, subnet: IPv4Network | IPv6Network
+    ) -> List[str]:
+        """
+        Returns the commands deleting the host firewall rules of a user network, including
+        duplicates. The rules shared by all users stay.
+        """
+        return [
+            f"while sudo iptables -D {rule} 2>/dev/null; do :; done"
+            for rule in self.firewall_rules(openvpn_port=openvpn_port, subnet=subnet)
+        ]
+
+    def apply_firewall(self, openvpn_port: int, subnet: IPv4Network | IPv6Network):
+        """
+        Inserts the host firewall rules of a user network if they do not exist yet.
+        """
+        commands = self.firewall_commands(openvpn_port=openvpn_port, subnet=subnet)
+        commands.append(SAVE_FIREWALL)
         for command in commands:
             self._execute_ssh_command(command)
 
-    def start_container(
+    def gateway_exists(self) -> bool:
+        return "gateway_openvpn" in self.containers
+
+    def send_gateway_data(self) -> None:
+        """
+        Sends the Dockovpn data, server files and client-config-dir of the gateway.
+        """
+        self.send_and_extract_tar(
+            user="gateway",
+            local_dir=f"{self.save_path}/gateway/{self.ip}",
+            remote_base=f"/home/{self.username}/ctf-data/gateway",
+        )
+
+    def start_gateway(
+        self,
+        user: str,
+        openvpn_port: int,
+        subnet: IPv4Network | IPv6Network,
+    ):
+        """
+        Starts the shared OpenVPN gateway of the host, or connects it to the user network
+        if it is already running, and allows the user's tunnel address to its subnet.
+        """
+        user_filtered = re.sub("[^A-Za-z0-9]+", "", user)
+        remote_base = f"/home/{self.username}/ctf-data/gateway"
+        if not self.gateway_exists():
+            self.docker.create_openvpn_server(
+                host_address=str(subnet.network_address + 2),
+                network_name=f"{user_filtered}_network",
+                container_name="gateway_openvpn",
+                openvpn_port=openvpn_port,
+                mount_path=f"{remote_base}/Dockovpn_data/",
+                server_path=f"{remote_base}/server",
+                extra_volumes=[
+                    f"{remote_base}/server/firewall.sh:{GATEWAY_FIREWALL}:ro",
+                    f"{remote_base}/ccd:{GATEWAY_CCD}:ro",
+                ],
+                mem_limit="1g",
+                cpu_quota=100000,
+                labels=self._labels(user="gateway", role="openvpn"),
+            )
+            with self.lock:
+                self.containers.append("gateway_openvpn")
+        else:
+            self.docker.connect_network(
+                container_name="gateway_openvpn",
+                network_name=f"{user_filtered}_network",
+                host_address=str(subnet.network_address + 2),
+            )
+            self.docker.call(
+                self.docker.client.containers.get("gateway_openvpn").exec_run,
+                cmd=f"sh {GATEWAY_FIREWALL}",
+            )
+        if "gateway_openvpn" in self.shared_networks:
+            self.shared_networks["gateway_openvpn"].add(f"{user_filtered}_network")
+
+        self.apply_firewall(openvpn_port=openvpn_port, subnet=subnet)
+
+    def remove_firewall(self, rules: List[str]) -> None:
+        """Deletes host firewall rules, including duplicates, and persists the rules."""
+        commands = [
+            f"while sudo iptables -D {rule} 2>/dev/null; do :; done" for rule in rules
+        ]
+        self._execute_ssh_command("; ".join(commands + [SAVE_FIREWALL]))
+
+    def openvpn_memory(self) -> int:
+        """
+        Returns the memory used by all OpenVPN servers on this host in bytes.
+        """
+        containers = self.docker.client.containers.list(
+            sparse=True, filters={"name": "_openvpn"}
+        )
+        return sum(
+            self.docker.container_memory(container_name=con.id) for con in containers
+        )
+
+    def container_spec(
         self,
         user: str,
         container: dict,
         subnet: IPv4Network | IPv6Network,
         index: int,
         environment: dict,
-    ) -> None:
+    ) -> dict:
         user_filtered = re.sub("[^A-Za-z0-9]+", "", user)
         environment["USER_FILTERED"] = user_filtered
-        self.docker.create_container(
+        return self.docker.container_spec(
             environment=environment,
             container_name=f"{user_filtered}_{container['name']}",
             network_name=f"{user_filtered}_network",
             image=container["image"],
             host_address=str(subnet.network_address + index),
+            labels=self._labels(user=user, role=container["name"]),
+            # Pooled challenges also read their environment from /ctf.
+            files=env_files(environment=environment) if container.get("pool") else None,
         )
 
-    def start_kali(
-        self, user: str, subnet: IPv4Network | IPv6Network, index: int, command: list
+    def start_container(
+        self,
+        user: str,
+        container: dict,
+        subnet: IPv4Network | IPv6Network,
+        index: int,
+        environment: dict,
+    ) -> None:
+        self.docker.run_spec(
+            self.container_spec(
+                user=user,
+                container=container,
+                subnet=subnet,
+                index=index,
+                environment=environment,
+            )
+        )
+
+    def reset_container(self, spec: dict) -> float:
+        """
+        Replaces a challenge or Kali container of a user by a pristine one built from its
+        specification, see container_spec and kali_spec.
+
+        Returns:
+            float: The downtime of the container in seconds.
+        """
+        downtime = self.docker.replace_container(spec=spec)
+        with self.lock:
+            if spec["name"] not in self.containers:
+                self.containers.append(spec["name"])
+        return downtime
+
+    def pool_containers(self, container: dict) -> List[str]:
+        prefix = f"pool_{container['name']}_"
+        return [con for con in self.containers if con.startswith(prefix)]
+
+    def fill_pool(self, container: dict, size: int) -> None:
+        """
+        Tops up the warm pool of pre-created containers for a challenge on this host.
+
+        Args:
+            container (dict): The challenge entry of the YAML configuration.
+            size (int): The number of pool containers to keep on this host.
+        """
+        existing = self.pool_containers(container=container)
+        index = 0
+        while len(existing) < size:
+            pool_name = f"pool_{container['name']}_{index}"
+            index += 1
+            if pool_name in existing:
+                continue
+            self.docker.create_pool_container(
+                container_name=pool_name,
+                image=container["image"],
+                labels={LABEL_ROLE: container["name"]},
+            )
+            existing.append(pool_name)
+            with self.lock:
+                self.containers.append(pool_name)
+        logger.info(
+            f"Pool for {container['name']} on host {self.ip} holds {len(existing)} containers"
+        )
+
+    def claim_pool_container(
+        self,
+        user: str,
+        container: dict,
+        subnet: IPv4Network | IPv6Network,
+        index: int,
+        environment: dict,
+    ) -> bool:
+        """
+        Starts a challenge for the user from the warm pool.
+
+        Returns:
+            bool: True if a pool container was claimed, False if the pool is empty.
+        """
+        pool_name = self.take_pool_container(container=container)
+        if pool_name is None:
+            logger.info(f"Pool for {container['name']} on host {self.ip} is empty")
+            return False
+
+        spec = self.container_spec(
+            user=user,
+            container=container,
+            subnet=subnet,
+            index=index,
+            environment=environment,
+        )
+        # A failed claim removes the pool container, so it is not put back.
+        self.docker.claim_pool_container(pool_name=pool_name, spec=spec)
+        with self.lock:
+            self.containers.append(spec["name"])
+        return True
+
+    def take_pool_container(self, container: dict) -> str | None:
+        """
+        Takes a pool container of the challenge off the container list, so it is claimed
+        only once.
+
+        Returns:
+            str | None: The name of the pool container, None if the pool is empty.
+        """
+        with self.lock:
+            pool = self.pool_containers(container=container)
+            if not pool:
+                return None
+            self.containers.remove(pool[0])
+            return pool[0]
+
+    def start_shared(self, container: dict, environment: dict) -> List[str]:
+        """
+        Starts the missing instances of a challenge shared by all users of this host.
+
+        Args:
+            container (dict): The challenge entry of the YAML configuration.
+            environment (dict): The environment of the instances.
+
+        Returns:
+            List[str]: The names of the instances.
+        """
+        names = [f"shared_{container['name']}_{i}" for i in range(container["shared"])]
+        for name in names:
+            if name in self.containers:
+                continue
+            self.docker.create_shared_container(
+                container_name=name,
+                image=container["image"],
+                environment=environment,
+                labels={LABEL_ROLE: f"shared_{container['name']}"},
+            )
+            with self.lock:
+                self.containers.append(name)
+        return names
+
+    def attached(self, container_name: str, user: str) -> bool:
+        """
+        True if a container serving many users, a shared instance or the gateway, is
+        connected to the network of the user. The networks are inspected once per
+        container.
+        """
+        if container_name not in self.containers:
+            return False
+        if container_name not in self.shared_networks:
+            attrs = self.docker.call(
+                self.docker.client.api.inspect_container, container_name
+            )
+            self.shared_networks[container_name] = set(
+                attrs["NetworkSettings"]["Networks"]
+            )
+        user_filtered = re.sub("[^A-Za-z0-9]+", "", user)
+        return f"{user_filtered}_network" in self.shared_networks[container_name]
+
+    def shared_attached(self, user: str, container: dict) -> bool:
+        """True if the shared instance serving the user is connected to its network."""
+        return self.attached(
+            container_name=shared_replica(user=user, container=container), user=user
+        )
+
+    def shared_spec(
+        self,
+        user: str,
+        container: dict,
+        subnet: IPv4Network | IPv6Network,
+        index: int,
+        flag: str,
+    ) -> dict:
+        """
+        Builds the attachment of the user to the shared instance of a challenge. The flag
+        and the user are written to /ctf/flags/<subnet> and /ctf/users/<subnet>, so the
+        challenge can answer with the flag of the requesting user based on its address.
+        """
+        user_filtered = re.sub("[^A-Za-z0-9]+", "", user)
+        return {
+            "name": f"{user_filtered}_{container['name']}",
+            "container": shared_replica(user=user, container=container),
+            "network": f"{user_filtered}_network",
+            "ip": str(subnet.network_address + index),
+            "files": {
+                f"ctf/flags/{subnet.network_address}": flag,
+                f"ctf/users/{subnet.network_address}": user,
+            },
+        }
+
+    def attach_shared(
+        self,
+        user: str,
+        container: dict,
+        subnet: IPv4Network | IPv6Network,
+        index: int,
+        flag: str,
     ) -> None:
+        spec = self.shared_spec(
+            user=user, container=container, subnet=subnet, index=index, flag=flag
+        )
+        self.docker.attach_shared(spec=spec)
+        if spec["container"] in self.shared_networks:
+            self.shared_networks[spec["container"]].add(spec["network"])
+
+    def kali_spec(
+        self, user: str, subnet: IPv4Network | IPv6Network, index: int, command: list
+    ) -> dict:
         user_filtered = re.sub("[^A-Za-z0-9]+", "", user)
-        self.docker.create_kali(
+        return self.docker.kali_spec(
             command=command,
             container_name=f"{user_filtered}_kali",
             network_name=f"{user_filtered}_network",
-            image="ghcr.io/emcl-research-itseclab/itsec-1-exercises:main-kali",
+            image=KALI_IMAGE,
             host_address=str(subnet.network_address + index),
+            labels=self._labels(user=user, role="kali"),
+        )
+
+    def start_kali(
+        self, user: str, subnet: IPv4Network | IPv6Network, index: int, command: list
+    ) -> None:
+        self.docker.run_spec(
+            self.kali_spec(user=user, subnet=subnet, index=index, command=command)
         )
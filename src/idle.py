@@ -0,0 +1,316 @@
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+from docker.errors import APIError
+from paramiko import SSHClient, AutoAddPolicy, SSHException
+
+sys.path.append(os.getcwd())
+from src.host import Host
+from src.log_config import get_logger
+from src.participant import Participant
+
+logger = get_logger("ctf_creator.idle")
+
+ACTIONS = ("stop", "pause")
+
+
+class IdleManager:
+    """
+    Suspends the challenge and Kali containers of users who are not connected to their
+    OpenVPN server and resumes them as soon as they connect.
+
+    Every OpenVPN server writes its connected clients to a status log in its mounted data
+    folder. The manager reads the logs of all users of a host with one command over a
+    persistent SSH connection and the container states with one Docker call per round.
+    Stopped containers free their memory, paused ones only their CPU but resume faster.
+    """
+
+    def __init__(
+        self,
+        hosts: List[Host],
+        users: List[Participant],
+        challenges: List[str],
+        save_path: str,
+        idle_timeout: int = 3600,
+        action: str = "stop",
+        interval: float = 1.0,
+        on_connect: Callable[[Participant, Host, dict, float], None] = None,
+    ) -> None:
+        self.hosts = hosts
+        self.challenges = challenges + ["kali"]
+        self.idle_timeout = idle_timeout
+        self.action = action
+        self.interval = interval
+        self.on_connect = on_connect
+        self.state_path = f"{save_path}/idle.json"
+        self.state = self._load_state()
+        self.ssh = {}
+        self.unmonitored = set()
+        self.connecting = set()
+        self.executor = ThreadPoolExecutor(max_workers=8)
+
+        self.users_by_host = {}
+        for user in users:
+            host = [h for h in hosts if str(h.ip) == str(user.ip)]
+            if host:
+                self.users_by_host.setdefault(host[0], []).append(user)
+
+        now = time.time()
+        for user in users:
+            # Users are not suspended right away when the manager starts.
+            self.state.setdefault(
+                user.name, {"last_seen": now, "suspended": False, "memory": 0}
+            )
+
+    def _load_state(self) -> dict:
+        if not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path, "r") as file:
+            return json.load(file)
+
+    def _save_state(self) -> None:
+        with open(f"{self.state_path}.part", "w") as file:
+            json.dump(self.state, file, indent=2)
+        os.replace(f"{self.state_path}.part", self.state_path)
+
+    def run(self, once: bool = False) -> None:
+        logger.info(
+            f"Watch {sum(len(u) for u in self.users_by_host.values())} users, "
+            f"{self.action} after {self.idle_timeout}s idle"
+        )
+        try:
+            while True:
+                start = time.monotonic()
+                self.poll()
+                if once:
+                    break
+                time.sleep(max(0, self.interval - (time.monotonic() - start)))
+        except KeyboardInterrupt:
+            logger.info("Idle manager stopped.")
+        finally:
+            self.executor.shutdown(wait=True)
+            self._save_state()
+            for ssh in self.ssh.values():
+                ssh.close()
+
+    def poll(self) -> None:
+        with ThreadPoolExecutor(max_workers=len(self.users_by_host) or 1) as executor:
+            futures = {
+                executor.submit(self._poll_host, host, users): host
+                for host, users in self.users_by_host.items()
+            }
+            for future, host in futures.items():
+                try:
+                    future.result()
+                except (APIError, SSHException, OSError) as e:
+                    logger.error(f"Idle check on host {host.ip} failed: {e}")
+        self._save_state()
+
+    def _client(self, host: Host) -> SSHClient:
+        if host not in self.ssh:
+            ssh = SSHClient()
+            ssh.load_system_host_keys()
+            ssh.set_missing_host_key_policy(AutoAddPolicy())
+            ssh.connect(str(host.ip), port=22, username=host.username)
+            self.ssh[host] = ssh
+        return self.ssh[host]
+
+    def _status(self, host: Host) -> Dict[str, Dict[str, float]]:
+        """
+        Returns the connected clients per status log folder, e.g. the user or gateway, with
+        the time each client connected. Folders without a status log are missing.
+        """
+        pattern = f"/home/{host.username}/ctf-data/*/Dockovpn_data/status.log"
+        command = (
+            f'sudo sh -c \'for f in {pattern}; do [ -f "$f" ] && echo "FILE $f" '
+            f'&& grep "^CLIENT_LIST," "$f"; done; true\''
+        )
+        try:
+            _, stdout, _ = self._client(host).exec_command(command, timeout=10)
+            output = stdout.read().decode()
+        except (SSHException, OSError):
+            ssh = self.ssh.pop(host, None)
+            if ssh:
+                ssh.close()
+            raise
+
+        status = {}
+        folder = None
+        for line in output.splitlines():
+            if line.startswith("FILE "):
+                folder = line.split("/")[-3]
+                status[folder] = {}
+            elif folder and line.startswith("CLIENT_LIST,"):
+                # CLIENT_LIST,<name>,<real>,<virtual>,<virtual v6>,<in>,<out>,<since>,<since time_t>,...
+                fields = line.split(",")
+                since = (
+                    float(fields[8])
+                    if len(fields) > 8 and fields[8].isdigit()
+                    else None
+                )
+                status[folder][fields[1]] = since
+        return status
+
+    def _connected(self, user: Participant, status: Dict[str, Dict[str, float]]):
+        """
+        Returns the time the user connected, False if not connected, or None if the OpenVPN
+        server of the user has no status log.
+        """
+        if user.gateway:
+            if "gateway" not in status:
+                return None
+            client_ids = [user.metadata.get("client_id")]
+            client_ids += user.metadata.get("member_clients", [])
+            since = [status["gateway"][c] for c in client_ids if c in status["gateway"]]
+            if not since:
+                return False
+            return min(s or time.time() for s in since)
+        if user.name not in status:
+            return None
+        if not status[user.name]:
+            return False
+        return min(s or time.time() for s in status[user.name].values())
+
+    def _openvpn_running(self, user: Participant, containers: dict) -> bool:
+        user_filtered = re.sub("[^A-Za-z0-9]+", "", user.name)
+        name = "gateway_openvpn" if user.gateway else f"{user_filtered}_openvpn"
+        return name in containers and containers[name]["State"] == "running"
+
+    def _poll_host(self, host: Host, users: List[Participant]) -> None:
+        status = self._status(host=host)
+        containers = {
+            c["Names"][0].lstrip("/"): c
+            for c in host.docker.call(host.docker.client.api.containers, all=True)
+        }
+
+        now = time.time()
+        resume = []
+        suspend = []
+        for user in users:
+            connected = self._connected(user=user, status=status)
+            if connected and not self._openvpn_running(
+                user=user, containers=containers
+            ):
+                # The status log of a dead OpenVPN server still lists its last clients.
+                connected = False
+            if connected is None:
+                if user.name not in self.unmonitored:
+                    self.unmonitored.add(user.name)
+                    logger.warning(
+                        f"No OpenVPN status log for {user.name}, recreate its OpenVPN "
+                        f"server with freshly rendered server files to monitor it."
+                    )
+                continue
+            state = self.state[user.name]
+            if connected:
+                state["last_seen"] = now
+                if self.on_connect and user.name not in self.connecting:
+                    self.connecting.add(user.name)
+                    self.executor.submit(
+                        self._connect, host, user, containers, connected
+                    )
+                if state["suspended"]:
+                    resume.append(user)
+            elif (
+                not state["suspended"] and now - state["last_seen"] > self.idle_timeout
+            ):
+                suspend.append(user)
+
+        if not resume and not suspend:
+            return
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for user in resume:
+                executor.submit(self._resume, host, user, containers)
+            for user in suspend:
+                executor.submit(self._suspend, host, user, containers)
+
+        suspended = [u for u in users if self.state[u.name]["suspended"]]
+        memory = sum(self.state[u.name]["memory"] for u in suspended) / (1024 * 1024)
+        kind = "reclaimed" if self.action == "stop" else "held by paused containers"
+        logger.info(
+            f"Host {host.ip}: {len(suspended)} of {len(users)} users suspended, "
+            f"{memory:.0f} MiB {kind}"
+        )
+
+    def _connect(
+        self, host: Host, user: Participant, containers: dict, since: float
+    ) -> None:
+        """Runs the connect callback in the background, so the polling is not blocked."""
+        try:
+            self.on_connect(user=user, host=host, containers=containers, since=since)
+        except Exception as e:
+            logger.error(f"Connect handling of {user.name} failed: {e}")
+        finally:
+            self.connecting.discard(user.name)
+
+    def _user_containers(self, user: Participant, containers: dict) -> List[str]:
+        user_filtered = re.sub("[^A-Za-z0-9]+", "", user.name)
+        names = [f"{user_filtered}_{c}" for c in self.challenges]
+        return [n for n in names if n in containers]
+
+    def _suspend(self, host: Host, user: Participant, containers: dict) -> None:
+        docker = host.docker
+        memory = 0
+        restart = self.state[user.name].setdefault("restart", {})
+        try:
+            for name in self._user_containers(user=user, containers=containers):
+                if containers[name]["State"] != "running":
+                    continue
+                memory += docker.container_memory(container_name=name)
+                if self.action == "pause":
+                    docker.call(docker.client.api.pause, name)
+                else:
+                    attrs = docker.call(docker.client.api.inspect_container, name)
+                    policy = attrs["HostConfig"]["RestartPolicy"]["Name"]
+                    if policy != "unless-stopped":
+                        restart[name] = policy
+                    # Manually stopped containers stay stopped if the daemon restarts.
+                    docker.call(
+                        docker.client.api.update_container,
+                        name,
+                        restart_policy={"Name": "unless-stopped"},
+                    )
+                    docker.call(docker.client.api.stop, name, timeout=5)
+        except APIError as e:
+            logger.error(f"Could not suspend {user.name}: {e}")
+            return
+        self.state[user.name].update(suspended=True, memory=memory)
+        logger.info(f"Suspended idle user {user.name} on host {host.ip}")
+
+    def _resume(self, host: Host, user: Participant, containers: dict) -> None:
+        docker = host.docker
+        start = time.monotonic()
+        restart = self.state[user.name].get("restart")
+        if restart is None:
+            # Suspended before the policies were kept, all containers are deployed with always.
+            restart = {
+                n: "always"
+                for n in self._user_containers(user=user, containers=containers)
+                if containers[n]["State"] in ("exited", "created")
+            }
+        try:
+            for name in self._user_containers(user=user, containers=containers):
+                state = containers[name]["State"]
+                if state == "paused":
+                    docker.call(docker.client.api.unpause, name)
+                elif state in ("exited", "created"):
+                    docker.call(docker.client.api.start, name)
+                if name in restart:
+                    # Restore the policy the container had before it was stopped.
+                    docker.call(
+                        docker.client.api.update_container,
+                        name,
+                        restart_policy={"Name": restart[name]},
+                    )
+        except APIError as e:
+            logger.error(f"Could not resume {user.name}: {e}")
+            return
+        self.state[user.name].update(suspended=False, memory=0, restart={})
+        logger.info(
+            f"Resumed {user.name} on host {host.ip} in {time.monotonic() - start:.2f}s"
+        )
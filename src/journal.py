@@ -0,0 +1,138 @@
+import json
+import os
+import sys
+import threading
+import time
+from typing import Set
+
+sys.path.append(os.getcwd())
+from src.log_config import get_logger
+
+logger = get_logger("ctf_creator.journal")
+
+DATA_GENERATED = "data_generated"
+DATA_UPLOADED = "data_uploaded"
+NETWORK = "network"
+OPENVPN = "openvpn"
+FIREWALL = "firewall"
+KALI = "kali"
+RESET = "reset"
+# Size in bytes after which the journal is compacted while a run is going on.
+COMPACT_SIZE = 64 * 1024 * 1024
+
+
+def container_step(name: str) -> str:
+    return f"container:{name}"
+
+
+class Journal:
+    """
+    Append-only journal of the completed deployment steps of every user.
+
+    Every step is written as one JSON line and synced to disk before the deployment goes
+    on, so after a crash the journal tells which steps finished without asking the hosts.
+    A reset entry discards the deployment steps recorded before it, the generated data of
+    a user stays valid.
+
+    The journal is compacted to the current steps of every user when it is closed or grows
+    beyond COMPACT_SIZE. Processes that share the journal with others set compact to False,
+    because the compacted file replaces the one they append to.
+
+    A read-only journal neither reads nor writes the file and only keeps the steps of its
+    own process in memory, for commands that run next to a deployment.
+    """
+
+    def __init__(self, save_path: str, read_only: bool = False) -> None:
+        self.path = f"{save_path}/journal.jsonl"
+        self.lock = threading.Lock()
+        self.steps = {}
+        self.compact = True
+        self.read_only = read_only
+        if read_only:
+            return
+        self._load()
+        os.makedirs(save_path, exist_ok=True)
+        self.file = open(self.path, "a")
+        if self.file.tell() > 0 and not self._ends_with_newline():
+            # Terminate a cut off line, so the next entry starts on its own line.
+            self.file.write("\n")
+            self.file.flush()
+
+    def _ends_with_newline(self) -> bool:
+        with open(self.path, "rb") as file:
+            file.seek(-1, os.SEEK_END)
+            return file.read(1) == b"\n"
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as file:
+            for number, line in enumerate(file, start=1):
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line is cut off if the process died while writing it.
+                    logger.warning(f"Skip damaged journal line {number}.")
+                    continue
+                self._apply(user=entry["user"], step=entry["step"])
+
+    def reload(self) -> None:
+        """Reads the steps again, after other processes appended to the journal."""
+        with self.lock:
+            self.steps = {}
+            self._load()
+
+    def _apply(self, user: str, step: str) -> None:
+        steps = self.steps.setdefault(user, set())
+        if step == RESET:
+            steps.intersection_update({DATA_GENERATED})
+        else:
+            steps.add(step)
+
+    def record(self, user: str, step: str) -> None:
+        with self.lock:
+            if self.read_only:
+                self._apply(user=user, step=step)
+                return
+            self.file.write(
+                json.dumps({"time": time.time(), "user": user, "step": step}) + "\n"
+            )
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self._apply(user=user, step=step)
+            if self.compact and self.file.tell() > COMPACT_SIZE:
+                self._compact()
+
+    def _compact(self) -> None:
+        """Rewrites the journal with the current steps of every user."""
+        now = time.time()
+        with open(f"{self.path}.part", "w") as file:
+            for user, steps in self.steps.items():
+                for step in sorted(steps):
+                    file.write(
+                        json.dumps({"time": now, "user": user, "step": step}) + "\n"
+                    )
+            file.flush()
+            os.fsync(file.fileno())
+        self.file.close()
+        os.replace(f"{self.path}.part", self.path)
+        self.file = open(self.path, "a")
+
+    def reset(self, user: str) -> None:
+        self.record(user=user, step=RESET)
+
+    def done(self, user: str, step: str) -> bool:
+        with self.lock:
+            return step in self.steps.get(user, set())
+
+    def completed(self, user: str) -> Set[str]:
+        with self.lock:
+            return set(self.steps.get(user, set()))
+
+    def close(self) -> None:
+        with self.lock:
+            if self.read_only or self.file.closed:
+                return
+            if self.compact:
+                self._compact()
+            self.file.close()
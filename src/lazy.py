@@ -0,0 +1,54 @@
+import os
+import sys
+from typing import List
+
+sys.path.append(os.getcwd())
+from src.log_config import get_logger
+from src.participant import Participant
+
+logger = get_logger("ctf_creator.lazy")
+
+
+def percentile(values: List[float], percent: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def lazy_metrics(users: List[Participant], target: float) -> dict:
+    """
+    Summarizes the lazily deployed users: how many were materialized, how many never
+    connected and how long it took from the first connect until their challenges ran.
+    """
+    lazy = [u for u in users if u.metadata.get("lazy")]
+    materialized = [u for u in lazy if u.metadata.get("materialized_at")]
+    latencies = [
+        u.metadata["ready_seconds"]
+        for u in materialized
+        if u.metadata.get("ready_seconds") is not None
+    ]
+    metrics = {
+        "lazy": len(lazy),
+        "materialized": len(materialized),
+        "never_materialized": len(lazy) - len(materialized),
+        "above_target": len([l for l in latencies if l > target]),
+    }
+    if latencies:
+        metrics["p50"] = percentile(latencies, 50)
+        metrics["p95"] = percentile(latencies, 95)
+        metrics["max"] = max(latencies)
+    return metrics
+
+
+def log_lazy_metrics(users: List[Participant], target: float) -> None:
+    metrics = lazy_metrics(users=users, target=target)
+    message = (
+        f"Lazy users: {metrics['materialized']} of {metrics['lazy']} materialized, "
+        f"{metrics['never_materialized']} never materialized"
+    )
+    if "p50" in metrics:
+        message += (
+            f", connect to ready p50 {metrics['p50']:.1f}s, p95 {metrics['p95']:.1f}s, "
+            f"max {metrics['max']:.1f}s, {metrics['above_target']} above {target}s"
+        )
+    logger.info(message)
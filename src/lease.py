@@ -0,0 +1,193 @@
+import json
+import os
+import shlex
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from typing import List
+
+from docker.errors import APIError
+
+sys.path.append(os.getcwd())
+from src.host import Host, SAVE_FIREWALL
+from src.log_config import get_logger
+from src.participant import Participant
+from src.roster import Roster
+
+logger = get_logger("ctf_creator.lease")
+
+# Number of cleanup commands sent to a host with one SSH command.
+SSH_BATCH = 100
+
+
+def lease_expiry(value: date | datetime) -> float:
+    """Converts the expires value of the configuration, a date expires at its end."""
+    if not isinstance(value, datetime):
+        value = datetime.combine(value, datetime.max.time())
+    return value.timestamp()
+
+
+def retired_users(save_path: str) -> set:
+    path = f"{save_path}/retired"
+    return set(os.listdir(path)) if os.path.isdir(path) else set()
+
+
+def expired_participants(save_path: str, now: float = None) -> List[Participant]:
+    """Returns all users with data whose lease expired."""
+    now = now or time.time()
+    data_path = f"{save_path}/data"
+    if not os.path.isdir(data_path):
+        return []
+    users = []
+    for name in sorted(os.listdir(data_path)):
+        if not os.path.isfile(f"{data_path}/{name}/client.ovpn"):
+            continue
+        user = Participant(user=name, save_path=save_path)
+        if user.metadata.get("expires") and user.metadata["expires"] < now:
+            users.append(user)
+    return users
+
+
+class LeaseCollector:
+    """
+    Tears down the environments of users whose lease expired.
+
+    The hosts are handled in parallel. On each host the containers and networks of the
+    users are removed in parallel batches, then the firewall rules and remote data of many
+    users are removed with a single SSH command. The user data is moved to <save>/retired,
+    which returns the port and subnet of the user to the allocator of the next run.
+    """
+
+    def __init__(self, hosts: List[Host], save_path: str, batch_size: int = 16) -> None:
+        self.hosts = hosts
+        self.save_path = save_path
+        self.batch_size = batch_size
+
+    def collect(self, users: List[Participant]) -> List[str]:
+        start = time.monotonic()
+        by_host = {}
+        for user in users:
+            host = [h for h in self.hosts if str(h.ip) == str(user.ip)]
+            if not host:
+                logger.warning(
+                    f"Host {user.ip} of expired user {user.name} is unknown."
+                )
+                continue
+            by_host.setdefault(host[0], []).append(user)
+
+        retired = []
+        if by_host:
+            with ThreadPoolExecutor(max_workers=len(by_host)) as executor:
+                futures = [
+                    executor.submit(self.remove_from_host, host, host_users)
+                    for host, host_users in by_host.items()
+                ]
+                for future in futures:
+                    retired += future.result()
+
+        for user in [u for u in users if u.name in retired]:
+            self._retire_data(user=user)
+        roster = Roster(save_path=self.save_path)
+        roster.save(users=roster.load() - set(retired))
+
+        logger.info(
+            f"Retired {len(retired)} of {len(users)} expired users in "
+            f"{time.monotonic() - start:.1f}s"
+        )
+        return retired
+
+    def remove_from_host(self, host: Host, users: List[Participant]) -> List[str]:
+        """
+        Removes the containers, network, firewall rules and remote data of the users from
+        the host, without retiring their local data.
+
+        Returns:
+            List[str]: The users that were removed.
+        """
+        removed = []
+        with ThreadPoolExecutor(max_workers=self.batch_size) as executor:
+            futures = {
+                user.name: executor.submit(
+                    host.user_remove, user=user.name, gateway=user.gateway
+                )
+                for user in users
+            }
+            for name, future in futures.items():
+                try:
+                    future.result()
+                    removed.append(name)
+                except APIError as e:
+                    logger.error(f"Could not remove {name} from host {host.ip}: {e}")
+
+        commands = []
+        for user in [u for u in users if u.name in removed]:
+            commands += host.firewall_remove_commands(
+                openvpn_port=user.existing_openvpn_port, subnet=user.subnet
+            )
+            commands.append(
+                f"sudo rm -rf /home/{host.username}/ctf-data/{shlex.quote(user.name)}"
+            )
+            if user.gateway:
+                commands += self._gateway_remove_commands(host=host, user=user)
+        for index in range(0, len(commands), SSH_BATCH):
+            host._execute_ssh_command("; ".join(commands[index : index + SSH_BATCH]))
+        if commands:
+            host._execute_ssh_command(SAVE_FIREWALL)
+        return removed
+
+    def _gateway_remove_commands(self, host: Host, user: Participant) -> List[str]:
+        """
+        Removes the user from the client-config-dir and firewall of the gateway, so the
+        profile is rejected and the tunnel address can be issued again.
+        """
+        gateway_path = f"{self.save_path}/gateway/{host.ip}"
+        clients_path = f"{gateway_path}/clients.json"
+        clients = {}
+        if os.path.exists(clients_path):
+            with open(clients_path, "r") as file:
+                clients = json.load(file)
+
+        # The members of a team have their own gateway clients.
+        client_ids = [user.metadata.get("client_id")]
+        client_ids += user.metadata.get("member_clients", [])
+        rules = []
+        for client_id in client_ids:
+            tunnel_ip = clients.pop(client_id, {}).get(
+                "tunnel_ip", user.metadata.get("tunnel_ip")
+            )
+            rules.append(f"-s {tunnel_ip} -d {user.subnet} -j ACCEPT")
+            ccd_file = f"{gateway_path}/ccd/{client_id}"
+            if os.path.exists(ccd_file):
+                os.remove(ccd_file)
+        if os.path.exists(clients_path):
+            with open(clients_path, "w") as file:
+                json.dump(clients, file, indent=2)
+        firewall_path = f"{gateway_path}/server/firewall.sh"
+        if os.path.exists(firewall_path):
+            with open(firewall_path, "r") as file:
+                lines = [line for line in file if not any(r in line for r in rules)]
+            with open(firewall_path, "w") as file:
+                file.writelines(lines)
+
+        remote = f"/home/{host.username}/ctf-data/gateway"
+        firewall = f"{remote}/server/firewall.sh"
+        commands = []
+        for client_id, rule in zip(client_ids, rules):
+            commands += [
+                f"rm -f {remote}/ccd/{shlex.quote(client_id)}",
+                # Rewritten in place, the file is bind mounted into the gateway.
+                f"grep -vF -- {shlex.quote(rule)} {firewall} > {firewall}.tmp",
+                f"cat {firewall}.tmp > {firewall}",
+                f"rm -f {firewall}.tmp",
+                f"docker exec gateway_openvpn sh -c 'while iptables -D FORWARD {rule} 2>/dev/null; do :; done'",
+            ]
+        return commands
+
+    def _retire_data(self, user: Participant) -> None:
+        target = f"{self.save_path}/retired/{user.name}"
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        os.makedirs(f"{self.save_path}/retired", exist_ok=True)
+        os.replace(f"{self.save_path}/data/{user.name}", target)
@@ -0,0 +1,33 @@
+import re
+import zlib
+from typing import Dict
+
+# Labels of every container the CTF-Creator deploys.
+LABEL_USER = "ctf-creator.user"
+LABEL_ROLE = "ctf-creator.role"
+
+
+def filter_user(user: str) -> str:
+    """Returns the user name as used in container and network names."""
+    return re.sub("[^A-Za-z0-9]+", "", user)
+
+
+def shared_replica(user: str, container: dict) -> str:
+    """Returns the name of the shared instance of a challenge that serves the user."""
+    replica = zlib.crc32(user.encode()) % container["shared"]
+    return f"shared_{container['name']}_{replica}"
+
+
+def container_owner(name: str, labels: dict, users: Dict[str, str]) -> str | None:
+    """
+    Returns the user of a container by its user label. Containers without the label, like
+    those of older versions, belong to the user whose filtered name prefixes their name.
+
+    Args:
+        name (str): The name of the container.
+        labels (dict): The labels of the container.
+        users (Dict[str, str]): The users by their filtered name.
+    """
+    if labels.get(LABEL_USER):
+        return labels[LABEL_USER]
+    return users.get(name.split("_", 1)[0]) if "_" in name else None
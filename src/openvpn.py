@@ -0,0 +1,258 @@
+from ipaddress import IPv4Network, IPv6Network, ip_network
+import io
+import sys
+import os
+import tarfile
+
+from docker import DockerClient
+from docker.errors import ImageNotFound
+
+sys.path.append(os.getcwd())
+from src.log_config import get_logger
+
+logger = get_logger("ctf_creator.openvpn")
+
+OPENVPN_IMAGE = "alekslitvinenk/openvpn"
+SERVER_CONF = "/etc/openvpn/server.conf"
+START_SCRIPT = "/opt/Dockovpn/start.sh"
+MASQUERADE_LINE = (
+    "iptables -t nat -A POSTROUTING -s 10.8.0.0/24 -o $ADAPTER -j MASQUERADE"
+)
+GATEWAY_NETWORK = ip_network("10.8.0.0/16")
+GATEWAY_FIREWALL = "/opt/Dockovpn/firewall.sh"
+GATEWAY_CCD = "/etc/openvpn/ccd"
+# Written into the mounted Dockovpn_data folder, so the host can read it without an exec.
+STATUS_LOG = "/opt/Dockovpn_data/status.log"
+STATUS_INTERVAL = 1
+
+
+class TemplateError(Exception):
+    """Custom exception raised when the OpenVPN image files do not have the expected layout."""
+
+    pass
+
+
+def ensure_image(client: DockerClient) -> None:
+    """Pulls the OpenVPN image on the given Docker if it does not exist yet."""
+    try:
+        client.images.get(OPENVPN_IMAGE)
+    except ImageNotFound:
+        logger.warning(f"Try to pull Image {OPENVPN_IMAGE}. Could take some time.")
+        client.images.pull(OPENVPN_IMAGE)
+
+
+def fetch_templates(client: DockerClient) -> dict:
+    """
+    Reads the pristine server.conf and start.sh from the OpenVPN image.
+
+    The container is only created, never started, so nothing runs on the local Docker.
+
+    Args:
+        client (DockerClient): The local Docker client.
+
+    Returns:
+        dict: The file contents keyed by their path inside the image.
+    """
+    ensure_image(client=client)
+
+    templates = {}
+    container = client.containers.create(OPENVPN_IMAGE)
+    try:
+        for path in (SERVER_CONF, START_SCRIPT):
+            archive, _ = container.get_archive(path)
+            with tarfile.open(fileobj=io.BytesIO(b"".join(archive))) as tar:
+                member = tar.getmember(os.path.basename(path))
+                templates[path] = tar.extractfile(member).read().decode()
+    finally:
+        container.remove(force=True)
+    return templates
+
+
+def render_server_conf(original: str, subnet: IPv4Network | IPv6Network) -> str:
+    """
+    Renders the server.conf of a user OpenVPN server.
+
+    Only the route to the user subnet is pushed, redirecting the default gateway and DNS is
+    removed so the clients keep their own internet connection. The connected clients are
+    written to the status log every second.
+    """
+    lines = [
+        line
+        for line in original.splitlines()
+        if not line.startswith('push "redirect-gateway')
+        and not line.startswith('push "dhcp-option DNS')
+        and not line.startswith("status")
+    ]
+    lines += [
+        f'push "route {subnet.network_address} {subnet.netmask}"',
+        "route-nopull",
+        "pull-filter ignore redirect-gateway",
+        f"status {STATUS_LOG} {STATUS_INTERVAL}",
+        "status-version 2",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def render_start_script(original: str, subnet: IPv4Network | IPv6Network) -> str:
+    """
+    Renders the start.sh of a user OpenVPN server.
+
+    The firewall rules restricting the tunnel to the user subnet are inserted directly after
+    the NAT rule of the original script, so they are applied on every container start.
+
+    Raises:
+        TemplateError: If the NAT rule is not part of the original script.
+    """
+    firewall = [
+        f"iptables -A INPUT -s {subnet} -j ACCEPT",
+        f"iptables -A OUTPUT -d {subnet} -j ACCEPT",
+        "iptables -A INPUT -m state --state ESTABLISHED,RELATED -j ACCEPT",
+        "iptables -A OUTPUT -m state --state ESTABLISHED,RELATED -j ACCEPT",
+        "iptables -A INPUT -j DROP",
+        "iptables -A OUTPUT -j DROP",
+    ]
+    lines = []
+    found = False
+    for line in original.splitlines():
+        lines.append(line)
+        if line.strip() == MASQUERADE_LINE:
+            indent = line[: len(line) - len(line.lstrip())]
+            lines += [f"{indent}{rule}" for rule in firewall]
+            found = True
+
+    if not found:
+        raise TemplateError(f"No '{MASQUERADE_LINE}' line found in {START_SCRIPT}.")
+
+    return "\n".join(lines) + "\n"
+
+
+def write_server_files(
+    templates: dict, subnet: IPv4Network | IPv6Network, path: str
+) -> None:
+    """
+    Writes the rendered server.conf and start.sh of a user to the given directory.
+
+    Args:
+        templates (dict): The pristine files as returned by fetch_templates.
+        subnet (IPv4Network | IPv6Network): The subnet of the user.
+        path (str): The directory the files are written to.
+    """
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "server.conf"), "w") as file:
+        file.write(render_server_conf(templates[SERVER_CONF], subnet))
+    start_script = os.path.join(path, "start.sh")
+    with open(start_script, "w") as file:
+        file.write(render_start_script(templates[START_SCRIPT], subnet))
+    os.chmod(start_script, 0o755)
+
+
+def render_gateway_server_conf(original: str) -> str:
+    """
+    Renders the server.conf of the shared OpenVPN gateway of a host.
+
+    No route is pushed globally, every client gets its own subnet route and a fixed tunnel
+    address from its file in the client-config-dir. Unknown clients are rejected.
+    """
+    lines = [
+        line
+        for line in original.splitlines()
+        if not line.startswith('push "redirect-gateway')
+        and not line.startswith('push "dhcp-option DNS')
+        and not line.startswith("server ")
+        and not line.startswith("topology ")
+        and not line.startswith("status")
+    ]
+    lines += [
+        f"server {GATEWAY_NETWORK.network_address} {GATEWAY_NETWORK.netmask}",
+        "topology subnet",
+        f"client-config-dir {GATEWAY_CCD}",
+        "ccd-exclusive",
+        "route-nopull",
+        "pull-filter ignore redirect-gateway",
+        f"status {STATUS_LOG} {STATUS_INTERVAL}",
+        "status-version 2",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def render_gateway_start_script(original: str) -> str:
+    """
+    Renders the start.sh of the shared OpenVPN gateway of a host.
+
+    The gateway is attached to several user networks, so the NAT rule must not be bound to a
+    single adapter. Forwarding is dropped by default: firewall.sh allows the tunnel address
+    of a client to reach its own subnet, and connections between the user networks, e.g.
+    of a Kali container routing through the gateway, are dropped explicitly.
+
+    Raises:
+        TemplateError: If the NAT rule is not part of the original script.
+    """
+    lines = []
+    found = False
+    for line in original.splitlines():
+        if line.strip() != MASQUERADE_LINE:
+            lines.append(line)
+            continue
+        indent = line[: len(line) - len(line.lstrip())]
+        rules = [
+            "iptables -P FORWARD DROP",
+            f"iptables -t nat -A POSTROUTING -s {GATEWAY_NETWORK} -j MASQUERADE",
+            "iptables -A FORWARD -m state --state ESTABLISHED,RELATED -j ACCEPT",
+            f"sh {GATEWAY_FIREWALL}",
+            f"iptables -A FORWARD -s {GATEWAY_NETWORK} -j DROP",
+            f"iptables -A FORWARD ! -s {GATEWAY_NETWORK} -j DROP",
+        ]
+        lines += [f"{indent}{rule}" for rule in rules]
+        found = True
+
+    if not found:
+        raise TemplateError(f"No '{MASQUERADE_LINE}' line found in {START_SCRIPT}.")
+
+    return "\n".join(lines) + "\n"
+
+
+def next_tunnel_ip(clients: dict) -> str:
+    """Returns the next free tunnel address of the gateway, the first one is the server."""
+    used = {client["tunnel_ip"] for client in clients.values()}
+    for address in GATEWAY_NETWORK.hosts():
+        if address == GATEWAY_NETWORK.network_address + 1:
+            continue
+        if str(address) not in used:
+            return str(address)
+    raise TemplateError(f"No free tunnel address left in {GATEWAY_NETWORK}.")
+
+
+def write_gateway_files(templates: dict, clients: dict, path: str) -> None:
+    """
+    Writes the server files, the client-config-dir and the firewall of a host gateway.
+
+    Args:
+        templates (dict): The pristine files as returned by fetch_templates.
+        clients (dict): The clients keyed by their common name, each with the
+            tunnel_ip and subnet of the user.
+        path (str): The gateway directory of the host.
+    """
+    server_path = os.path.join(path, "server")
+    ccd_path = os.path.join(path, "ccd")
+    os.makedirs(server_path, exist_ok=True)
+    os.makedirs(ccd_path, exist_ok=True)
+
+    with open(os.path.join(server_path, "server.conf"), "w") as file:
+        file.write(render_gateway_server_conf(templates[SERVER_CONF]))
+    start_script = os.path.join(server_path, "start.sh")
+    with open(start_script, "w") as file:
+        file.write(render_gateway_start_script(templates[START_SCRIPT]))
+    os.chmod(start_script, 0o755)
+
+    firewall = ["#!/bin/sh"]
+    for client_id, client in clients.items():
+        subnet = ip_network(client["subnet"])
+        with open(os.path.join(ccd_path, client_id), "w") as file:
+            file.write(
+                f"ifconfig-push {client['tunnel_ip']} {GATEWAY_NETWORK.netmask}\n"
+                f'push "route {subnet.network_address} {subnet.netmask}"\n'
+            )
+        rule = f"FORWARD -s {client['tunnel_ip']} -d {subnet} -j ACCEPT"
+        firewall.append(f"iptables -C {rule} 2>/dev/null || iptables -I {rule}")
+    with open(os.path.join(server_path, "firewall.sh"), "w") as file:
+        file.write("\n".join(firewall) + "\n")
@@ -1,4 +1,5 @@
 from ipaddress import ip_network
+import json
 import sys
 import os
 
@@ -13,6 +14,7 @@ class Participant:
     def __init__(self, user: str, save_path: str) -> None:
         self.name = user
         self.save_path = save_path
+        self.metadata = self._read_metadata()
         if os.path.exists(f"{self.save_path}/data/{self.name}"):
             self.ip, self.existing_openvpn_port = self._extract_ovpn_info(
                 f"{self.save_path}/data/{self.name}/client.ovpn"
@@ -23,6 +25,24 @@ class Participant:
                 )
             )
 
+    @property
+    def gateway(self) -> bool:
+        """True if the user is served by the shared OpenVPN gateway of the host."""
+        return self.metadata.get("mode") == "gateway"
+
+    def _read_metadata(self) -> dict:
+        file_path = f"{self.save_path}/data/{self.name}/meta.json"
+        if not os.path.exists(file_path):
+            return {}
+        with open(file_path, "r") as file:
+            return json.load(file)
+
+    def write_metadata(self) -> None:
+        path = f"{self.save_path}/data/{self.name}"
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "meta.json"), "w") as file:
+            json.dump(self.metadata, file, indent=2)
+
     def _extract_readme_info(self, file_path):
         """
         Extracts the host IP address, port number, and subnet from an OpenVPN configuration file.
@@ -0,0 +1,143 @@
+import os
+import queue
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+sys.path.append(os.getcwd())
+from src.log_config import get_logger
+
+logger = get_logger("ctf_creator.pipeline")
+
+# Put once per worker into the queue of a stage after its last item.
+DONE = object()
+
+
+class Stage:
+    """
+    One step of a pipeline, run by a fixed number of threads that take their items from a
+    bounded queue. The queue depth is sampled on every put, which shows where the pipeline
+    is held up.
+    """
+
+    def __init__(
+        self, name: str, func: Callable[[Any], Any], workers: int, queue_size: int
+    ) -> None:
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.samples = 0
+        self.depth_sum = 0
+        self.max_depth = 0
+
+    def put(self, item: Any) -> None:
+        """Adds an item, waits while the queue is full."""
+        start = time.monotonic()
+        self.queue.put(item)
+        depth = self.queue.qsize()
+        with self.lock:
+            self.blocked += time.monotonic() - start
+            self.samples += 1
+            self.depth_sum += depth
+            self.max_depth = max(self.max_depth, depth)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "processed": self.processed,
+                "failed": self.failed,
+                "busy": round(self.busy, 1),
+                "blocked": round(self.blocked, 1),
+                "max_depth": self.max_depth,
+                "avg_depth": (
+                    round(self.depth_sum / self.samples, 1) if self.samples else 0.0
+                ),
+            }
+
+
+class Pipeline:
+    """
+    Runs items through a sequence of stages connected by bounded queues.
+
+    Every stage passes the result of its function on to the next stage, a result of None
+    drops the item. A full queue blocks the stage in front of it, so a slow stage holds the
+    faster ones back instead of piling up work. An item whose stage raises an error is
+    logged and dropped, the other items go on.
+    """
+
+    def __init__(
+        self,
+        stages: List[Tuple[str, Callable[[Any], Any], int]],
+        queue_size: int = 8,
+        label: Callable[[Any], str] = str,
+    ) -> None:
+        self.stages = [
+            Stage(name=name, func=func, workers=workers, queue_size=queue_size)
+            for name, func, workers in stages
+        ]
+        self.label = label
+        self.failed = []
+
+    def _work(self, index: int) -> None:
+        stage = self.stages[index]
+        following = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            item = stage.queue.get()
+            if item is DONE:
+                return
+            start = time.monotonic()
+            try:
+                result = stage.func(item)
+            except BaseException as e:
+                # Also SystemExit, a dead worker would leave the stage in front blocked.
+                logger.error(f"Stage {stage.name} of {self.label(item)} failed: {e!r}")
+                with stage.lock:
+                    stage.failed += 1
+                    stage.busy += time.monotonic() - start
+                self.failed.append((self.label(item), stage.name))
+                continue
+            with stage.lock:
+                stage.processed += 1
+                stage.busy += time.monotonic() - start
+            if following is not None and result is not None:
+                following.put(result)
+
+    def run(self, items: Iterable) -> List[Tuple[str, str]]:
+        """
+        Args:
+            items (Iterable): The items handed to the first stage.
+
+        Returns:
+            List[Tuple[str, str]]: The failed items with the stage they failed in.
+        """
+        threads = []
+        for index, stage in enumerate(self.stages):
+            threads.append(
+                [
+                    threading.Thread(target=self._work, args=(index,), daemon=True)
+                    for _ in range(stage.workers)
+                ]
+            )
+            for thread in threads[-1]:
+                thread.start()
+
+        for item in items:
+            self.stages[0].put(item)
+        for stage, workers in zip(self.stages, threads):
+            # All items of a stage are handed on once its workers are done.
+            for _ in workers:
+                stage.queue.put(DONE)
+            for thread in workers:
+                thread.join()
+        return self.failed
+
+    def stats(self) -> Dict[str, dict]:
+        return {stage.name: stage.stats() for stage in self.stages}
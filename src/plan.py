@@ -0,0 +1,175 @@
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from ipaddress import IPv4Network, IPv6Network
+from typing import Dict, List
+
+from paramiko import SSHClient, AutoAddPolicy, SSHException
+
+sys.path.append(os.getcwd())
+from src.docker_env import LABEL_USER
+from src.host import firewall_rules
+from src.log_config import get_logger
+
+logger = get_logger("ctf_creator.plan")
+
+# Rough seconds per operation, used to estimate the duration of a plan.
+COSTS = {
+    "generate": 8.0,
+    "remove_user": 3.0,
+    "remove": 1.0,
+    "remove_network": 0.5,
+    "network": 0.5,
+    "upload": 2.0,
+    "openvpn": 2.0,
+    "challenge": 1.5,
+    "attach": 0.5,
+    "kali": 2.0,
+    "firewall": 0.2,
+    "deploy": 10.0,
+}
+# Seconds of the single SSH command that applies the firewall rules of a host.
+FIREWALL_BATCH = 1.0
+OPERATIONS = {
+    "create": ("network", "openvpn", "challenge", "attach", "kali", "deploy"),
+    "remove": ("remove_user", "remove", "remove_network"),
+    "upload": ("upload",),
+    "firewall": ("firewall",),
+}
+
+
+def _inventory_command(username: str) -> str:
+    return "; ".join(
+        [
+            "docker ps -a --format "
+            f"'c\\t{{{{.Names}}}}\\t{{{{.State}}}}\\t{{{{.Networks}}}}\\t"
+            f'{{{{.Label "{LABEL_USER}"}}}}\'',
+            "docker network ls --format 'n\\t{{.Name}}'",
+            f"ls -1d /home/{username}/ctf-data/*/Dockovpn_data 2>/dev/null"
+            " | sed 's/^/d\\t/'",
+            "sudo -n iptables -S 2>/dev/null | sed 's/^/f\\t/'",
+        ]
+    )
+
+
+def parse_inventory(output: str) -> dict:
+    """Parses the output of the inventory command of a host."""
+    inventory = {"containers": {}, "networks": set(), "data": set(), "firewall": []}
+    for line in output.replace("\r", "").splitlines():
+        parts = line.split("\t")
+        if parts[0] == "c" and len(parts) >= 4:
+            inventory["containers"][parts[1]] = {
+                "state": parts[2],
+                "networks": set(filter(None, parts[3].split(","))),
+                "user": parts[4] if len(parts) > 4 else "",
+            }
+        elif parts[0] == "n" and len(parts) == 2:
+            inventory["networks"].add(parts[1])
+        elif parts[0] == "d" and len(parts) == 2:
+            inventory["data"].add(parts[1].rstrip("/").split("/")[-2])
+        elif parts[0] == "f" and len(parts) == 2 and parts[1].startswith("-A "):
+            inventory["firewall"].append(_rule_tokens(parts[1][len("-A ") :]))
+    return inventory
+
+
+def read_inventory(host: dict) -> dict:
+    """
+    Reads the containers, networks, uploaded user data and firewall rules of a host with
+    one SSH command.
+
+    Returns:
+        dict: The inventory of the host, with an error instead if it cannot be reached.
+    """
+    ssh = SSHClient()
+    ssh.load_system_host_keys()
+    ssh.set_missing_host_key_policy(AutoAddPolicy())
+    try:
+        ssh.connect(
+            str(host.get("ip")),
+            port=22,
+            username=host.get("username"),
+            key_filename=host.get("identity_file"),
+            timeout=10,
+        )
+        _, stdout, _ = ssh.exec_command(
+            _inventory_command(username=host.get("username")), timeout=60
+        )
+        return parse_inventory(stdout.read().decode())
+    except (SSHException, OSError) as e:
+        logger.error(f"Could not read the inventory of host {host.get('ip')}: {e}")
+        return {"error": str(e)}
+    finally:
+        ssh.close()
+
+
+def read_inventories(hosts: List[dict]) -> Dict[str, dict]:
+    """Reads the inventories of all hosts in parallel."""
+    with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+        inventories = list(executor.map(read_inventory, hosts))
+    return {str(h.get("ip")): i for h, i in zip(hosts, inventories)}
+
+
+def _rule_tokens(rule: str) -> tuple:
+    """Splits a rule into its chain and options, single addresses written as /32."""
+    tokens = rule.split()
+    for index in range(1, len(tokens)):
+        if tokens[index - 1] in ("-s", "-d") and "/" not in tokens[index]:
+            tokens[index] += "/32"
+    return tokens[0], set(tokens[1:])
+
+
+def firewall_present(
+    inventory: dict, openvpn_port: int, subnet: IPv4Network | IPv6Network
+) -> bool:
+    """
+    True if all firewall rules of a user network are in the listing of the host. iptables
+    lists matches it added implicitly, e.g. -m udp, so a listed rule may hold more options.
+    """
+    for rule in firewall_rules(openvpn_port=openvpn_port, subnet=subnet):
+        chain, options = _rule_tokens(rule)
+        if not any(
+            chain == listed and options <= listed_options
+            for listed, listed_options in inventory.get("firewall", [])
+        ):
+            return False
+    return True
+
+
+def user_prefix(user: str) -> str:
+    return f"{re.sub('[^A-Za-z0-9]+', '', user)}_"
+
+
+def estimate(users: Dict[str, List[dict]], workers: int) -> float:
+    """
+    Estimates the seconds a host needs for its part of a plan. The operations of a user
+    run one after another, the users in parallel and the firewall rules in one batch.
+    """
+    chains = [
+        sum(COSTS[o["op"]] for o in ops if o["op"] not in ("generate", "firewall"))
+        for ops in users.values()
+    ]
+    rules = sum(1 for ops in users.values() for o in ops if o["op"] == "firewall")
+    if not chains:
+        return 0.0
+    seconds = max(max(chains), sum(chains) / workers)
+    if rules:
+        seconds += FIREWALL_BATCH + rules * COSTS["firewall"]
+    return seconds
+
+
+def summarize(plan: dict, workers: int) -> dict:
+    """Counts the operations of every host and estimates the duration of the plan."""
+    summary = {"hosts": {}, "generate": len(plan["generate"])}
+    for ip, users in plan["hosts"].items():
+        ops = [o["op"] for user_ops in users.values() for o in user_ops]
+        counts = {
+            kind: sum(1 for op in ops if op in names)
+            for kind, names in OPERATIONS.items()
+        }
+        counts["users"] = len(users)
+        counts["seconds"] = round(estimate(users=users, workers=workers), 1)
+        summary["hosts"][ip] = counts
+    slowest = max((h["seconds"] for h in summary["hosts"].values()), default=0.0)
+    summary["seconds"] = round(summary["generate"] * COSTS["generate"] + slowest, 1)
+    return summary
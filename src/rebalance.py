@@ -0,0 +1,63 @@
+import math
+import os
+import sys
+from typing import Dict, List, Tuple
+
+sys.path.append(os.getcwd())
+from src.participant import Participant
+
+
+def plan_moves(
+    users: List[Participant],
+    hosts: List[str],
+    drain: List[str] = None,
+    max_moves: int = None,
+) -> List[Tuple[Participant, str]]:
+    """
+    Computes which users move to which host, so the users are spread evenly.
+
+    Users of drained hosts and of hosts that are no longer configured always move. Then
+    users of hosts above the even share move until every host holds at most its share.
+    Each user goes to the host with the fewest users at that point.
+
+    Args:
+        users (List[Participant]): The deployed users.
+        hosts (List[str]): The IP addresses of the configured hosts.
+        drain (List[str], optional): Hosts that are emptied completely.
+        max_moves (int, optional): Upper limit of moves, the stranded users come first.
+
+    Returns:
+        List[Tuple[Participant, str]]: The users to move with their new host.
+    """
+    drain = set(drain or [])
+    targets = [h for h in hosts if h not in drain]
+    if not targets:
+        raise ValueError("No host is left to move the users to.")
+
+    by_host: Dict[str, List[Participant]] = {h: [] for h in targets}
+    stranded = []
+    for user in sorted(users, key=lambda u: u.name):
+        if str(user.ip) in by_host:
+            by_host[str(user.ip)].append(user)
+        else:
+            stranded.append(user)
+
+    share = math.ceil(len(users) / len(targets))
+    candidates = list(stranded)
+    for host in targets:
+        # The users beyond the share move, in the order of their names.
+        candidates += by_host[host][share:]
+        by_host[host] = by_host[host][:share]
+    moving = candidates if max_moves is None else candidates[:max_moves]
+
+    load = {h: len(by_host[h]) for h in targets}
+    for user in candidates[len(moving) :]:
+        if str(user.ip) in load:
+            load[str(user.ip)] += 1
+    moves = []
+    for user in moving:
+        target = min(targets, key=lambda h: (load[h], targets.index(h)))
+        load[target] += 1
+        if target != str(user.ip):
+            moves.append((user, target))
+    return moves
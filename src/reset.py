@@ -0,0 +1,176 @@
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ipaddress import ip_address
+from typing import Dict, List
+
+from docker.errors import APIError, ImageNotFound
+
+sys.path.append(os.getcwd())
+from src.gen_flag import challenge_environment
+from src.host import Host
+from src.log_config import get_logger
+from src.participant import Participant
+from src.rotate import read_epoch
+
+logger = get_logger("ctf_creator.reset")
+
+
+class ResetError(Exception):
+    """Custom exception raised when the environment of a user cannot be reset."""
+
+    pass
+
+
+class EnvironmentReset:
+    """
+    Restores the challenge containers of single users to a pristine state.
+
+    The specification of each container is rebuilt from the image it was created from,
+    its static IP and the environment of the user, and the container is replaced by a
+    fresh one. The OpenVPN server, the network and all other users are not touched. The
+    containers of each host are listed once, the users are reset in parallel.
+    """
+
+    def __init__(
+        self,
+        hosts: List[Host],
+        config: dict,
+        save_path: str,
+        workers: int = 16,
+    ) -> None:
+        self.hosts = {str(h.ip): h for h in hosts}
+        self.config = config
+        self.save_path = save_path
+        self.workers = workers
+        self.epoch = read_epoch(save_path=save_path)
+        self.challenges = {
+            c["name"]: c for c in config.get("containers") if not c.get("shared")
+        }
+
+    def reset(self, users: List[str], challenges: List[str] = None) -> Dict[str, dict]:
+        """
+        Args:
+            users (List[str]): The users to reset.
+            challenges (List[str], optional): The challenges to reset, defaults to all
+                challenges and the Kali container.
+
+        Returns:
+            Dict[str, dict]: The downtime of each reset container or the error per user.
+        """
+        start = time.monotonic()
+        listings = {}
+        results = {}
+        tasks = []
+        for user in users:
+            try:
+                participant = self._participant(user=user)
+                host = self.hosts.get(str(participant.ip))
+                if host is None:
+                    raise ResetError(f"Host {participant.ip} of {user} is unknown")
+                if host not in listings:
+                    # Looked up by name, claimed pool containers and containers of
+                    # older versions have no user label.
+                    listings[host] = {
+                        c["Names"][0].lstrip("/"): c
+                        for c in host.docker.call(
+                            host.docker.client.api.containers, all=True
+                        )
+                    }
+                tasks.append((participant, host))
+            except ResetError as e:
+                logger.error(e)
+                results[user] = {"error": str(e)}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {
+                participant.name: executor.submit(
+                    self._reset_user, participant, host, listings[host], challenges
+                )
+                for participant, host in tasks
+            }
+            for user, future in futures.items():
+                try:
+                    results[user] = future.result()
+                except (APIError, ImageNotFound, ResetError) as e:
+                    logger.error(f"Reset of {user} failed: {e}")
+                    results[user] = {"error": str(e)}
+
+        failed = [u for u, r in results.items() if "error" in r]
+        logger.info(
+            f"Reset {len(results) - len(failed)} of {len(users)} users in "
+            f"{time.monotonic() - start:.1f}s"
+        )
+        return results
+
+    def _participant(self, user: str) -> Participant:
+        if not os.path.isfile(f"{self.save_path}/data/{user}/client.ovpn"):
+            raise ResetError(f"No data for {user} in {self.save_path}")
+        return Participant(user=user, save_path=self.save_path)
+
+    def _reset_user(
+        self,
+        user: Participant,
+        host: Host,
+        containers: Dict[str, dict],
+        challenges: List[str] = None,
+    ) -> Dict[str, float]:
+        user_filtered = re.sub("[^A-Za-z0-9]+", "", user.name)
+        network = f"{user_filtered}_network"
+        names = challenges or list(self.challenges) + (
+            ["kali"] if f"{user_filtered}_kali" in containers else []
+        )
+        unknown = [n for n in names if n not in self.challenges and n != "kali"]
+        if unknown:
+            raise ResetError(f"Unknown or shared challenges {unknown}")
+
+        used = {
+            int(ip_address(a)) - int(user.subnet.network_address)
+            for a in [self._address(c, network) for c in containers.values()]
+            if a
+        }
+        downtime = {}
+        for name in names:
+            existing = containers.get(f"{user_filtered}_{name}")
+            address = self._address(existing, network) if existing else None
+            if address:
+                index = int(ip_address(address)) - int(user.subnet.network_address)
+            elif name == "kali":
+                index = 3
+            else:
+                index = min(set(range(4, 255)) - used)
+                used.add(index)
+            spec = self._spec(user=user, host=host, name=name, index=index)
+            if existing:
+                # The image the container was created from, even if the tag moved on.
+                spec["image"] = existing["ImageID"]
+            downtime[name] = round(host.reset_container(spec=spec), 2)
+        logger.info(f"Reset {user.name} on host {host.ip}: {downtime}")
+        return downtime
+
+    def _spec(self, user: Participant, host: Host, name: str, index: int) -> dict:
+        if name == "kali":
+            return host.kali_spec(
+                user=user.name,
+                subnet=user.subnet,
+                index=index,
+                command=[self.config.get("secret"), "kali"],
+            )
+        return host.container_spec(
+            user=user.name,
+            container=self.challenges[name],
+            subnet=user.subnet,
+            index=index,
+            environment=challenge_environment(
+                user=user.name,
+                secret=self.config.get("secret"),
+                container=name,
+                epoch=self.epoch,
+            ),
+        )
+
+    def _address(self, container: dict, network: str) -> str:
+        networks = container.get("NetworkSettings", {}).get("Networks", {})
+        return networks.get(network, {}).get("IPAddress")
@@ -0,0 +1,132 @@
+import csv
+import json
+import os
+import re
+import sys
+from typing import Iterable, Iterator, List, Tuple
+
+sys.path.append(os.getcwd())
+from src.log_config import get_logger
+from src.participant import Participant
+
+logger = get_logger("ctf_creator.roster")
+
+HEADERS = {"user", "users", "email", "mail"}
+
+
+class RosterError(Exception):
+    """Custom exception raised when a user of the roster is invalid."""
+
+    pass
+
+
+class UserValidator:
+    """
+    Validates users one by one, so rosters can be streamed instead of held in memory.
+
+    Only what the deployment relies on is checked: the user names a folder of the user
+    data, and neither the user nor the filtered name, which is used for container and
+    network names, was seen before.
+    """
+
+    def __init__(self) -> None:
+        self.users = set()
+        self.filtered = {}
+
+    def validate(self, user: str, source: str) -> str:
+        if not isinstance(user, str) or not user.strip(".") or "/" in user:
+            raise RosterError(f"{source}: Invalid user {user!r}.")
+        if user in self.users:
+            raise RosterError(f"{source}: Duplicate user {user}.")
+        user_filtered = re.sub("[^A-Za-z0-9]+", "", user)
+        if not user_filtered:
+            raise RosterError(f"{source}: User {user!r} has no letters or digits.")
+        if user_filtered in self.filtered:
+            raise RosterError(
+                f"{source}: User {user} collides with {self.filtered[user_filtered]}."
+            )
+        self.users.add(user)
+        self.filtered[user_filtered] = user
+        return user
+
+
+def _read_csv(path: str) -> Iterator[Tuple[int, str]]:
+    with open(path, "r", newline="") as file:
+        for number, row in enumerate(csv.reader(file), start=1):
+            if not row or not row[0].strip():
+                continue
+            if number == 1 and row[0].strip().lower() in HEADERS:
+                continue
+            yield number, row[0].strip()
+
+
+def _read_jsonl(path: str) -> Iterator[Tuple[int, str]]:
+    with open(path, "r") as file:
+        for number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise RosterError(f"{path}:{number}: {e}")
+            if isinstance(entry, dict):
+                entry = entry.get("user", entry.get("email"))
+            yield number, entry
+
+
+def read_users(path: str, validator: UserValidator = None) -> Iterator[str]:
+    """
+    Streams and validates the users of a CSV (first column) or JSON lines file. JSON lines
+    are either strings or objects with a "user" or "email" key.
+
+    Raises:
+        RosterError: If a user is invalid or the file format is unknown.
+    """
+    validator = validator or UserValidator()
+    if path.endswith(".csv"):
+        rows = _read_csv(path)
+    elif path.endswith((".jsonl", ".ndjson")):
+        rows = _read_jsonl(path)
+    else:
+        raise RosterError(f"Unknown user file format {path}, use .csv or .jsonl.")
+
+    for number, user in rows:
+        yield validator.validate(user=user, source=f"{path}:{number}")
+
+
+class Roster:
+    """
+    Snapshot of the users of the last run, used to find added and removed users.
+    """
+
+    def __init__(self, save_path: str) -> None:
+        self.path = f"{save_path}/roster.txt"
+
+    def load(self) -> set:
+        if not os.path.exists(self.path):
+            return set()
+        with open(self.path, "r") as file:
+            return {line.rstrip("\n") for line in file if line.strip()}
+
+    def save(self, users: Iterable[str]) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f"{self.path}.part", "w") as file:
+            for user in sorted(users):
+                file.write(f"{user}\n")
+        os.replace(f"{self.path}.part", self.path)
+
+
+def deployed_participants(save_path: str) -> List[Participant]:
+    """
+    Returns the users of the last run with existing data. Without a roster snapshot all
+    users with data are returned.
+    """
+    names = Roster(save_path=save_path).load()
+    if not names:
+        data_path = f"{save_path}/data"
+        names = os.listdir(data_path) if os.path.isdir(data_path) else []
+    return [
+        Participant(user=name, save_path=save_path)
+        for name in sorted(names)
+        if os.path.isfile(f"{save_path}/data/{name}/client.ovpn")
+    ]
@@ -0,0 +1,146 @@
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from docker.errors import APIError
+from requests.exceptions import ConnectionError
+
+sys.path.append(os.getcwd())
+from src.docker_env import Docker, LABEL_ROLE
+from src.gen_flag import challenge_flag
+from src.log_config import get_logger
+from src.naming import container_owner, filter_user
+from src.roster import deployed_participants
+
+logger = get_logger("ctf_creator.rotate")
+
+
+def read_epoch(save_path: str) -> int:
+    """Returns the current flag epoch, 0 before the first rotation."""
+    path = f"{save_path}/epoch"
+    if not os.path.exists(path):
+        return 0
+    with open(path, "r") as file:
+        return int(file.read().strip() or 0)
+
+
+def write_epoch(save_path: str, epoch: int) -> None:
+    path = f"{save_path}/epoch"
+    with open(f"{path}.part", "w") as file:
+        file.write(f"{epoch}\n")
+    os.replace(f"{path}.part", path)
+
+
+class FlagRotator:
+    """
+    Pushes the flags of a new epoch into all running challenge containers.
+
+    The flags are written to /ctf/flag, or to /ctf/flags/<subnet> of shared instances, and
+    read back to confirm the write. No container is restarted, so challenges that support
+    rotation read the file instead of the FLAG variable. The hosts are handled in parallel,
+    the containers of a host in batches through the admission controller of the host.
+    """
+
+    def __init__(
+        self, config: dict, save_path: str, epoch: int, batch_size: int = 32
+    ) -> None:
+        self.config = config
+        self.save_path = save_path
+        self.epoch = epoch
+        self.batch_size = batch_size
+        self.challenges = {c["name"] for c in config.get("containers")}
+        self.users = {}
+
+    def _flag(self, user: str, container: str) -> str:
+        return challenge_flag(
+            user=user,
+            secret=self.config.get("secret"),
+            container=container,
+            epoch=self.epoch,
+        )
+
+    def rotate(self) -> Dict[str, List[str]]:
+        """
+        Returns:
+            Dict[str, List[str]]: The containers that could not be updated per host.
+        """
+        start = time.monotonic()
+        self.users = {
+            u.name: u for u in deployed_participants(save_path=self.save_path)
+        }
+        hosts = self.config.get("hosts")
+        with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+            results = list(executor.map(self._rotate_host, hosts))
+        written = sum(r[0] for r in results)
+        failed = {str(h.get("ip")): r[1] for h, r in zip(hosts, results) if r[1]}
+        elapsed = time.monotonic() - start
+        logger.info(
+            f"Rotated {written} flags to epoch {self.epoch} in {elapsed:.1f}s "
+            f"({written / elapsed if elapsed else 0:.0f} flags/s), "
+            f"{sum(len(f) for f in failed.values())} failed"
+        )
+        return failed
+
+    def _tasks(self, containers: List[dict]) -> List[tuple]:
+        """Returns the container, files and the file to confirm of every write."""
+        networks = {f"{filter_user(u.name)}_network": u for u in self.users.values()}
+        filtered = {filter_user(u): u for u in self.users}
+        tasks = []
+        for container in containers:
+            labels = container.get("Labels") or {}
+            name = container["Names"][0].lstrip("/")
+            if name.startswith("pool_"):
+                continue
+            if name.startswith("shared_"):
+                role = name[len("shared_") :].rsplit("_", 1)[0]
+                if role not in self.challenges:
+                    continue
+                for network in container["NetworkSettings"]["Networks"]:
+                    user = networks.get(network)
+                    if user is None:
+                        continue
+                    path = f"ctf/flags/{user.subnet.network_address}"
+                    flag = self._flag(user=user.name, container=role)
+                    tasks.append((name, {path: flag}, path))
+                continue
+            # Claimed pool containers and those of older versions may lack labels.
+            role = labels.get(LABEL_ROLE, name.split("_", 1)[-1])
+            user = container_owner(name=name, labels=labels, users=filtered)
+            if role in self.challenges and user is not None:
+                flag = self._flag(user=user, container=role)
+                tasks.append((name, {"ctf/flag": flag}, "ctf/flag"))
+        return tasks
+
+    def _rotate_host(self, host: dict) -> tuple:
+        ip = str(host.get("ip"))
+        try:
+            docker = Docker(host=host)
+            containers = docker.call(docker.client.api.containers, all=True)
+        except (APIError, ConnectionError) as e:
+            logger.error(f"Could not list the containers on host {ip}: {e}")
+            return 0, [ip]
+
+        tasks = self._tasks(containers=containers)
+        with ThreadPoolExecutor(max_workers=self.batch_size) as executor:
+            confirmed = list(
+                executor.map(lambda task: self._write(docker, *task), tasks)
+            )
+        failed = [task[0] for task, ok in zip(tasks, confirmed) if not ok]
+        logger.info(
+            f"Host {ip}: {len(tasks) - len(failed)} of {len(tasks)} flags written"
+        )
+        return len(tasks) - len(failed), failed
+
+    def _write(self, docker: Docker, name: str, files: dict, confirm: str) -> bool:
+        try:
+            docker.write_files(container_name=name, files=files)
+            written = docker.read_file(container_name=name, path=f"/{confirm}")
+        except APIError as e:
+            logger.error(f"Could not write the flag of {name}: {e}")
+            return False
+        if written != files[confirm]:
+            logger.error(f"Flag of {name} does not match after the write")
+            return False
+        return True
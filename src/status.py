@@ -0,0 +1,271 @@
+"""
+Read-only status of all deployed users.
+
+Only light modules are imported here, so `python3 src/status.py` answers without loading
+the Docker SDK and the deployment code. Each host is asked with one SSH command.
+"""
+
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import run, TimeoutExpired
+from typing import List
+
+import click
+import yaml
+
+sys.path.append(os.getcwd())
+from src.log_config import get_logger
+from src.naming import filter_user, shared_replica
+from src.participant import Participant
+from src.roster import deployed_participants
+
+logger = get_logger("ctf_creator.status")
+
+READY = "ready"
+LAZY = "lazy"
+SUSPENDED = "suspended"
+DEGRADED = "degraded"
+DOWN = "down"
+UNKNOWN = "unknown"
+STATES = (READY, LAZY, SUSPENDED, DEGRADED, DOWN, UNKNOWN)
+# Container states of a user that is served. Paused containers belong to idle users.
+RUNNING = ("running", "restarting")
+
+
+def _listing_command() -> str:
+    return "; ".join(
+        [
+            "docker ps -a --format "
+            f"'c\\t{{{{.Names}}}}\\t{{{{.State}}}}\\t{{{{.Networks}}}}'",
+            "docker network ls --filter name=_network --format 'n\\t{{.Name}}'",
+        ]
+    )
+
+
+def query_host(host: dict, timeout: float = 10.0) -> dict:
+    """
+    Lists all containers and the user networks of a host with one SSH command. Containers
+    created before the labels are found by their names as well.
+
+    Returns:
+        dict: The containers with their state and networks and the network names, with
+            an error instead if the host cannot be asked.
+    """
+    start = time.monotonic()
+    try:
+        result = run(
+            [
+                "ssh",
+                "-o",
+                "BatchMode=yes",
+                "-o",
+                f"ConnectTimeout={int(timeout)}",
+                "-i",
+                host.get("identity_file"),
+                f"{host.get('username')}@{host.get('ip')}",
+                _listing_command(),
+            ],
+            capture_output=True,
+            text=True,
+            timeout=timeout * 3,
+        )
+    except (TimeoutExpired, OSError) as e:
+        return {"error": str(e), "seconds": round(time.monotonic() - start, 2)}
+    if result.returncode != 0:
+        return {
+            "error": result.stderr.strip() or f"exit code {result.returncode}",
+            "seconds": round(time.monotonic() - start, 2),
+        }
+
+    listing = {"containers": {}, "networks": set()}
+    for line in result.stdout.splitlines():
+        parts = line.split("\t")
+        if parts[0] == "c" and len(parts) == 4:
+            listing["containers"][parts[1]] = {
+                "state": parts[2],
+                "networks": set(filter(None, parts[3].split(","))),
+            }
+        elif parts[0] == "n" and len(parts) == 2:
+            listing["networks"].add(parts[1])
+    listing["seconds"] = round(time.monotonic() - start, 2)
+    return listing
+
+
+def _suspended(save_path: str) -> set:
+    path = f"{save_path}/idle.json"
+    if not os.path.exists(path):
+        return set()
+    with open(path, "r") as file:
+        return {u for u, s in json.load(file).items() if s.get("suspended")}
+
+
+def user_status(
+    user: Participant,
+    listing: dict,
+    containers: List[dict],
+    kali: bool,
+    suspended: bool,
+) -> dict:
+    """
+    Returns the readiness of a user from the listing of its host.
+
+    A user is down without its network or OpenVPN server, lazy while it waits for the
+    first connect, suspended while the idle manager stopped its challenges, and degraded
+    if any other container is missing or not running.
+    """
+    if "error" in listing:
+        return {"state": UNKNOWN, "problems": [listing["error"]]}
+    prefix = filter_user(user.name)
+    running = listing["containers"]
+    problems = []
+    if f"{prefix}_network" not in listing["networks"]:
+        problems.append("network missing")
+    openvpn = "gateway_openvpn" if user.gateway else f"{prefix}_openvpn"
+    if openvpn not in running:
+        problems.append("openvpn missing")
+    elif running[openvpn]["state"] not in RUNNING:
+        problems.append(f"openvpn {running[openvpn]['state']}")
+    if problems:
+        return {"state": DOWN, "problems": problems}
+
+    if user.metadata.get("lazy") and not user.metadata.get("materialized_at"):
+        return {"state": LAZY, "problems": []}
+
+    stopped = []
+    expected = [
+        (
+            c["name"],
+            (
+                shared_replica(user=user.name, container=c)
+                if c.get("shared")
+                else f"{prefix}_{c['name']}"
+            ),
+            c.get("shared"),
+        )
+        for c in containers
+    ]
+    if kali or user.metadata.get("kali"):
+        expected.append(("kali", f"{prefix}_kali", False))
+    for role, name, shared in expected:
+        if name not in running:
+            problems.append(f"{role} missing")
+        elif shared and f"{prefix}_network" not in running[name]["networks"]:
+            problems.append(f"{role} not attached")
+        elif running[name]["state"] not in RUNNING:
+            stopped.append(f"{role} {running[name]['state']}")
+    if problems:
+        return {"state": DEGRADED, "problems": problems + stopped}
+    if stopped:
+        if suspended:
+            return {"state": SUSPENDED, "problems": []}
+        return {"state": DEGRADED, "problems": stopped}
+    return {"state": READY, "problems": []}
+
+
+def fleet_status(config: dict, save_path: str, kali: bool = False) -> dict:
+    """Queries all hosts in parallel and joins their listings with the user data."""
+    start = time.monotonic()
+    hosts = config.get("hosts")
+    with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+        listings = dict(
+            zip(
+                [str(h.get("ip")) for h in hosts],
+                executor.map(query_host, hosts),
+            )
+        )
+    suspended = _suspended(save_path=save_path)
+
+    users = {}
+    summary = {
+        ip: {"seconds": listing["seconds"], "error": listing.get("error")}
+        | {state: 0 for state in STATES}
+        for ip, listing in listings.items()
+    }
+    for user in deployed_participants(save_path=save_path):
+        ip = str(user.ip)
+        listing = listings.get(ip, {"error": "host not configured"})
+        readiness = user_status(
+            user=user,
+            listing=listing,
+            containers=config.get("containers"),
+            kali=kali,
+            suspended=user.name in suspended,
+        )
+        users[user.name] = {"host": ip} | readiness
+        if ip in summary:
+            summary[ip][readiness["state"]] += 1
+    return {
+        "hosts": summary,
+        "users": users,
+        "seconds": round(time.monotonic() - start, 2),
+    }
+
+
+def print_status(fleet: dict, show_all: bool = False) -> None:
+    for name, user in sorted(fleet["users"].items()):
+        if show_all or user["state"] not in (READY, LAZY, SUSPENDED):
+            problems = f"  {', '.join(user['problems'])}" if user["problems"] else ""
+            click.echo(f"{user['state']:<10} {user['host']:<16} {name}{problems}")
+    click.echo()
+    click.echo(f"{'host':<16} " + " ".join(f"{s:>9}" for s in STATES) + "  seconds")
+    for ip, host in fleet["hosts"].items():
+        counts = " ".join(f"{host[s]:>9}" for s in STATES)
+        error = f"  {host['error']}" if host["error"] else ""
+        click.echo(f"{ip:<16} {counts}  {host['seconds']:>7}{error}")
+    total = len(fleet["users"])
+    ready = sum(1 for u in fleet["users"].values() if u["state"] == READY)
+    click.echo(f"{ready} of {total} users ready in {fleet['seconds']}s")
+
+
+@click.command()
+@click.option(
+    "--config",
+    required=True,
+    help="The path to the .yaml configuration file for the CTF-Creator.",
+    type=click.File("r", encoding="utf8"),
+)
+@click.option(
+    "--save",
+    required=True,
+    help="The path where the user data of the CTF-Creator is saved.",
+    type=click.Path(exists=True, file_okay=False),
+)
+@click.option(
+    "--kali",
+    default=False,
+    is_flag=True,
+    help="The users have a Kali container.",
+    show_default=True,
+)
+@click.option(
+    "--json",
+    "as_json",
+    default=False,
+    is_flag=True,
+    help="Prints the status of every host and user as JSON.",
+    show_default=True,
+)
+@click.option(
+    "--all",
+    "show_all",
+    default=False,
+    is_flag=True,
+    help="Lists every user, not only the users with problems.",
+    show_default=True,
+)
+def status(config, save, kali, as_json, show_all):
+    """Shows which users are ready, without changing anything on the hosts."""
+    result = fleet_status(config=yaml.safe_load(config), save_path=save, kali=kali)
+    if as_json:
+        click.echo(json.dumps(result, indent=2))
+    else:
+        print_status(fleet=result, show_all=show_all)
+    if any(u["state"] in (DEGRADED, DOWN, UNKNOWN) for u in result["users"].values()):
+        exit(1)
+
+
+if __name__ == "__main__":
+    status()
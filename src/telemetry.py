@@ -0,0 +1,312 @@
+import csv
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+from paramiko import SSHClient, AutoAddPolicy, SSHException
+
+sys.path.append(os.getcwd())
+from src.docker_env import LABEL_ROLE, LABEL_USER
+from src.lazy import percentile
+from src.log_config import get_logger
+from src.naming import filter_user
+
+logger = get_logger("ctf_creator.telemetry")
+
+UNITS = {
+    "B": 1,
+    "kB": 1000,
+    "KB": 1000,
+    "KiB": 1024,
+    "MB": 1000**2,
+    "MiB": 1024**2,
+    "GB": 1000**3,
+    "GiB": 1024**3,
+    "TB": 1000**4,
+    "TiB": 1024**4,
+}
+ANSI = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+STATS = "docker stats --format '{{json .}}'"
+LABELS = (
+    f"docker ps --filter label={LABEL_ROLE} --format "
+    f'\'{{{{.Names}}}}\\t{{{{.Label "{LABEL_USER}"}}}}\\t{{{{.Label "{LABEL_ROLE}"}}}}\''
+)
+
+
+def parse_size(value: str) -> float:
+    """Converts a size of docker stats, e.g. 10.5MiB, to bytes."""
+    match = re.match(r"^\s*([0-9.]+)\s*([A-Za-z]+)\s*$", value)
+    if not match:
+        return 0.0
+    return float(match.group(1)) * UNITS.get(match.group(2), 1)
+
+
+class HostStream:
+    """
+    Streams docker stats of all running containers of a host over one SSH connection.
+
+    The Docker CLI on the host samples all containers and writes one JSON line per
+    container and round, so the controller needs no request per container. The labels of
+    the containers are refreshed over the same connection.
+    """
+
+    def __init__(self, host: dict, label_interval: float = 30.0) -> None:
+        self.host = host
+        self.ip = str(host.get("ip"))
+        self.label_interval = label_interval
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.containers = {}
+        self.ssh = None
+        self.stopped = threading.Event()
+
+    def start(self) -> None:
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.ssh:
+            self.ssh.close()
+
+    def snapshot(self) -> List[dict]:
+        """Returns the latest sample of every labelled container."""
+        with self.lock:
+            return [
+                {**self.containers[name], "cpu": cpu, "memory": memory}
+                for name, (cpu, memory) in self.samples.items()
+                if name in self.containers
+            ]
+
+    def _connect(self) -> SSHClient:
+        ssh = SSHClient()
+        ssh.load_system_host_keys()
+        ssh.set_missing_host_key_policy(AutoAddPolicy())
+        ssh.connect(self.ip, port=22, username=self.host.get("username"))
+        return ssh
+
+    def _refresh_labels(self) -> None:
+        _, stdout, _ = self.ssh.exec_command(LABELS, timeout=30)
+        rows = [
+            line.split("\t")
+            for line in stdout.read().decode().splitlines()
+            if len(line.split("\t")) == 3
+        ]
+        # Claimed pool containers of older versions have no user label, their name starts
+        # with the filtered name of the user.
+        users = {filter_user(user): user for _, user, _ in rows if user}
+        containers = {}
+        for name, user, role in rows:
+            if not user and "_" in name and not name.startswith(("pool_", "shared_")):
+                prefix = name.split("_", 1)[0]
+                user = users.get(prefix, prefix)
+            containers[name] = {"user": user, "challenge": role}
+        with self.lock:
+            self.containers = containers
+            self.samples = {n: s for n, s in self.samples.items() if n in containers}
+
+    def _run(self) -> None:
+        while not self.stopped.is_set():
+            try:
+                self.ssh = self._connect()
+                self._refresh_labels()
+                refreshed = time.monotonic()
+                _, stdout, _ = self.ssh.exec_command(STATS)
+                for line in stdout:
+                    if self.stopped.is_set():
+                        return
+                    self._parse(line=ANSI.sub("", line).strip())
+                    if time.monotonic() - refreshed > self.label_interval:
+                        self._refresh_labels()
+                        refreshed = time.monotonic()
+            except (SSHException, OSError) as e:
+                if self.stopped.is_set():
+                    return
+                logger.error(f"Stats stream of host {self.ip} failed: {e}")
+            finally:
+                if self.ssh:
+                    self.ssh.close()
+            self.stopped.wait(5)
+
+    def _parse(self, line: str) -> None:
+        if not line.startswith("{"):
+            return
+        try:
+            stats = json.loads(line)
+        except json.JSONDecodeError:
+            return
+        cpu = float(stats.get("CPUPerc", "0%").rstrip("%") or 0)
+        memory = parse_size(stats.get("MemUsage", "0B").split("/")[0])
+        with self.lock:
+            self.samples[stats.get("Name")] = (cpu, memory)
+
+
+class TelemetryCollector:
+    """
+    Aggregates the resource usage of all hosts per user, per challenge and per host.
+
+    Every interval the latest sample of each container is summed up per user and per host,
+    while every container is an observation of its challenge. The values of the last window
+    are kept to report rolling percentiles, which are served for Prometheus and appended
+    to a CSV file.
+    """
+
+    def __init__(
+        self,
+        hosts: List[dict],
+        interval: float = 5.0,
+        window: float = 300.0,
+        csv_path: str = None,
+    ) -> None:
+        self.streams = [HostStream(host=host) for host in hosts]
+        self.interval = interval
+        self.csv_path = csv_path
+        self.length = max(1, int(window / interval))
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def _observe(
+        self, scope: str, name: str, cpu: List[float], memory: List[float]
+    ) -> None:
+        """Adds the observations of one interval, the oldest interval drops out."""
+        series = self.series.setdefault(
+            (scope, name),
+            {"cpu": deque(maxlen=self.length), "memory": deque(maxlen=self.length)},
+        )
+        series["cpu"].append(cpu)
+        series["memory"].append(memory)
+
+    def sample(self) -> None:
+        users = {}
+        challenges = {}
+        with self.lock:
+            for stream in self.streams:
+                snapshot = stream.snapshot()
+                self._observe(
+                    scope="host",
+                    name=stream.ip,
+                    cpu=[sum(s["cpu"] for s in snapshot)],
+                    memory=[sum(s["memory"] for s in snapshot)],
+                )
+                for sample in snapshot:
+                    if sample["user"]:
+                        usage = users.setdefault(sample["user"], [0.0, 0.0])
+                        usage[0] += sample["cpu"]
+                        usage[1] += sample["memory"]
+                    usage = challenges.setdefault(sample["challenge"], ([], []))
+                    usage[0].append(sample["cpu"])
+                    usage[1].append(sample["memory"])
+            for user, (cpu, memory) in users.items():
+                self._observe(scope="user", name=user, cpu=[cpu], memory=[memory])
+            for challenge, (cpu, memory) in challenges.items():
+                self._observe(scope="challenge", name=challenge, cpu=cpu, memory=memory)
+
+    def summary(self) -> List[dict]:
+        """Returns the p50, p95 and maximum of every series over the window."""
+        rows = []
+        with self.lock:
+            for (scope, name), series in sorted(self.series.items()):
+                for metric, intervals in series.items():
+                    values = [v for interval in intervals for v in interval]
+                    if not values:
+                        continue
+                    rows.append(
+                        {
+                            "scope": scope,
+                            "name": name,
+                            "metric": metric,
+                            "p50": percentile(values, 50),
+                            "p95": percentile(values, 95),
+                            "max": max(values),
+                        }
+                    )
+        return rows
+
+    def prometheus(self) -> str:
+        """
+        Returns the summary as one gauge per statistic, e.g. ctf_cpu_percent_p95. The
+        percentiles are computed over the window, so they are no Prometheus summary.
+        """
+        rows = self.summary()
+        lines = []
+        for metric, base in (
+            ("cpu", "ctf_cpu_percent"),
+            ("memory", "ctf_memory_bytes"),
+        ):
+            for key in ("p50", "p95", "max"):
+                lines.append(f"# TYPE {base}_{key} gauge")
+                for row in [r for r in rows if r["metric"] == metric]:
+                    name = row["name"].replace("\\", "\\\\").replace('"', '\\"')
+                    lines.append(
+                        f'{base}_{key}{{scope="{row["scope"]}",name="{name}"}} '
+                        f"{row[key]:.2f}"
+                    )
+        return "\n".join(lines) + "\n"
+
+    def write_csv(self) -> None:
+        exists = os.path.exists(self.csv_path)
+        now = int(time.time())
+        with open(self.csv_path, "a", newline="") as file:
+            writer = csv.writer(file)
+            if not exists:
+                writer.writerow(
+                    ["time", "scope", "name", "metric", "p50", "p95", "max"]
+                )
+            for row in self.summary():
+                writer.writerow(
+                    [now, row["scope"], row["name"], row["metric"]]
+                    + [round(row[k], 2) for k in ("p50", "p95", "max")]
+                )
+
+    def serve(self, port: int) -> ThreadingHTTPServer:
+        collector = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = collector.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        server = ThreadingHTTPServer(("", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info(f"Serve the metrics on port {port} at /metrics")
+        return server
+
+    def run(
+        self, port: int = None, csv_interval: float = 60.0, duration: float = None
+    ) -> None:
+        for stream in self.streams:
+            stream.start()
+        server = self.serve(port=port) if port else None
+        start = time.monotonic()
+        written = start
+        try:
+            while duration is None or time.monotonic() - start < duration:
+                time.sleep(self.interval)
+                self.sample()
+                if self.csv_path and time.monotonic() - written >= csv_interval:
+                    self.write_csv()
+                    written = time.monotonic()
+        except KeyboardInterrupt:
+            logger.info("Telemetry stopped.")
+        finally:
+            if self.csv_path:
+                self.write_csv()
+            if server:
+                server.shutdown()
+            for stream in self.streams:
+                stream.stop()
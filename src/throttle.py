@@ -0,0 +1,147 @@
+import os
+import random
+import sys
+import threading
+import time
+from typing import Callable
+
+from docker.errors import APIError
+from requests.exceptions import ConnectionError, Timeout
+
+sys.path.append(os.getcwd())
+from src.log_config import get_logger
+
+logger = get_logger("ctf_creator.throttle")
+
+
+def is_transient(error: Exception) -> bool:
+    """
+    Returns True for errors worth a retry: timeouts, broken connections, rate limiting and
+    server errors of the daemon. Client errors like a name conflict are not retried.
+    """
+    if isinstance(error, (ConnectionError, Timeout)):
+        return True
+    if isinstance(error, APIError):
+        return error.status_code == 429 or error.is_server_error()
+    return False
+
+
+class AdmissionController:
+    """
+    Limits the Docker calls in flight on one host and adapts the limit to the daemon.
+
+    The limit grows by one call per round of successful calls and is halved when a call
+    fails with a transient error or takes longer than the target latency (AIMD). Transient
+    errors of idempotent calls are retried with exponential backoff and full jitter.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial: int = 4,
+        minimum: int = 1,
+        maximum: int = 32,
+        target_latency: float = 5.0,
+        retries: int = 4,
+        backoff: float = 0.5,
+    ) -> None:
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.retries = retries
+        self.backoff = backoff
+
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.calls = 0
+        self.errors = 0
+        self.retried = 0
+        self.latency = 0.0
+
+    def call(self, function: Callable, *args, **kwargs):
+        """
+        Runs a Docker call once a slot is free and retries it on transient errors.
+
+        Raises:
+            Exception: The error of the last attempt, or any non transient error.
+        """
+        return self._call(function, self.retries, *args, **kwargs)
+
+    def call_once(self, function: Callable, *args, **kwargs):
+        """
+        Runs a Docker call that is not idempotent, like creating a container or network,
+        once a slot is free. The daemon may have done the work of a call that timed out, so
+        it is not retried: a second attempt would fail with a name conflict.
+
+        Raises:
+            Exception: The error of the call.
+        """
+        return self._call(function, 0, *args, **kwargs)
+
+    def _call(self, function: Callable, retries: int, *args, **kwargs):
+        for attempt in range(retries + 1):
+            self._acquire()
+            start = time.monotonic()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                transient = is_transient(e)
+                self._release(latency=time.monotonic() - start, failed=transient)
+                if not transient or attempt == retries:
+                    raise
+                delay = random.uniform(0, self.backoff * 2**attempt)
+                logger.warning(
+                    f"Transient error on host {self.name}, retry in {delay:.1f}s: {e}"
+                )
+                with self.condition:
+                    self.retried += 1
+                time.sleep(delay)
+                continue
+            self._release(latency=time.monotonic() - start, failed=False)
+            return result
+
+    def _acquire(self) -> None:
+        with self.condition:
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.waiting -= 1
+            self.in_flight += 1
+
+    def _release(self, latency: float, failed: bool) -> None:
+        with self.condition:
+            self.in_flight -= 1
+            self.calls += 1
+            self.latency = (
+                latency if self.calls == 1 else 0.8 * self.latency + 0.2 * latency
+            )
+            if failed:
+                self.errors += 1
+            if failed or latency > self.target_latency:
+                limit = max(self.minimum, self.limit / 2)
+                if int(limit) != int(self.limit):
+                    logger.debug(
+                        f"Host {self.name}: lower the call limit to {int(limit)}"
+                    )
+                self.limit = limit
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "max_waiting": self.max_waiting,
+                "calls": self.calls,
+                "errors": self.errors,
+                "retried": self.retried,
+                "latency": round(self.latency, 3),
+            }
@@ -0,0 +1,239 @@
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ipaddress import ip_address
+from typing import Dict, List
+
+from docker.errors import APIError, ImageNotFound
+
+sys.path.append(os.getcwd())
+from src.docker_env import LABEL_ROLE
+from src.gen_flag import challenge_environment
+from src.host import Host
+from src.log_config import get_logger
+from src.naming import container_owner, filter_user
+from src.participant import Participant
+from src.roster import deployed_participants
+from src.rotate import read_epoch
+
+logger = get_logger("ctf_creator.update")
+
+
+class UpdateError(Exception):
+    """Custom exception raised when a stale container cannot be recreated."""
+
+    pass
+
+
+class RollingUpdater:
+    """
+    Recreates the challenge containers that run an outdated image.
+
+    The image of every challenge is resolved to its ID on each host, then the containers
+    of all users are listed with one call per host and compared against it. Stale
+    containers are recreated with the same static IP and a freshly generated environment.
+    The hosts are updated in parallel, the users of a host in waves of a fixed size, so
+    only a few users of a host are without their challenges at the same time.
+    """
+
+    def __init__(
+        self,
+        hosts: List[Host],
+        config: dict,
+        save_path: str,
+        wave_size: int = 4,
+        pull: bool = True,
+    ) -> None:
+        self.hosts = hosts
+        self.config = config
+        self.save_path = save_path
+        self.wave_size = wave_size
+        self.pull = pull
+        self.containers = {c["name"]: c for c in config.get("containers")}
+        self.epoch = read_epoch(save_path=save_path)
+        self.lock = threading.Lock()
+        self.updated = 0
+        self.failed = []
+        self.users = {}
+
+    def update(self) -> dict:
+        start = time.monotonic()
+        self.users = {
+            filter_user(u.name): u.name
+            for u in deployed_participants(save_path=self.save_path)
+        }
+        with ThreadPoolExecutor(max_workers=len(self.hosts)) as executor:
+            stale = sum(executor.map(self._update_host, self.hosts))
+        elapsed = time.monotonic() - start
+        summary = {
+            "stale": stale,
+            "updated": self.updated,
+            "failed": self.failed,
+            "seconds": round(elapsed, 1),
+        }
+        logger.info(
+            f"Updated {self.updated} of {stale} users with stale challenges in "
+            f"{elapsed:.1f}s ({self.updated / elapsed if elapsed else 0:.2f} users/s), "
+            f"{len(self.failed)} failed"
+        )
+        return summary
+
+    def _target_images(self, host: Host) -> Dict[str, str]:
+        """Returns the image ID each challenge should run on the host."""
+        images = {}
+        for name, container in self.containers.items():
+            try:
+                if self.pull:
+                    host.docker.call(host.docker.client.images.pull, container["image"])
+                images[name] = host.docker.call(
+                    host.docker.client.api.inspect_image, container["image"]
+                )["Id"]
+            except (APIError, ImageNotFound) as e:
+                logger.error(
+                    f"Could not resolve {container['image']} on host {host.ip}: {e}"
+                )
+        return images
+
+    def _update_host(self, host: Host) -> int:
+        images = self._target_images(host=host)
+        # Containers of older versions have no labels and are known by their name.
+        listing = host.docker.call(host.docker.client.api.containers, all=True)
+
+        stale = {}
+        shared = []
+        pool = []
+        for container in listing:
+            labels = container.get("Labels") or {}
+            name = container["Names"][0].lstrip("/")
+            if name.startswith(("shared_", "pool_")):
+                kind, rest = name.split("_", 1)
+                role = labels.get(LABEL_ROLE, rest.rsplit("_", 1)[0])
+                role = role[len("shared_") :] if role.startswith("shared_") else role
+            else:
+                kind = "user"
+                role = labels.get(LABEL_ROLE, name.split("_", 1)[-1])
+            if role not in images or container["ImageID"] == images[role]:
+                continue
+            if kind == "shared":
+                shared.append((role, container))
+            elif kind == "pool":
+                pool.append((role, name))
+            else:
+                user = container_owner(name=name, labels=labels, users=self.users)
+                if user is not None:
+                    stale.setdefault(user, []).append((role, container))
+
+        for role, container in shared:
+            self._recreate_shared(host=host, role=role, container=container)
+        for role, name in pool:
+            # Refilled with the current image by the next create.
+            host.docker.call(host.docker.client.api.remove_container, name, force=True)
+            if name in host.containers:
+                host.containers.remove(name)
+
+        users = sorted(stale)
+        if not users:
+            logger.info(f"All challenges on host {host.ip} are up to date")
+            return 0
+        logger.info(
+            f"Host {host.ip}: {len(users)} users with stale challenges, "
+            f"update {self.wave_size} at a time"
+        )
+        start = time.monotonic()
+        done = 0
+        with ThreadPoolExecutor(max_workers=self.wave_size) as executor:
+            for index in range(0, len(users), self.wave_size):
+                wave = users[index : index + self.wave_size]
+                list(
+                    executor.map(
+                        lambda user: self._recreate_user(host, user, stale[user]), wave
+                    )
+                )
+                done += len(wave)
+                elapsed = time.monotonic() - start
+                logger.info(
+                    f"Host {host.ip}: {done}/{len(users)} users, "
+                    f"{done / elapsed if elapsed else 0:.2f} users/s"
+                )
+        return len(users)
+
+    def _address(self, container: dict, network: str) -> str:
+        networks = container.get("NetworkSettings", {}).get("Networks", {})
+        return networks.get(network, {}).get("IPAddress")
+
+    def _recreate_user(self, host: Host, user: str, containers: List[tuple]) -> None:
+        user_filtered = re.sub("[^A-Za-z0-9]+", "", user)
+        try:
+            if not os.path.isfile(f"{self.save_path}/data/{user}/client.ovpn"):
+                raise UpdateError(f"No data for {user} in {self.save_path}")
+            participant = Participant(user=user, save_path=self.save_path)
+            for role, container in containers:
+                address = self._address(container, f"{user_filtered}_network")
+                if not address:
+                    raise UpdateError(f"{container['Names'][0]} has no address")
+                index = int(ip_address(address)) - int(
+                    participant.subnet.network_address
+                )
+                spec = host.container_spec(
+                    user=user,
+                    container=self.containers[role],
+                    subnet=participant.subnet,
+                    index=index,
+                    environment=challenge_environment(
+                        user=user,
+                        secret=self.config.get("secret"),
+                        container=role,
+                        epoch=self.epoch,
+                    ),
+                )
+                # The old container is only removed once its replacement is created.
+                host.docker.replace_container(spec=spec)
+                if container["State"] != "running":
+                    # Containers of idle users stay suspended.
+                    host.docker.call(
+                        host.docker.client.api.stop, f"{user_filtered}_{role}"
+                    )
+        except (APIError, ImageNotFound, UpdateError) as e:
+            logger.error(f"Update of {user} on host {host.ip} failed: {e}")
+            with self.lock:
+                self.failed.append(user)
+            return
+        with self.lock:
+            self.updated += 1
+
+    def _recreate_shared(self, host: Host, role: str, container: dict) -> None:
+        """Recreates a shared instance and connects it to the same user networks again."""
+        name = container["Names"][0].lstrip("/")
+        users = {
+            f"{re.sub('[^A-Za-z0-9]+', '', u.name)}_network": u
+            for u in deployed_participants(save_path=self.save_path)
+        }
+        host.docker.call(host.docker.client.api.remove_container, name, force=True)
+        if name in host.containers:
+            host.containers.remove(name)
+        host.shared_networks.pop(name, None)
+        host.start_shared(
+            container=self.containers[role],
+            environment={"SECRET": self.config.get("secret"), "CHALLENGE": role},
+        )
+        for network in container.get("NetworkSettings", {}).get("Networks", {}):
+            user = users.get(network)
+            if user is None:
+                continue
+            address = self._address(container, network)
+            host.attach_shared(
+                user=user.name,
+                container=self.containers[role],
+                subnet=user.subnet,
+                index=int(ip_address(address)) - int(user.subnet.network_address),
+                flag=challenge_environment(
+                    user=user.name,
+                    secret=self.config.get("secret"),
+                    container=role,
+                    epoch=self.epoch,
+                )["FLAG"],
+            )
+        logger.info(f"Recreated shared {name} on host {host.ip}")
@@ -0,0 +1,218 @@
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from docker.errors import APIError
+from requests.exceptions import ConnectionError
+
+sys.path.append(os.getcwd())
+from src.docker_env import Docker
+from src.host import shared_replica
+from src.log_config import get_logger
+from src.participant import Participant
+from src.roster import deployed_participants
+
+logger = get_logger("ctf_creator.verify")
+
+GATEWAY = "gateway_openvpn"
+
+
+def _health(status: str) -> str:
+    """Returns the health of a container from its status, e.g. 'Up 3 minutes (healthy)'."""
+    match = re.search(r"\((healthy|unhealthy|health: starting)\)", status or "")
+    return match.group(1) if match else "none"
+
+
+class Verifier:
+    """
+    Checks that the deployed environment of every user actually works.
+
+    Every host is queried once for all its containers, including their state, health,
+    published ports and addresses. The reachability of the challenges is checked with one exec per user in the
+    user's OpenVPN container, which pings all challenge addresses at once. The hosts are
+    checked in parallel, the users of a host with a bounded number of workers.
+    """
+
+    def __init__(
+        self,
+        config: dict,
+        save_path: str,
+        kalibox: bool = False,
+        workers: int = 32,
+        timeout: int = 2,
+    ) -> None:
+        self.config = config
+        self.save_path = save_path
+        self.kalibox = kalibox
+        self.workers = workers
+        self.timeout = timeout
+        self.challenges = [c["name"] for c in config.get("containers")]
+        self.shared = {
+            c["name"]: c for c in config.get("containers") if c.get("shared")
+        }
+
+    def checks(self) -> List[str]:
+        names = ["openvpn", "port"] + self.challenges
+        if self.kalibox:
+            names.append("kali")
+        return names + ["reachable"]
+
+    def verify(self) -> Dict[str, dict]:
+        start = time.monotonic()
+        users = deployed_participants(save_path=self.save_path)
+        hosts = {str(h.get("ip")): h for h in self.config.get("hosts")}
+        by_host = {}
+        results = {}
+        for user in users:
+            if str(user.ip) in hosts:
+                by_host.setdefault(str(user.ip), []).append(user)
+            else:
+                results[user.name] = {"host": str(user.ip), "error": "unknown host"}
+
+        if by_host:
+            with ThreadPoolExecutor(max_workers=len(by_host)) as executor:
+                futures = [
+                    executor.submit(self._verify_host, hosts[ip], host_users)
+                    for ip, host_users in by_host.items()
+                ]
+                for future in futures:
+                    results.update(future.result())
+
+        failed = [u for u, r in results.items() if not r.get("ok")]
+        logger.info(
+            f"Verified {len(results)} users in {time.monotonic() - start:.1f}s, "
+            f"{len(failed)} failed"
+        )
+        return results
+
+    def _verify_host(self, host: dict, users: List[Participant]) -> Dict[str, dict]:
+        ip = str(host.get("ip"))
+        try:
+            docker = Docker(host=host)
+            containers = {
+                c["Names"][0].lstrip("/"): c
+                for c in docker.call(docker.client.api.containers, all=True)
+            }
+        except (APIError, ConnectionError) as e:
+            logger.error(f"Could not list the containers on host {ip}: {e}")
+            return {u.name: {"host": ip, "error": str(e)} for u in users}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {
+                user.name: executor.submit(self._verify_user, docker, containers, user)
+                for user in users
+            }
+            return {name: future.result() for name, future in futures.items()}
+
+    def _container_ok(self, container: dict) -> bool:
+        return (
+            container is not None
+            and container.get("State") == "running"
+            and _health(container.get("Status")) != "unhealthy"
+        )
+
+    def _verify_user(self, docker: Docker, containers: dict, user: Participant) -> dict:
+        user_filtered = re.sub("[^A-Za-z0-9]+", "", user.name)
+        network = f"{user_filtered}_network"
+        openvpn_name = GATEWAY if user.gateway else f"{user_filtered}_openvpn"
+        openvpn = containers.get(openvpn_name)
+        result = {"host": str(user.ip), "checks": {}, "details": {}}
+        checks = result["checks"]
+
+        checks["openvpn"] = self._container_ok(openvpn)
+        port = str(user.existing_openvpn_port)
+        checks["port"] = openvpn is not None and any(
+            str(p.get("PublicPort")) == port and p.get("Type") == "udp"
+            for p in openvpn.get("Ports", [])
+        )
+
+        names = self.challenges + (["kali"] if self.kalibox else [])
+        if user.metadata.get("lazy") and not user.metadata.get("materialized_at"):
+            # The challenges are created by monitor on the first connect.
+            for name in names + ["reachable"]:
+                checks[name] = True
+                result["details"][name] = "not materialized"
+            result["ok"] = all(checks.values())
+            return result
+
+        targets = {}
+        for name in names:
+            if name in self.shared:
+                container = containers.get(
+                    shared_replica(user=user.name, container=self.shared[name])
+                )
+            else:
+                container = containers.get(f"{user_filtered}_{name}")
+            checks[name] = self._container_ok(container)
+            if container is None:
+                result["details"][name] = "missing"
+                continue
+            result["details"][name] = container.get("Status")
+            address = (
+                container.get("NetworkSettings", {})
+                .get("Networks", {})
+                .get(network, {})
+                .get("IPAddress")
+            )
+            if address:
+                targets[name] = address
+            elif name in self.shared:
+                checks[name] = False
+                result["details"][name] = "not attached"
+
+        checks["reachable"] = False
+        if checks["openvpn"] and targets:
+            reached = self._ping(docker, openvpn_name, list(targets.values()))
+            unreachable = [n for n, a in targets.items() if a not in reached]
+            checks["reachable"] = not unreachable and len(targets) == len(names)
+            if unreachable:
+                result["details"]["reachable"] = f"unreachable: {unreachable}"
+
+        result["ok"] = all(checks.values())
+        return result
+
+    def _ping(self, docker: Docker, container: str, addresses: List[str]) -> set:
+        """Pings all addresses in parallel from within a container with a single exec."""
+        pings = " ".join(
+            f"(ping -c 1 -W {self.timeout} {a} >/dev/null 2>&1 && echo {a}) &"
+            for a in addresses
+        )
+        try:
+            exec_id = docker.call(
+                docker.client.api.exec_create, container, ["sh", "-c", f"{pings} wait"]
+            )
+            output = docker.call(docker.client.api.exec_start, exec_id)
+        except APIError as e:
+            logger.warning(f"Reachability check in {container} failed: {e}")
+            return set()
+        return set(output.decode().split())
+
+
+def print_matrix(results: Dict[str, dict], checks: List[str]) -> None:
+    """Prints one row per user with a pass or fail mark for each check."""
+    width = max([len(u) for u in results] + [4])
+    columns = [max(len(c), 4) for c in checks]
+    print(
+        f"{'user':<{width}}  {'host':<15}  "
+        + "  ".join(f"{c:<{w}}" for c, w in zip(checks, columns))
+    )
+    for user in sorted(results):
+        result = results[user]
+        if "error" in result:
+            print(f"{user:<{width}}  {result['host']:<15}  ERROR {result['error']}")
+            continue
+        marks = "  ".join(
+            f"{('PASS' if result['checks'].get(c) else 'FAIL'):<{w}}"
+            for c, w in zip(checks, columns)
+        )
+        print(f"{user:<{width}}  {result['host']:<15}  {marks}")
+
+
+def write_results(results: Dict[str, dict], path: str) -> None:
+    with open(f"{path}.part", "w") as file:
+        json.dump(results, file, indent=2)
+    os.replace(f"{path}.part", path)
@@ -0,0 +1,411 @@
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+from docker.errors import APIError, DockerException
+from requests.exceptions import RequestException
+
+sys.path.append(os.getcwd())
+from src.docker_env import Docker
+from src.host import Host, shared_replica
+from src.lazy import percentile
+from src.lease import retired_users
+from src.log_config import get_logger
+from src.naming import container_owner, filter_user
+from src.participant import Participant
+from src.roster import deployed_participants
+
+logger = get_logger("ctf_creator.watch")
+
+# Container states that need no repair. Paused containers belong to idle users.
+RUNNING = ("running", "paused", "restarting")
+EVENTS = ["create", "start", "restart", "die", "stop", "destroy", "pause", "unpause"]
+
+
+class Reconciler:
+    """
+    Keeps the deployed users of all hosts complete, driven by the Docker events of the
+    hosts instead of walking every user.
+
+    The containers and networks of each host are listed once and then kept up to date
+    from its event stream. An event that breaks a user, a removed container or network or
+    a container that died without being stopped, marks only this user for repair. After a
+    short grace period that collects related events, missing parts are recreated with
+    deploy_challenge and crashed containers are started again. The users of a host are
+    repaired one after another, the hosts in parallel. After a lost event stream, e.g. a
+    reboot, the host is listed again and all its users are checked.
+    """
+
+    def __init__(
+        self,
+        creator,
+        hosts: List[Host],
+        save_path: str,
+        grace: float = 5.0,
+        max_repairs: int = 3,
+        repair_window: float = 600.0,
+    ) -> None:
+        self.creator = creator
+        self.creator.hosts = hosts
+        self.hosts = {str(h.ip): h for h in hosts}
+        self.save_path = save_path
+        self.grace = grace
+        self.max_repairs = max_repairs
+        self.repair_window = repair_window
+        self.shared = {
+            c["name"]: c for c in creator.config.get("containers") if c.get("shared")
+        }
+
+        self.users = {ip: {} for ip in self.hosts}
+        for user in deployed_participants(save_path=save_path):
+            if str(user.ip) in self.users:
+                self.users[str(user.ip)][user.name] = user
+        self.networks = {
+            ip: {f"{self._prefix(name)}network": name for name in users}
+            for ip, users in self.users.items()
+        }
+        # Containers of older versions and claimed pool containers have no user label.
+        self.filtered = {
+            ip: {filter_user(name): name for name in users}
+            for ip, users in self.users.items()
+        }
+
+        self.lock = threading.Lock()
+        self.model = {
+            ip: {"containers": {}, "networks": set(), "connected": False}
+            for ip in self.hosts
+        }
+        self.dirty = {}
+        self.dying = {}
+        self.history = {}
+        self.latency = deque(maxlen=1000)
+        self.counters = {
+            "events": 0,
+            "repairs": 0,
+            "restarts": 0,
+            "failed": 0,
+            "throttled": 0,
+        }
+        self.last_event = {}
+        self.executors = {ip: ThreadPoolExecutor(max_workers=1) for ip in self.hosts}
+        self.busy = set()
+        self.stopped = threading.Event()
+
+    def _prefix(self, user: str) -> str:
+        return f"{re.sub('[^A-Za-z0-9]+', '', user)}_"
+
+    def _mark(self, ip: str, user: str, since: float = None) -> None:
+        """Marks a user for repair after the grace period."""
+        if user not in self.users[ip]:
+            return
+        now = time.time()
+        due, first = self.dirty.get((ip, user), (now + self.grace, since or now))
+        self.dirty[(ip, user)] = (due, min(first, since or now))
+
+    def _sync(self, ip: str, docker: Docker) -> None:
+        """Lists the containers and networks of a host and checks all its users."""
+        containers = {}
+        for c in docker.call(docker.client.api.containers, all=True):
+            name = c["Names"][0].lstrip("/")
+            user = container_owner(
+                name=name, labels=c.get("Labels") or {}, users=self.filtered[ip]
+            )
+            containers[name] = {"state": c["State"], "user": user or ""}
+        networks = {n["Name"] for n in docker.call(docker.client.api.networks)}
+        with self.lock:
+            self.model[ip].update(
+                containers=containers, networks=networks, connected=True
+            )
+            for name, container in containers.items():
+                if container["state"] not in RUNNING:
+                    # Unknown why it exited, e.g. a reboot, so it counts as crashed.
+                    self.dying[(ip, name)] = time.time()
+            for user in self.users[ip]:
+                self._mark(ip=ip, user=user)
+        logger.info(
+            f"Host {ip}: {len(containers)} containers and {len(networks)} networks, "
+            f"check {len(self.users[ip])} users"
+        )
+
+    def _listen(self, ip: str) -> None:
+        """Follows the event stream of a host, reconnects and lists it again if lost."""
+        while not self.stopped.is_set():
+            try:
+                docker = Docker(host=self.hosts[ip].host)
+                since = int(time.time())
+                self._sync(ip=ip, docker=docker)
+                for event in docker.client.api.events(
+                    since=since,
+                    decode=True,
+                    filters={"type": ["container", "network"], "event": EVENTS},
+                ):
+                    if self.stopped.is_set():
+                        return
+                    self._handle(ip=ip, event=event)
+            except (APIError, DockerException, RequestException, OSError) as e:
+                logger.error(f"Event stream of host {ip} lost: {e}")
+            with self.lock:
+                self.model[ip]["connected"] = False
+            self.stopped.wait(5)
+
+    def _handle(self, ip: str, event: dict) -> None:
+        action = event.get("Action", "")
+        attributes = event.get("Actor", {}).get("Attributes", {})
+        name = attributes.get("name", "")
+        now = time.time()
+        with self.lock:
+            self.counters["events"] += 1
+            self.last_event[ip] = now
+            model = self.model[ip]
+            if event.get("Type") == "network":
+                if action == "create":
+                    model["networks"].add(name)
+                elif action == "destroy":
+                    model["networks"].discard(name)
+                    self._mark(ip=ip, user=self.networks[ip].get(name), since=now)
+                return
+
+            user = (
+                container_owner(name=name, labels=attributes, users=self.filtered[ip])
+                or ""
+            )
+            container = model["containers"].setdefault(
+                name, {"state": "created", "user": user}
+            )
+            if action in ("start", "unpause", "restart"):
+                container["state"] = "running"
+            elif action == "pause":
+                container["state"] = "paused"
+            elif action == "die":
+                container["state"] = "exited"
+                # A stop event follows if the container was stopped on purpose.
+                self.dying[(ip, name)] = now
+                self._mark(ip=ip, user=user, since=now)
+            elif action == "stop":
+                container["state"] = "exited"
+                self.dying.pop((ip, name), None)
+            elif action == "destroy":
+                model["containers"].pop(name, None)
+                self.dying.pop((ip, name), None)
+                if name.startswith("shared_"):
+                    self._shared_lost(ip=ip, name=name, since=now)
+                else:
+                    self._mark(ip=ip, user=user, since=now)
+            if name == "gateway_openvpn" and action in ("die", "destroy"):
+                self.hosts[ip].shared_networks.pop(name, None)
+                for gateway_user in self.users[ip].values():
+                    if gateway_user.gateway:
+                        self._mark(ip=ip, user=gateway_user.name, since=now)
+
+    def _shared_lost(self, ip: str, name: str, since: float) -> None:
+        """Marks the users served by a removed shared instance."""
+        self.hosts[ip].shared_networks.pop(name, None)
+        for container in self.shared.values():
+            for user in self.users[ip]:
+                if shared_replica(user=user, container=container) == name:
+                    self._mark(ip=ip, user=user, since=since)
+
+    def _suspended(self) -> set:
+        """The users whose containers the idle manager stopped."""
+        path = f"{self.save_path}/idle.json"
+        if not os.path.exists(path):
+            return set()
+        try:
+            with open(path, "r") as file:
+                state = json.load(file)
+        except (OSError, json.JSONDecodeError):
+            return set()
+        return {user for user, s in state.items() if s.get("suspended")}
+
+    def _allowed(self, user: str, now: float) -> bool:
+        """Limits the repairs of a user, so a crashing container is not restarted forever."""
+        history = self.history.setdefault(user, deque())
+        while history and now - history[0] > self.repair_window:
+            history.popleft()
+        if len(history) >= self.max_repairs:
+            return False
+        history.append(now)
+        return True
+
+    def reconcile(self) -> None:
+        """Hands the users whose grace period ended to the repair worker of their host."""
+        now = time.time()
+        with self.lock:
+            due = [
+                (key, first)
+                for key, (at, first) in self.dirty.items()
+                if at <= now
+                and key not in self.busy
+                and self.model[key[0]]["connected"]
+            ]
+            for key, _ in due:
+                del self.dirty[key]
+                self.busy.add(key)
+        for (ip, user), first in due:
+            self.executors[ip].submit(self._repair, ip, user, first)
+
+    def _repair(self, ip: str, name: str, first: float) -> None:
+        host = self.hosts[ip]
+        prefix = self._prefix(name)
+        try:
+            user = Participant(user=name, save_path=self.save_path)
+            if (
+                name in retired_users(save_path=self.save_path)
+                or not os.path.isfile(f"{self.save_path}/data/{name}/client.ovpn")
+                or str(user.ip) != ip
+            ):
+                # Retired by gc or moved by rebalance, removed on purpose.
+                logger.info(f"{name} is no longer deployed on host {ip}, stop watching")
+                with self.lock:
+                    self.users[ip].pop(name, None)
+                return
+            lazy = self.creator._is_lazy(user=user)
+            expected = self.creator._user_containers(lazy=lazy)
+            with self.lock:
+                containers = dict(self.model[ip]["containers"])
+                networks = set(self.model[ip]["networks"])
+                crashed = {
+                    n for (i, n), _ in self.dying.items() if i == ip and n in containers
+                }
+
+            missing = [] if f"{prefix}network" in networks else ["network"]
+            stopped = []
+            suspended = name in self._suspended()
+            for container in expected:
+                if container in self.shared:
+                    replica = shared_replica(
+                        user=name, container=self.shared[container]
+                    )
+                    if replica not in containers:
+                        missing.append(container)
+                    continue
+                if container == "openvpn" and user.gateway:
+                    container_name = "gateway_openvpn"
+                else:
+                    container_name = f"{prefix}{container}"
+                if container_name not in containers:
+                    missing.append(container)
+                elif containers[container_name]["state"] in RUNNING:
+                    continue
+                elif container == "openvpn" or (
+                    # The idle manager stops the challenges of suspended users.
+                    container_name in crashed
+                    and not suspended
+                ):
+                    stopped.append(container_name)
+            if not missing and not stopped:
+                return
+            if not self._allowed(user=name, now=time.time()):
+                logger.warning(
+                    f"{name} on host {ip} was repaired {self.max_repairs} times in "
+                    f"{self.repair_window:.0f}s, skip until the window passed"
+                )
+                with self.lock:
+                    self.counters["throttled"] += 1
+                return
+
+            if missing:
+                # deploy_challenge decides from the lists of the host.
+                host.containers = list(containers)
+                host.networks = list(networks)
+                for container in [c for c in missing if c in self.shared]:
+                    host.start_shared(
+                        container=self.shared[container],
+                        environment={
+                            "SECRET": self.creator.config.get("secret"),
+                            "CHALLENGE": container,
+                        },
+                    )
+                self.creator.deploy_challenge(user, host)
+            for container_name in stopped:
+                host.docker.call(host.docker.client.api.start, container_name)
+            with self.lock:
+                self.counters["repairs" if missing else "restarts"] += 1
+                self.latency.append(time.time() - first)
+                for container_name in stopped:
+                    self.dying.pop((ip, container_name), None)
+            logger.info(
+                f"Repaired {name} on host {ip} {time.time() - first:.1f}s after the "
+                f"failure: recreated {missing}, started {stopped}"
+            )
+        except Exception as e:
+            logger.error(f"Repair of {name} on host {ip} failed: {e}")
+            with self.lock:
+                self.counters["failed"] += 1
+        finally:
+            with self.lock:
+                self.busy.discard((ip, name))
+
+    def status(self) -> dict:
+        with self.lock:
+            latency = list(self.latency)
+            return {
+                "hosts": {
+                    ip: {
+                        "connected": model["connected"],
+                        "containers": len(model["containers"]),
+                        "networks": len(model["networks"]),
+                        "users": len(self.users[ip]),
+                        "last_event": self.last_event.get(ip),
+                    }
+                    for ip, model in self.model.items()
+                },
+                "pending": len(self.dirty) + len(self.busy),
+                **self.counters,
+                "repair_seconds": {
+                    "p50": round(percentile(latency, 50), 1) if latency else None,
+                    "p95": round(percentile(latency, 95), 1) if latency else None,
+                },
+            }
+
+    def serve(self, port: int) -> ThreadingHTTPServer:
+        reconciler = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/status":
+                    self.send_error(404)
+                    return
+                body = json.dumps(reconciler.status(), indent=2).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        server = ThreadingHTTPServer(("", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info(f"Serve the status on port {port} at /status")
+        return server
+
+    def run(self, port: int = None, interval: float = 1.0) -> None:
+        logger.info(
+            f"Watch {sum(len(u) for u in self.users.values())} users on "
+            f"{len(self.hosts)} hosts"
+        )
+        for ip in self.hosts:
+            threading.Thread(target=self._listen, args=(ip,), daemon=True).start()
+        server = self.serve(port=port) if port else None
+        try:
+            while True:
+                time.sleep(interval)
+                self.reconcile()
+        except KeyboardInterrupt:
+            logger.info("Watch stopped.")
+        finally:
+            self.stopped.set()
+            if server:
+                server.shutdown()
+            for executor in self.executors.values():
+                executor.shutdown(wait=True)
+            self.creator.journal.close()
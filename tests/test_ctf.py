@@ -0,0 +1,19 @@
+import os
+import sys
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+from docker.errors import NotFound
+
+sys.path.append(os.getcwd())
+from src.ctf import CTFCreator, OpenVPNError
+
+
+def test_openvpn_config_raises_instead_of_exiting():
+    creator = CTFCreator.__new__(CTFCreator)
+    creator._local_docker = mock.Mock()
+    creator._local_docker.containers.get.side_effect = NotFound("gone")
+    creator.local_docker_openvpn = "local_openvpn"
+    with pytest.raises(OpenVPNError):
+        creator._openvpn_config(user=SimpleNamespace(name="alice"))
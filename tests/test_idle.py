@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+
+sys.path.append(os.getcwd())
+from src.ctf import CTFCreator
+from src.idle import IdleManager
+
+
+class FakeHost:
+    ip = "192.0.2.10"
+    username = "ctf"
+
+
+class FakeUser:
+    def __init__(self, name: str, metadata: dict) -> None:
+        self.name = name
+        self.metadata = metadata
+        self.written = 0
+
+    def write_metadata(self) -> None:
+        self.written += 1
+
+
+def manager(tmp_path, on_connect) -> IdleManager:
+    return IdleManager(
+        hosts=[],
+        users=[],
+        challenges=["web", "db"],
+        save_path=str(tmp_path),
+        on_connect=on_connect,
+    )
+
+
+def test_connect_hands_the_user_and_host_to_the_callback(tmp_path):
+    calls = []
+    idle = manager(tmp_path, on_connect=lambda **kwargs: calls.append(kwargs))
+    host, user = FakeHost(), FakeUser(name="alice", metadata={})
+    idle.connecting.add(user.name)
+
+    idle._connect(host, user, {"alice_openvpn": {}}, 10.0)
+
+    assert calls == [
+        {"user": user, "host": host, "containers": {"alice_openvpn": {}}, "since": 10.0}
+    ]
+    assert user.name not in idle.connecting
+
+
+def test_connect_failure_is_logged_and_retried_later(tmp_path):
+    def on_connect(**kwargs):
+        raise RuntimeError("host down")
+
+    idle = manager(tmp_path, on_connect=on_connect)
+    user = FakeUser(name="alice", metadata={})
+    idle.connecting.add(user.name)
+
+    idle._connect(FakeHost(), user, {}, None)
+
+    assert user.name not in idle.connecting
+
+
+def test_connect_materializes_a_lazy_user(tmp_path):
+    creator = CTFCreator.__new__(CTFCreator)
+    creator.config = {"containers": [{"name": "web"}, {"name": "db"}]}
+    creator.ready_target = 30
+    started = []
+    creator._start_challenges = lambda **kwargs: started.append(kwargs)
+    host, user = FakeHost(), FakeUser(name="alice", metadata={"lazy": True})
+    containers = {
+        "alice_openvpn": {"NetworkSettings": {"Networks": {}}},
+        "alice_web": {
+            "NetworkSettings": {
+                "Networks": {"alice_network": {"IPAddress": "10.13.0.7"}}
+            }
+        },
+    }
+
+    idle = manager(tmp_path, on_connect=creator.materialize)
+    idle._connect(host, user, containers, time.time())
+
+    assert len(started) == 1
+    assert started[0]["user"] is user
+    assert started[0]["host"] is host
+    assert started[0]["running"] == ["web"]
+    assert started[0]["used_ip"] == [7]
+    assert user.metadata["materialized_at"]
+    assert user.written == 1
+
+    # Materialized users are not started again.
+    idle._connect(host, user, containers, time.time())
+    assert len(started) == 1
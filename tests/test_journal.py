@@ -0,0 +1,117 @@
+import json
+import os
+import sys
+
+sys.path.append(os.getcwd())
+import src.journal
+from src.journal import DATA_GENERATED, NETWORK, OPENVPN, Journal, container_step
+
+
+def entries(path) -> list:
+    with open(path, "r") as file:
+        return [json.loads(line) for line in file]
+
+
+def test_steps_survive_a_restart(tmp_path):
+    journal = Journal(save_path=str(tmp_path))
+    journal.record(user="alice", step=NETWORK)
+    journal.record(user="alice", step=container_step("web"))
+    journal.file.close()
+
+    journal = Journal(save_path=str(tmp_path))
+    assert journal.completed(user="alice") == {NETWORK, "container:web"}
+    assert not journal.done(user="bob", step=NETWORK)
+
+
+def test_reset_keeps_only_the_generated_data(tmp_path):
+    journal = Journal(save_path=str(tmp_path))
+    for step in (DATA_GENERATED, NETWORK, OPENVPN):
+        journal.record(user="alice", step=step)
+    journal.reset(user="alice")
+    journal.record(user="alice", step=NETWORK)
+    assert journal.completed(user="alice") == {DATA_GENERATED, NETWORK}
+    journal.file.close()
+
+    assert Journal(save_path=str(tmp_path)).completed(user="alice") == {
+        DATA_GENERATED,
+        NETWORK,
+    }
+
+
+def test_damaged_last_line_is_skipped(tmp_path):
+    (tmp_path / "journal.jsonl").write_text(
+        '{"time": 1, "user": "alice", "step": "network"}\n{"time": 2, "user": "al'
+    )
+    journal = Journal(save_path=str(tmp_path))
+    journal.record(user="bob", step=NETWORK)
+    journal.file.close()
+
+    assert Journal(save_path=str(tmp_path)).completed(user="bob") == {NETWORK}
+    last = (tmp_path / "journal.jsonl").read_text().splitlines()[-1]
+    assert json.loads(last)["user"] == "bob"
+
+
+def test_close_compacts_to_the_current_steps(tmp_path):
+    journal = Journal(save_path=str(tmp_path))
+    for _ in range(3):
+        journal.record(user="alice", step=NETWORK)
+        journal.reset(user="alice")
+    journal.record(user="alice", step=OPENVPN)
+    journal.close()
+    journal.close()
+
+    assert [(e["user"], e["step"]) for e in entries(tmp_path / "journal.jsonl")] == [
+        ("alice", OPENVPN)
+    ]
+
+
+def test_compacts_while_recording(tmp_path, monkeypatch):
+    monkeypatch.setattr(src.journal, "COMPACT_SIZE", 200)
+    journal = Journal(save_path=str(tmp_path))
+    for _ in range(10):
+        journal.record(user="alice", step=NETWORK)
+    assert len(entries(tmp_path / "journal.jsonl")) < 10
+    journal.record(user="alice", step=OPENVPN)
+    journal.file.close()
+
+    assert Journal(save_path=str(tmp_path)).completed(user="alice") == {
+        NETWORK,
+        OPENVPN,
+    }
+
+
+def test_shared_journal_is_not_compacted(tmp_path):
+    journal = Journal(save_path=str(tmp_path))
+    journal.compact = False
+    journal.record(user="alice", step=NETWORK)
+    journal.record(user="alice", step=NETWORK)
+    journal.close()
+    assert len(entries(tmp_path / "journal.jsonl")) == 2
+
+
+def test_reload_reads_the_steps_of_other_processes(tmp_path):
+    journal = Journal(save_path=str(tmp_path))
+    journal.record(user="alice", step=NETWORK)
+    worker = Journal(save_path=str(tmp_path))
+    worker.compact = False
+    worker.record(user="bob", step=OPENVPN)
+    worker.close()
+
+    journal.reload()
+    assert journal.completed(user="bob") == {OPENVPN}
+    journal.close()
+    assert Journal(save_path=str(tmp_path)).completed(user="bob") == {OPENVPN}
+
+
+def test_read_only_journal_leaves_the_file_alone(tmp_path):
+    journal = Journal(save_path=str(tmp_path))
+    journal.record(user="alice", step=NETWORK)
+    journal.close()
+    before = (tmp_path / "journal.jsonl").read_text()
+
+    monitor = Journal(save_path=str(tmp_path), read_only=True)
+    monitor.record(user="alice", step=OPENVPN)
+    monitor.close()
+
+    assert monitor.done(user="alice", step=OPENVPN)
+    assert (tmp_path / "journal.jsonl").read_text() == before
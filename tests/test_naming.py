@@ -0,0 +1,25 @@
+import os
+import sys
+
+sys.path.append(os.getcwd())
+from src.naming import LABEL_USER, container_owner, filter_user
+
+USERS = {filter_user("alice.smith"): "alice.smith", filter_user("bob"): "bob"}
+
+
+def test_owner_from_the_user_label():
+    labels = {LABEL_USER: "bob"}
+    assert container_owner(name="alicesmith_web", labels=labels, users=USERS) == "bob"
+
+
+def test_owner_from_the_name_without_label():
+    assert container_owner(name="alicesmith_web", labels={}, users=USERS) == (
+        "alice.smith"
+    )
+    assert container_owner(name="bob_openvpn", labels={}, users=USERS) == "bob"
+
+
+def test_containers_of_unknown_users_have_no_owner():
+    assert container_owner(name="carol_web", labels={}, users=USERS) is None
+    assert container_owner(name="gateway", labels={}, users=USERS) is None
+    assert container_owner(name="bob", labels={}, users=USERS) is None
@@ -0,0 +1,107 @@
+import os
+import sys
+from ipaddress import ip_network
+
+import pytest
+
+sys.path.append(os.getcwd())
+from src.openvpn import (
+    GATEWAY_FIREWALL,
+    GATEWAY_NETWORK,
+    MASQUERADE_LINE,
+    SERVER_CONF,
+    START_SCRIPT,
+    STATUS_LOG,
+    TemplateError,
+    next_tunnel_ip,
+    render_gateway_start_script,
+    render_server_conf,
+    render_start_script,
+    write_gateway_files,
+)
+
+ORIGINAL_CONF = """port 1194
+proto udp
+server 10.8.0.0 255.255.255.0
+push "redirect-gateway def1 bypass-dhcp"
+push "dhcp-option DNS 8.8.8.8"
+status /tmp/openvpn-status.log
+"""
+ORIGINAL_SCRIPT = f"""#!/bin/sh
+if true; then
+    {MASQUERADE_LINE}
+fi
+openvpn --config /etc/openvpn/server.conf
+"""
+SUBNET = ip_network("10.13.0.0/24")
+
+
+def test_server_conf_pushes_only_the_user_subnet():
+    conf = render_server_conf(ORIGINAL_CONF, SUBNET).splitlines()
+    assert 'push "route 10.13.0.0 255.255.255.0"' in conf
+    assert not any(line.startswith('push "redirect-gateway') for line in conf)
+    assert not any(line.startswith('push "dhcp-option DNS') for line in conf)
+    assert "port 1194" in conf
+
+
+def test_server_conf_writes_the_status_log():
+    conf = render_server_conf(ORIGINAL_CONF, SUBNET).splitlines()
+    assert [line for line in conf if line.startswith("status")] == [
+        f"status {STATUS_LOG} 1",
+        "status-version 2",
+    ]
+
+
+def test_start_script_restricts_the_tunnel_after_the_nat_rule():
+    lines = render_start_script(ORIGINAL_SCRIPT, SUBNET).splitlines()
+    nat = lines.index(f"    {MASQUERADE_LINE}")
+    assert lines[nat + 1] == f"    iptables -A INPUT -s {SUBNET} -j ACCEPT"
+    assert "    iptables -A INPUT -j DROP" in lines
+    assert lines[-1] == "openvpn --config /etc/openvpn/server.conf"
+
+
+def test_start_script_without_nat_rule():
+    with pytest.raises(TemplateError):
+        render_start_script("#!/bin/sh\n", SUBNET)
+
+
+def test_gateway_start_script_drops_forwarding_by_default():
+    lines = [
+        line.strip()
+        for line in render_gateway_start_script(ORIGINAL_SCRIPT).splitlines()
+    ]
+    assert MASQUERADE_LINE not in lines
+    policy = lines.index("iptables -P FORWARD DROP")
+    firewall = lines.index(f"sh {GATEWAY_FIREWALL}")
+    assert policy < firewall
+    # Traffic between the user networks is dropped after the rules of the clients.
+    assert lines.index(f"iptables -A FORWARD ! -s {GATEWAY_NETWORK} -j DROP") > firewall
+    assert lines.index(f"iptables -A FORWARD -s {GATEWAY_NETWORK} -j DROP") > firewall
+
+
+def test_gateway_start_script_without_nat_rule():
+    with pytest.raises(TemplateError):
+        render_gateway_start_script("#!/bin/sh\n")
+
+
+def test_next_tunnel_ip_skips_the_server_and_used_addresses():
+    assert next_tunnel_ip({}) == "10.8.0.2"
+    clients = {"a": {"tunnel_ip": "10.8.0.2"}, "b": {"tunnel_ip": "10.8.0.3"}}
+    assert next_tunnel_ip(clients) == "10.8.0.4"
+
+
+def test_gateway_firewall_allows_each_client_only_its_subnet(tmp_path):
+    clients = {
+        "client1": {"tunnel_ip": "10.8.0.2", "subnet": "10.13.0.0/24"},
+        "client2": {"tunnel_ip": "10.8.0.3", "subnet": "10.13.1.0/24"},
+    }
+    templates = {SERVER_CONF: ORIGINAL_CONF, START_SCRIPT: ORIGINAL_SCRIPT}
+    write_gateway_files(templates=templates, clients=clients, path=str(tmp_path))
+
+    firewall = (tmp_path / "server" / "firewall.sh").read_text()
+    assert "FORWARD -s 10.8.0.2 -d 10.13.0.0/24 -j ACCEPT" in firewall
+    assert "FORWARD -s 10.8.0.3 -d 10.13.1.0/24 -j ACCEPT" in firewall
+    assert "-s 10.8.0.2 -d 10.13.1.0/24" not in firewall
+    ccd = (tmp_path / "ccd" / "client1").read_text()
+    assert ccd.startswith("ifconfig-push 10.8.0.2 ")
+    assert 'push "route 10.13.0.0 255.255.255.0"' in ccd
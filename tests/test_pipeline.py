@@ -0,0 +1,70 @@
+import os
+import sys
+import threading
+
+sys.path.append(os.getcwd())
+from src.pipeline import Pipeline
+
+
+def test_items_pass_all_stages():
+    done = []
+    lock = threading.Lock()
+
+    def deploy(item):
+        with lock:
+            done.append(item)
+
+    pipeline = Pipeline(
+        stages=[("generate", lambda i: i * 10, 1), ("deploy", deploy, 3)],
+        queue_size=2,
+    )
+    assert pipeline.run(range(20)) == []
+    assert sorted(done) == [i * 10 for i in range(20)]
+    stats = pipeline.stats()
+    assert stats["generate"]["processed"] == stats["deploy"]["processed"] == 20
+    assert stats["deploy"]["max_depth"] <= 2
+
+
+def test_none_drops_the_item():
+    done = []
+    pipeline = Pipeline(
+        stages=[
+            ("filter", lambda i: i if i % 2 else None, 1),
+            ("deploy", done.append, 1),
+        ]
+    )
+    pipeline.run(range(6))
+    assert done == [1, 3, 5]
+
+
+def test_failed_items_are_reported_and_the_others_go_on():
+    def generate(item):
+        if item == 3:
+            raise RuntimeError("no profile")
+        return item
+
+    done = []
+    pipeline = Pipeline(
+        stages=[("generate", generate, 1), ("deploy", done.append, 1)], queue_size=1
+    )
+    assert pipeline.run(range(10)) == [("3", "generate")]
+    assert sorted(done) == [0, 1, 2, 4, 5, 6, 7, 8, 9]
+    assert pipeline.stats()["generate"]["failed"] == 1
+
+
+def test_exit_in_a_stage_does_not_block_the_run():
+    def generate(item):
+        if item < 3:
+            exit(1)
+        return item
+
+    done = []
+    pipeline = Pipeline(
+        stages=[("generate", generate, 1), ("deploy", done.append, 1)], queue_size=1
+    )
+    worker = threading.Thread(target=pipeline.run, args=(range(20),), daemon=True)
+    worker.start()
+    worker.join(timeout=10)
+    assert not worker.is_alive()
+    assert len(pipeline.failed) == 3
+    assert len(done) == 17
@@ -0,0 +1,55 @@
+import os
+import sys
+from ipaddress import ip_network
+
+sys.path.append(os.getcwd())
+from src.plan import firewall_present, parse_inventory
+
+SUBNET = ip_network("10.13.0.0/24")
+OUTPUT = "\r\n".join(
+    [
+        "c\talice_openvpn\trunning\talice_network\talice",
+        "c\talice_web\texited\talice_network,bridge\t",
+        "c\tpool_web_0\tcreated\t\t",
+        "n\talice_network",
+        "n\tbridge",
+        "d\t/home/ctf/ctf-data/alice/Dockovpn_data",
+        "f\t-P FORWARD DROP",
+        "f\t-A DOCKER-USER -s 10.13.0.2/32 -p udp -m udp --dport 45001 -j ACCEPT",
+        "f\t-A DOCKER-USER -s 10.13.0.0/24 -m state --state RELATED,ESTABLISHED -j RETURN",
+        "f\t-A INPUT -d 10.13.0.1/32 -j REJECT --reject-with icmp-port-unreachable",
+        "f\t-A FORWARD -d 10.13.0.1/32 -j REJECT --reject-with icmp-port-unreachable",
+        "unexpected line",
+    ]
+)
+
+
+def test_parse_inventory():
+    inventory = parse_inventory(OUTPUT)
+    assert inventory["containers"]["alice_openvpn"] == {
+        "state": "running",
+        "networks": {"alice_network"},
+        "user": "alice",
+    }
+    assert inventory["containers"]["alice_web"]["networks"] == {
+        "alice_network",
+        "bridge",
+    }
+    assert inventory["containers"]["pool_web_0"]["networks"] == set()
+    assert inventory["networks"] == {"alice_network", "bridge"}
+    assert inventory["data"] == {"alice"}
+    assert len(inventory["firewall"]) == 4
+
+
+def test_firewall_present_with_implicit_matches():
+    inventory = parse_inventory(OUTPUT)
+    assert firewall_present(inventory, openvpn_port=45001, subnet=SUBNET)
+
+
+def test_firewall_missing_rules():
+    inventory = parse_inventory(OUTPUT)
+    assert not firewall_present(inventory, openvpn_port=45002, subnet=SUBNET)
+    assert not firewall_present(
+        inventory, openvpn_port=45001, subnet=ip_network("10.13.1.0/24")
+    )
+    assert not firewall_present({}, openvpn_port=45001, subnet=SUBNET)
@@ -0,0 +1,56 @@
+import os
+import sys
+from collections import Counter
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.append(os.getcwd())
+from src.rebalance import plan_moves
+
+HOSTS = ["10.0.0.1", "10.0.0.2", "10.0.0.3"]
+
+
+def users(counts: dict) -> list:
+    return [
+        SimpleNamespace(name=f"{ip}-{index:02d}", ip=ip)
+        for ip, count in counts.items()
+        for index in range(count)
+    ]
+
+
+def load(all_users: list, moves: list) -> Counter:
+    targets = {user.name: target for user, target in moves}
+    return Counter(targets.get(u.name, u.ip) for u in all_users)
+
+
+def test_users_are_spread_evenly_over_a_new_host():
+    all_users = users({"10.0.0.1": 6, "10.0.0.2": 6})
+    moves = plan_moves(users=all_users, hosts=HOSTS)
+    assert load(all_users, moves) == {"10.0.0.1": 4, "10.0.0.2": 4, "10.0.0.3": 4}
+    assert all(target == "10.0.0.3" for _, target in moves)
+
+
+def test_balanced_hosts_need_no_moves():
+    all_users = users({"10.0.0.1": 2, "10.0.0.2": 2, "10.0.0.3": 1})
+    assert plan_moves(users=all_users, hosts=HOSTS) == []
+
+
+def test_drained_and_removed_hosts_are_emptied():
+    all_users = users({"10.0.0.1": 2, "10.0.0.2": 2, "10.0.0.9": 2})
+    moves = plan_moves(users=all_users, hosts=HOSTS, drain=["10.0.0.1"])
+    after = load(all_users, moves)
+    assert after["10.0.0.1"] == 0
+    assert after["10.0.0.9"] == 0
+    assert after["10.0.0.2"] == after["10.0.0.3"] == 3
+
+
+def test_max_moves_starts_with_the_stranded_users():
+    all_users = users({"10.0.0.1": 6, "10.0.0.9": 1})
+    moves = plan_moves(users=all_users, hosts=HOSTS, max_moves=1)
+    assert [(user.ip, target) for user, target in moves] == [("10.0.0.9", "10.0.0.2")]
+
+
+def test_nothing_left_to_move_to():
+    with pytest.raises(ValueError):
+        plan_moves(users=users({"10.0.0.1": 1}), hosts=["10.0.0.1"], drain=["10.0.0.1"])
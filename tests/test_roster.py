@@ -0,0 +1,59 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.getcwd())
+from src.roster import Roster, RosterError, UserValidator, read_users
+
+
+@pytest.mark.parametrize("user", ["alice", "alice smith", "jörg", "a.b+ctf@x.de"])
+def test_validator_accepts_names_of_the_configuration(user):
+    assert UserValidator().validate(user=user, source="test") == user
+
+
+@pytest.mark.parametrize("user", ["", ".", "..", "a/b", "  ", "!!", None, 42])
+def test_validator_rejects_names_without_a_folder_or_container_name(user):
+    with pytest.raises(RosterError):
+        UserValidator().validate(user=user, source="test")
+
+
+def test_validator_rejects_duplicates_and_collisions():
+    validator = UserValidator()
+    validator.validate(user="alice.smith", source="test")
+    with pytest.raises(RosterError, match="Duplicate"):
+        validator.validate(user="alice.smith", source="test")
+    with pytest.raises(RosterError, match="collides with alice.smith"):
+        validator.validate(user="alice-smith", source="test")
+
+
+def test_read_users_from_csv_skips_the_header(tmp_path):
+    path = tmp_path / "users.csv"
+    path.write_text("email,team\nalice@x.de,red\n\nbob@x.de,blue\n")
+    assert list(read_users(str(path))) == ["alice@x.de", "bob@x.de"]
+
+
+def test_read_users_from_json_lines(tmp_path):
+    path = tmp_path / "users.jsonl"
+    path.write_text('"alice"\n{"user": "bob"}\n{"email": "carol@x.de"}\n')
+    assert list(read_users(str(path))) == ["alice", "bob", "carol@x.de"]
+
+
+def test_read_users_reports_the_line(tmp_path):
+    path = tmp_path / "users.csv"
+    path.write_text("alice\nalice\n")
+    with pytest.raises(RosterError, match="users.csv:2"):
+        list(read_users(str(path)))
+
+
+def test_read_users_rejects_unknown_formats(tmp_path):
+    with pytest.raises(RosterError):
+        list(read_users(str(tmp_path / "users.txt")))
+
+
+def test_roster_snapshot(tmp_path):
+    roster = Roster(save_path=str(tmp_path))
+    assert roster.load() == set()
+    roster.save(["bob", "alice"])
+    assert roster.load() == {"alice", "bob"}
+    assert (tmp_path / "roster.txt").read_text() == "alice\nbob\n"
@@ -0,0 +1,94 @@
+import os
+import sys
+
+import pytest
+from docker.errors import APIError
+from requests import Response
+from requests.exceptions import ConnectionError
+
+sys.path.append(os.getcwd())
+from src.throttle import AdmissionController, is_transient
+
+
+def api_error(status: int) -> APIError:
+    response = Response()
+    response.status_code = status
+    return APIError("error", response=response)
+
+
+class Flaky:
+    """Fails with the given errors first, then succeeds."""
+
+    def __init__(self, *errors: Exception) -> None:
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "done"
+
+
+def test_transient_errors():
+    assert is_transient(ConnectionError())
+    assert is_transient(api_error(500))
+    assert is_transient(api_error(429))
+    assert not is_transient(api_error(409))
+    assert not is_transient(ValueError())
+
+
+def test_limit_grows_additively_and_is_halved_on_errors():
+    controller = AdmissionController(name="test", initial=4, retries=0, backoff=0)
+    for _ in range(4):
+        controller.call(lambda: None)
+    assert controller.limit == pytest.approx(5.0, abs=0.1)
+
+    with pytest.raises(APIError):
+        controller.call(Flaky(api_error(500)))
+    assert int(controller.limit) == 2
+    assert controller.stats()["errors"] == 1
+
+
+def test_slow_calls_halve_the_limit():
+    controller = AdmissionController(name="test", initial=8, target_latency=-1)
+    controller.call(lambda: None)
+    assert controller.limit == 4
+
+
+def test_limit_stays_within_its_bounds():
+    controller = AdmissionController(
+        name="test", initial=2, minimum=2, maximum=3, retries=0, backoff=0
+    )
+    with pytest.raises(APIError):
+        controller.call(Flaky(api_error(503)))
+    assert controller.limit == 2
+    for _ in range(20):
+        controller.call(lambda: None)
+    assert controller.limit == 3
+
+
+def test_call_retries_transient_errors():
+    controller = AdmissionController(name="test", retries=2, backoff=0)
+    function = Flaky(api_error(500), ConnectionError())
+    assert controller.call(function) == "done"
+    assert function.calls == 3
+    assert controller.stats()["retried"] == 2
+
+
+def test_call_does_not_retry_client_errors():
+    controller = AdmissionController(name="test", retries=2, backoff=0)
+    function = Flaky(api_error(409))
+    with pytest.raises(APIError):
+        controller.call(function)
+    assert function.calls == 1
+
+
+def test_call_once_never_retries():
+    controller = AdmissionController(name="test", retries=4, backoff=0)
+    function = Flaky(api_error(500))
+    with pytest.raises(APIError):
+        controller.call_once(function)
+    assert function.calls == 1
+    assert controller.stats()["retried"] == 0
+    assert controller.stats()["in_flight"] == 0